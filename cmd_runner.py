@@ -0,0 +1,207 @@
+#-------------------------------------------------------------------------------
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Brent Yates
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#-------------------------------------------------------------------------------
+# Runs shell commands for the scripts in this directory. The output of a command
+# is streamed line by line to the log file (and the console when echoing) while
+# it runs, and only the newest lines are kept in memory. Commands can run from
+# several threads at once, can be given a timeout and can be cancelled. The exit
+# code, wall time and resource usage of every command are recorded.
+#-------------------------------------------------------------------------------
+
+from __future__ import print_function
+
+import os
+import sys
+import signal
+import subprocess
+import threading
+import time
+import weakref
+from collections import deque
+
+# Number of stdout and stderr lines kept per command (the newest ones). The log file
+# gets all of them.
+OUTPUT_LINES = 1000
+# Seconds a command has to exit after SIGTERM (timeout or cancel) before it is killed.
+KILL_GRACE = 5.0
+
+# Every runner, for cancel_all()
+_Runners = weakref.WeakSet()
+
+class CommandResult(object):
+    """
+    Outcome of one command. returncode is negative when the command was ended by a
+    signal. stdout and stderr hold the last OUTPUT_LINES lines of each stream.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.returncode = None
+        self.stdout = deque(maxlen = OUTPUT_LINES)
+        self.stderr = deque(maxlen = OUTPUT_LINES)
+        self.seconds = 0.0
+        self.user_seconds = 0.0
+        self.system_seconds = 0.0
+        self.max_rss_kib = 0
+        self.timed_out = False
+        self.cancelled = False
+
+class CommandRunner(object):
+    """
+    Runs shell commands. Each command runs in its own process group so a timeout or
+    cancel() ends the whole pipeline it started.
+    """
+
+    def __init__(self, logfile = None):
+        self.logfile = logfile
+        self._log_lock = threading.Lock()
+        self._log_file = open(logfile, "a") if logfile else None
+        self._lock = threading.Lock()
+        self._running = {}
+        _Runners.add(self)
+
+    def _log(self, text):
+        if self._log_file:
+            with self._log_lock:
+                self._log_file.write(text + "\n")
+                self._log_file.flush()
+
+    def _pump(self, stream, lines, prefix, echo):
+        for raw in iter(stream.readline, b""):
+            Line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            lines.append(Line)
+            self._log(prefix + Line)
+            if echo:
+                print("  " + Line)
+        stream.close()
+
+    def _stop(self, process):
+        """
+        Sends SIGTERM to the process group of a command, then SIGKILL if it is still
+        running after KILL_GRACE seconds.
+        """
+        for sig, wait in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, 0)):
+            try:
+                os.killpg(process.pid, sig)
+            except OSError:
+                return
+            Deadline = time.time() + wait
+            while time.time() < Deadline:
+                if process.pid not in self._running:
+                    return
+                time.sleep(0.05)
+
+    def cancel(self):
+        """
+        Ends every command that is running (from any thread).
+        """
+        with self._lock:
+            Running = list(self._running.items())
+        for pid, (process, result) in Running:
+            result.cancelled = True
+        for pid, (process, result) in Running:
+            self._stop(process)
+
+    def run(self, cmd, workingDir = "", inputStr = None, echo = False, timeout = None):
+        """
+        Runs a shell command and returns its CommandResult. The command is ended after
+        timeout seconds (if given). Interrupting the calling thread (Ctrl-C) ends the
+        command before the interrupt is passed on.
+        """
+        Result = CommandResult(cmd)
+        self._log("$ " + cmd)
+        if echo:
+            print(cmd)
+        Start = time.time()
+        # The command gets its own session (process group) so it can be ended as a whole.
+        if sys.version_info[0] >= 3:
+            Session = {"start_new_session": True}
+        else:
+            Session = {"preexec_fn": os.setsid}
+        Process = subprocess.Popen(cmd, shell = True, cwd = workingDir or None, stdin = subprocess.PIPE,
+                                   stdout = subprocess.PIPE, stderr = subprocess.PIPE, **Session)
+        with self._lock:
+            self._running[Process.pid] = (Process, Result)
+
+        def feed():
+            try:
+                if inputStr is not None:
+                    Process.stdin.write(inputStr.encode("utf-8"))
+            except (IOError, OSError):
+                pass
+            try:
+                Process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+        def reap():
+            # wait4 also returns the resource usage of the command
+            pid, Status, Usage = os.wait4(Process.pid, 0)
+            if os.WIFSIGNALED(Status):
+                Result.returncode = -os.WTERMSIG(Status)
+            else:
+                Result.returncode = os.WEXITSTATUS(Status)
+            # Keep Popen from waiting on the process again
+            Process.returncode = Result.returncode
+            Result.user_seconds = Usage.ru_utime
+            Result.system_seconds = Usage.ru_stime
+            Result.max_rss_kib = Usage.ru_maxrss
+            with self._lock:
+                del self._running[Process.pid]
+
+        Threads = [threading.Thread(target = feed),
+                   threading.Thread(target = self._pump, args = (Process.stdout, Result.stdout, "", echo)),
+                   threading.Thread(target = self._pump, args = (Process.stderr, Result.stderr, "! ", echo)),
+                   threading.Thread(target = reap)]
+        for thread in Threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            Waiter = Threads[-1]
+            while Waiter.is_alive():
+                Waiter.join(0.1)
+                if timeout is not None and Waiter.is_alive() and time.time() - Start > timeout:
+                    Result.timed_out = True
+                    self._log("! timed out after {:.0f}s".format(timeout))
+                    self._stop(Process)
+                    timeout = None
+        except KeyboardInterrupt:
+            Result.cancelled = True
+            self._stop(Process)
+            raise
+        for thread in Threads[:-1]:
+            thread.join()
+        Result.seconds = time.time() - Start
+        self._log("# exit code {} ({:.2f}s, {:.2f}s user, {:.2f}s system, {}KiB max RSS)".format(
+                  Result.returncode, Result.seconds, Result.user_seconds, Result.system_seconds,
+                  Result.max_rss_kib))
+        return(Result)
+
+def cancel_all():
+    """
+    Ends the commands of every runner. Commands run in their own process group so they
+    do not get the terminal's Ctrl-C; a script that is interrupted while other threads
+    run commands calls this.
+    """
+    for runner in list(_Runners):
+        runner.cancel()
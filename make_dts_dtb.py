@@ -27,7 +27,7 @@
 # include files in the Linux source tree.
 #
 # Requires the following Python modules:
-#   shell_helper (https://github.com/byates/shell_helper)
+#   cmd_runner (in this directory)
 #-------------------------------------------------------------------------------
 
 from __future__ import print_function
@@ -38,7 +38,7 @@ import argparse
 import glob
 import shutil
 import pprint
-from shell_helper import ShellHelper
+from cmd_runner import CommandRunner
 from time import sleep
 
 EchoCmds = False
@@ -50,22 +50,17 @@ def run_cmd(cmd, workingDir = "", inputStr = None, suppress_errors={}):
     Returns True if command had no errors otherwise False.
     LastCommandResult holds the command result code.
     """
-    global ShellHelperInst
+    global CommandRunnerInst
     global EchoCmds
     global LastCommandResult
-    r = ShellHelperInst.RunCmdCaptureOutput(cmd, workingDir, inputStr, echo_cmd = EchoCmds)
-    if EchoCmds:
-        if r[1]:
-            for line in r[1]:
-                print("  " + line)
-    LastCommandResult = r[0]
+    r = CommandRunnerInst.run(cmd, workingDir, inputStr, echo = EchoCmds)
+    LastCommandResult = r.returncode
     # Check for errors (non-zero return code)
     if LastCommandResult != 0 and (not LastCommandResult in suppress_errors):
-        if r[2]:
-            for line in r[2]:
-                print(line)
+        for line in r.stderr:
+            print(line)
         cmdName = cmd.split()[0]
-        print("ERROR: "+cmdName+" failed with code {}.".format(r[0]))
+        print("ERROR: "+cmdName+" failed with code {}.".format(r.returncode))
         return(False)
     return(True)
 
@@ -92,7 +87,7 @@ if __name__ == '__main__':
     Args = Parser.parse_args()
 
     EchoCmds = Args.verbose
-    ShellHelperInst = ShellHelper(logfile = Args.logfile)
+    CommandRunnerInst = CommandRunner(logfile = Args.logfile)
 
     # If the user has specified a location for the kernel source then use it otherwise
     # try the environment variable.
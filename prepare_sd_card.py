@@ -26,7 +26,7 @@
 # Script to create Boot SD card for the Altera SOC FPGAs
 #
 # Requires the following Python modules:
-#   shell_helper (https://github.com/byates/shell_helper)
+#   cmd_runner (in this directory)
 #   reparted
 #   colorama
 #-------------------------------------------------------------------------------
@@ -41,31 +41,104 @@ import glob
 import shutil
 import pprint
 import fnmatch
+import copy
+import threading
+import time
+import tarfile
+import stat
+import json
+import hashlib
+import mmap
+import fcntl
+import struct
+import random
+import tempfile
+import re
+import socket
+import select
 from colorama import Fore, Style
 import reparted
-from shell_helper import ShellHelper
+from cmd_runner import CommandRunner, cancel_all
 from time import sleep
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    string_types = (basestring,)
+except NameError:
+    string_types = (str,)
 
 MIB = (1024*1024)
 GIB = (MIB * 1024)
 
 SECTOR_SIZE = 512  # bytes
-# 1MiB alignment (arbitrary but should be multiple of 128KiB)
-SECTOR_ALIGNMENT = (1024*1024) / SECTOR_SIZE
+# Minimum 1MiB partition alignment (arbitrary but should be multiple of 128KiB). The
+# partitions are aligned to the card's erase block (allocation unit) when it is larger.
+SECTOR_ALIGNMENT = (1024*1024) // SECTOR_SIZE
+# Erase block size used when the card does not report one, and the largest one used.
+DEFAULT_ERASE_BLOCK = 4 * MIB
+MAX_ERASE_BLOCK = 64 * MIB
+# SD allocation unit sizes for the AU_SIZE field of the SD Status register (SSR).
+SD_AU_SIZES = [0, 16*1024, 32*1024, 64*1024, 128*1024, 256*1024, 512*1024, MIB, 2*MIB, 4*MIB,
+               8*MIB, 12*MIB, 16*MIB, 24*MIB, 32*MIB, 64*MIB]
+# ext4 stride in 4KiB blocks (the 8KiB page these cards were tuned for). The stripe
+# width is the erase block.
+EXT4_STRIDE = 2
 
 # Changing these will require changing the preloader and u-boot images.
 FAT_PARTITION = 1
 RAW_PARTITION = 2
 ROOTFS_PARTITION = 3
 USER_PARTITION = 4
+# Partition names accepted on the command line.
+PARTITION_NAMES = {"fat": FAT_PARTITION, "raw": RAW_PARTITION, "rootfs": ROOTFS_PARTITION, "user": USER_PARTITION}
+# File system of each partition.
+PARTITION_FILESYSTEMS = {"fat": "vfat", "raw": "raw", "rootfs": "ext4", "user": "ext4"}
+
+# The card layout used without --layout, in the layout file format (JSON, or TOML with
+# [[partitions]] tables). Every partition above is listed once, in the order they are
+# placed on the card. Sizes are absolute ("256MiB"), a percentage of the card ("25%"),
+# "fit" or "fit+<margin>" (the size of what is installed on the partition plus a margin
+# given as a size or a percentage) or "rest" (what is left, one partition at most). Each
+# partition starts on an erase block boundary and is rounded up to whole erase blocks.
+# "mkfs" names a profile of MKFS_PROFILES or of the file's own "mkfs_profiles"; without
+# one the built-in tuning is used.
+DEFAULT_LAYOUT = {
+    "partitions": [
+        {"name": "fat",    "size": "255MiB",  "type": "0x0B", "fs": "vfat", "bootable": True},
+        {"name": "raw",    "size": "16MiB",   "type": "0xA2", "fs": "raw"},
+        {"name": "rootfs", "size": "1280MiB", "type": "0x83", "fs": "ext4"},
+        {"name": "user",   "size": "rest",    "type": "0x83", "fs": "ext4"},
+    ],
+}
+# Options passed to mkfs in place of the built-in tuning. The stripe, discard, block
+# size and label options are always added for ext4.
+MKFS_PROFILES = {
+    "ext4-nojournal": "-O ^has_journal,^huge_file",
+    "ext4-journal":   "-O ^huge_file",
+    "ext4-small":     "-O ^has_journal,^huge_file -m 0 -i 8192",
+    "vfat":           "",
+}
+# "fit" sizes of ext4 partitions leave room for the metadata and reserved blocks of a
+# file system made with the mke2fs defaults (bytes per inode, inode size, 5% reserved)
+# plus a fixed slack for the journal and group descriptors. A FAT32 partition is never
+# given less than FAT32_MIN_SIZE.
+EXT4_INODE_RATIO = 16384
+EXT4_INODE_SIZE = 256
+EXT4_RESERVED = 0.05
+EXT4_FIT_SLACK = 16 * MIB
+FAT32_MIN_SIZE = 40 * MIB
+# --layout auto sizes the FAT and ROOTFS partitions to their content plus this much
+# headroom (percent, --headroom) and gives the rest of the card to USER.
+AUTO_HEADROOM = 25
 
-NODE_SUFFIX_FAT = str(FAT_PARTITION)
-NODE_SUFFIX_ROOTFS = str(ROOTFS_PARTITION)
-NODE_SUFFIX_RAW = str(RAW_PARTITION)
-NODE_SUFFIX_USER = str(USER_PARTITION)
 FAT_MOUNT_POINT = "/mnt/emmc_p1"
 ROOTFS_MOUNT_POINT = "/mnt/emmc_p3"
 USER_MOUNT_POINT = "/mnt/emmc_p4"
+# When several devices are provisioned at once each one gets its own mount points
+# under this directory (e.g., /mnt/sdcard_sdc_p1).
+PRIVATE_MOUNT_ROOT = "/mnt"
 
 # We look for Preloader, FAT, and ROOTFS files in a set of directories under a common
 # directory (args.images_loc). Each partition type has a directory.
@@ -78,6 +151,107 @@ IMAGE_FILES_FAT_LOC = "fat_partition"
 IMAGE_FILES_ROOTFS_LOC = "rootfs_partition"
 IMAGE_FILES_USER_LOC = "user_partition"
 
+# The fan-out writer reads its source in chunks of this size and each target device
+# can fall this many chunks behind the reader before the reader has to wait.
+FANOUT_CHUNK_SIZE = 1 * MIB
+FANOUT_QUEUE_DEPTH = 16
+
+# The native rootfs extractor hands files up to this size to a pool of writer threads
+# (larger files are streamed by the reader). The queue depth bounds the memory used.
+EXTRACT_THREADS = 8
+EXTRACT_SMALL_FILE_SIZE = 256 * 1024
+EXTRACT_QUEUE_DEPTH = 256
+
+# Block maps (bmap) describe the ranges of a card image that hold data. Ranges are in
+# units of BMAP_BLOCK_SIZE and are written to the card in chunks of FLASH_CHUNK_SIZE.
+BMAP_BLOCK_SIZE = 4096
+BMAP_EXTENSION = ".bmap"
+FLASH_CHUNK_SIZE = 4 * MIB
+# Number of FLASH_CHUNK_SIZE buffers between the decompressor and the device writer
+# (two gives double buffering: one being filled while the other is written).
+FLASH_BUFFERS = 2
+# lseek() whence values for finding the data in sparse files (Linux).
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# Read-back verification hashes files on this many threads, reading VERIFY_CHUNK_SIZE
+# bytes at a time.
+VERIFY_THREADS = 4
+VERIFY_CHUNK_SIZE = 4 * MIB
+# Block device ioctls: flush and invalidate buffers, re-read the partition table and
+# get the logical sector size.
+BLKFLSBUF = 0x1261
+BLKRRPART = 0x125F
+BLKSSZGET = 0x1268
+# Erase ioctls: discard, secure discard and zero a byte range ([start, length]).
+BLKDISCARD = 0x1277
+BLKSECDISCARD = 0x127D
+BLKZEROOUT = 0x127F
+# After an erase this much is read back at the start, middle and end of the range to
+# find out if discarded blocks read back as zeroes.
+ERASE_CHECK_SIZE = MIB
+# Where discard is not supported only this much at the start of the node (partition
+# table and file system headers) is zeroed, unless --erase-zero-fallback is given.
+ERASE_ZERO_HEAD = 4 * MIB
+# How long to wait for the kernel/udev to create the partition nodes after the
+# partition table is re-read, and how often to look.
+PARTITION_NODE_TIMEOUT = 10.0
+PARTITION_NODE_POLL = 0.05
+
+# CopyRootFS writes a manifest of the archive next to it (<name>.manifest) for delta
+# installs. These top level directories are never in the archive so a delta install
+# leaves them alone.
+ROOTFS_MANIFEST_EXTENSION = ".manifest"
+ROOTFS_EXCLUDED_DIRS = ("proc", "sys", "dev", "mnt", "media", "lost+found")
+
+# FAT32 boot partition images built in-process.
+FAT32_RESERVED_SECTORS = 32
+FAT32_MIN_CLUSTERS = 65525
+FAT32_EOC = 0x0FFFFFFF
+# The FAT data area is aligned to the erase block up to this size (the reserved sector
+# count that pads it is a 16 bit field).
+FAT32_MAX_ALIGNMENT = 4 * MIB
+FAT_LABEL = "BOOT"
+
+# mkfs.ext4 options of offline built ROOTFS images. lazy_itable_init leaves the inode
+# tables to the kernel so the holes in the image do not have to be written as zeros.
+ROOTFS_IMAGE_MKFS_OPTIONS = "-O ^has_journal,^huge_file -E {},lazy_itable_init=1,root_owner=0:0 -b 4096"
+
+# Offline built partition images are kept in a cache keyed by a hash of their inputs
+# and format options. Least recently used images are removed above the size budget.
+IMAGE_CACHE_DIR = "/var/cache/prepare_sd_card"
+IMAGE_CACHE_BUDGET = "8GiB"
+IMAGE_CACHE_VERSION = 1
+
+# Drives are found here rather than by probing every device with libparted. Names with
+# these prefixes are virtual devices that are never an install target.
+SYS_BLOCK = "/sys/block"
+SKIPPED_BLOCK_DEVICES = ("loop", "ram", "zram", "dm-", "md", "sr", "fd", "nbd")
+MOUNTINFO = "/proc/self/mountinfo"
+
+# --watch mode. Kernel uevents are read from this netlink family (/sys/block is polled
+# when it is not available). Only cards in MMC/SD host slots and USB readers whose
+# vendor or model matches WATCH_READER_MODELS are provisioned. The settle time lets the
+# kernel finish scanning a new card before it is used.
+NETLINK_KOBJECT_UEVENT = 15
+WATCH_READER_MODELS = r"\b(MICRO ?)?SD|MMC|CARD|READER|CRW"
+WATCH_POLL_INTERVAL = 1.0
+WATCH_SETTLE = 2.0
+WATCH_HOOK_TIMEOUT = 60
+
+# ROOTFS archive codecs: archive extension, default level and the magic bytes used to
+# detect the codec of an existing archive.
+ROOTFS_CODECS = {
+    "gz":   (".tar.gz",  6, b"\x1f\x8b"),
+    "zstd": (".tar.zst", 3, b"\x28\xb5\x2f\xfd"),
+    "lz4":  (".tar.lz4", 1, b"\x04\x22\x4d\x18"),
+    "xz":   (".tar.xz",  6, b"\xfd7zXZ\x00"),
+}
+# Codec of a ROOTFS copy when neither --rootfs-codec nor the -c extension gives one, and
+# the short archive extensions of the codecs (also accepted by -c).
+ROOTFS_DEFAULT_CODEC = "gz"
+ROOTFS_SHORT_EXTENSIONS = {".tgz": "gz", ".tzst": "zstd", ".tlz4": "lz4", ".txz": "xz"}
+
 # SYNC is used to flush file system buffers so that that SDCard gets the data
 # we have written. It is avaialbe natively in python3 but not in 2.
 if hasattr(os, 'sync'):
@@ -88,20 +262,1820 @@ else:
     def sync():
         libc.sync()
 
+SIZE_UNITS = {
+    "":    1,
+    "B":   1,
+    "K":   1024,        "KIB": 1024,        "KB": 1000,
+    "M":   MIB,         "MIB": MIB,         "MB": 1000*1000,
+    "G":   GIB,         "GIB": GIB,         "GB": 1000*1000*1000,
+}
+
+def parse_size(text):
+    """
+    Converts a size string such as '4GiB', '3900MB' or '512M' into a number of bytes.
+    Returns None if the string can not be parsed.
+    """
+    text = text.strip()
+    Index = len(text)
+    while Index > 0 and text[Index - 1].isalpha():
+        Index = Index - 1
+    Units = text[Index:].upper()
+    if Units not in SIZE_UNITS:
+        return(None)
+    try:
+        Value = float(text[:Index])
+    except ValueError:
+        return(None)
+    return(int(Value * SIZE_UNITS[Units]))
+
+def read_sysfs(path, default = ""):
+    """
+    Returns the stripped contents of a sysfs attribute or default if it can not be read.
+    """
+    try:
+        with open(path) as f:
+            return(f.read().strip())
+    except (IOError, OSError):
+        return(default)
+
+class BlockDevice(object):
+    """
+    A whole disk found under /sys/block. Only sysfs is read to build it, libparted is
+    opened on the device the first time parted() is called.
+    """
+
+    def __init__(self, name, sys_block = SYS_BLOCK):
+        SysPath = os.path.join(sys_block, name)
+        self.name = name
+        self.path = "/dev/" + name
+        # sysfs sizes are always in 512 byte units, whatever the logical sector size.
+        self.size = reparted.Size(int(read_sysfs(os.path.join(SysPath, "size"), "0")) * 512, "B")
+        self.removable = read_sysfs(os.path.join(SysPath, "removable")) == "1"
+        Real = os.path.realpath(SysPath)
+        if "/usb" in Real:
+            self.transport = "usb"
+        elif "/mmc_host/" in Real:
+            self.transport = "mmc"
+        elif "/nvme/" in Real:
+            self.transport = "nvme"
+        elif "/ata" in Real:
+            self.transport = "ata"
+        elif "/virtio" in Real:
+            self.transport = "virtio"
+        else:
+            self.transport = ""
+        DevicePath = os.path.join(SysPath, "device")
+        self.vendor = read_sysfs(os.path.join(DevicePath, "vendor"))
+        # virtio and NVMe report a numeric PCI vendor id here, which says nothing useful.
+        if self.vendor.startswith("0x"):
+            self.vendor = ""
+        # MMC/SD cards have a product name instead of a model and also expose their CID.
+        self.model = read_sysfs(os.path.join(DevicePath, "model")) or read_sysfs(os.path.join(DevicePath, "name"))
+        self.cid = read_sysfs(os.path.join(DevicePath, "cid"))
+        self._parted = None
+
+    def parted(self):
+        """
+        Returns the reparted device for this disk, opening it on first use.
+        """
+        if self._parted is None:
+            self._parted = reparted.Device(self.path)
+        return(self._parted)
+
+    def description(self):
+        """
+        Returns a one line summary of the transport, vendor, model and CID of the device.
+        """
+        Parts = []
+        if self.transport:
+            Parts.append(self.transport)
+        if self.removable:
+            Parts.append("removable")
+        Model = " ".join(p for p in (self.vendor, self.model) if p)
+        if Model:
+            Parts.append(Model)
+        if self.cid:
+            Parts.append("CID " + self.cid)
+        return(", ".join(Parts))
+
+    def is_card_reader(self):
+        """
+        Returns True for a card in an MMC/SD host slot or in a USB reader whose vendor or
+        model names it an SD/MMC card reader (USB sticks and disks are not).
+        """
+        if self.transport == "mmc":
+            return(True)
+        return(self.transport == "usb" and
+               re.search(WATCH_READER_MODELS, self.vendor + " " + self.model, re.IGNORECASE) is not None)
+
+    def __str__(self):
+        return(self.path)
+
+def probe_block_devices(sys_block = SYS_BLOCK):
+    """
+    Returns a BlockDevice for every disk under /sys/block that could be an install target.
+    Virtual devices (loop, ram, device mapper, ...), the boot and RPMB areas of eMMC parts
+    and empty card readers are left out.
+    """
+    Devices = []
+    try:
+        Names = sorted(os.listdir(sys_block))
+    except OSError:
+        return(Devices)
+    for name in Names:
+        if name.startswith(SKIPPED_BLOCK_DEVICES):
+            continue
+        if re.match(r"mmcblk\d+(boot\d+|rpmb)$", name):
+            continue
+        if not os.path.exists(os.path.join(sys_block, name, "device")):
+            continue
+        Device = BlockDevice(name, sys_block)
+        if Device.size.to("B") == 0:
+            continue
+        Devices.append(Device)
+    return(Devices)
+
+class MountTable(object):
+    """
+    Index of the mounts of this process, read from /proc/self/mountinfo and keyed by the
+    major:minor of the mounted device. The kernel flags the open mountinfo file when the
+    mounts change, so the table is only read again after a mount or unmount.
+    """
+
+    def __init__(self, path = MOUNTINFO):
+        self._fd = os.open(path, os.O_RDONLY)
+        self._poll = select.poll()
+        self._poll.register(self._fd, select.POLLPRI | select.POLLERR)
+        self._lock = threading.Lock()
+        self._mounts = None
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        Chunks = []
+        while True:
+            Chunk = os.read(self._fd, 65536)
+            if not Chunk:
+                break
+            Chunks.append(Chunk)
+        Mounts = []
+        for line in b"".join(Chunks).decode("utf-8", "replace").splitlines():
+            # id parent major:minor root mount_point options [optional...] - type source super_options
+            Fields = line.split()
+            Mounts.append({"id": Fields[0], "parent": Fields[1], "dev": Fields[2],
+                           "path": re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), Fields[4])})
+        return(Mounts)
+
+    def mounts(self):
+        """
+        Returns the current mounts as a list of dicts (id, parent, dev, path).
+        """
+        with self._lock:
+            if self._mounts is None or self._poll.poll(0):
+                self._mounts = self._read()
+            return(self._mounts)
+
+    def mount_points(self, dev):
+        """
+        Returns the mount points of device number dev ("major:minor").
+        """
+        return([mount["path"] for mount in self.mounts() if mount["dev"] == dev])
+
+    def under(self, devs):
+        """
+        Returns the mount points of the devices in devs and of everything mounted below
+        them, deepest first.
+        """
+        Mounts = self.mounts()
+        Ids = set(mount["id"] for mount in Mounts if mount["dev"] in devs)
+        Changed = True
+        while Changed:
+            Changed = False
+            for mount in Mounts:
+                if mount["id"] not in Ids and mount["parent"] in Ids:
+                    Ids.add(mount["id"])
+                    Changed = True
+        Paths = [mount["path"] for mount in Mounts if mount["id"] in Ids]
+        return(sorted(Paths, key = lambda path: path.rstrip("/").count("/"), reverse = True))
+
+def device_number(path):
+    """
+    Returns the "major:minor" of a device node or None if it does not exist.
+    """
+    try:
+        Rdev = os.stat(path).st_rdev
+    except OSError:
+        return(None)
+    return("{}:{}".format(os.major(Rdev), os.minor(Rdev)))
+
+class ImageFileDevice(object):
+    """
+    Stands in for a BlockDevice when the target is a regular image file. The image is
+    attached to a loop device with partition scanning enabled so that the same partition,
+    format and mount commands used for an SDCard work unchanged.
+    """
+
+    def __init__(self, image_path, loop_path, size_bytes):
+        self.image_path = image_path
+        self.path = loop_path
+        self.size = reparted.Size(size_bytes, "B")
+
+    def parted(self):
+        return(reparted.Device(self.path))
+
+    def __str__(self):
+        return(self.image_path + " (" + self.path + ")")
+
+class FileSink(object):
+    """
+    Fan-out sink that writes to a file or device node and flushes it to the media on close.
+    """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self._file = None
+
+    def open(self):
+        self._file = open(self.path, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        return(True)
+
+class ProcessSink(object):
+    """
+    Fan-out sink that pipes the data into the stdin of a command (e.g., tar -x).
+    """
+
+    def __init__(self, name, args, cwd = None):
+        self.name = name
+        self.args = args
+        self.cwd = cwd
+        self._process = None
+
+    def open(self):
+        self._process = subprocess.Popen(self.args, cwd = self.cwd, stdin = subprocess.PIPE)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def close(self):
+        if not self._process:
+            return(False)
+        self._process.stdin.close()
+        return(self._process.wait() == 0)
+
+class FanOutWriter(object):
+    """
+    Reads a source once and tees the bytes to several sinks. Each sink has a bounded queue
+    and its own writer thread, so the reader only waits when the slowest sink is a full
+    queue behind. A sink that fails is dropped and the others carry on.
+    """
+
+    def __init__(self, sinks, chunk_size = FANOUT_CHUNK_SIZE, queue_depth = FANOUT_QUEUE_DEPTH):
+        self.sinks = sinks
+        self.chunk_size = chunk_size
+        self.queue_depth = queue_depth
+        self.errors = [None] * len(sinks)
+        self.bytes_read = 0
+
+    def _drain(self, index, sinkQueue):
+        Sink = self.sinks[index]
+        try:
+            Sink.open()
+        except Exception as e:
+            self.errors[index] = e
+        while True:
+            Data = sinkQueue.get()
+            if Data is None:
+                break
+            if self.errors[index] is None:
+                try:
+                    Sink.write(Data)
+                except Exception as e:
+                    self.errors[index] = e
+        try:
+            if not Sink.close() and self.errors[index] is None:
+                self.errors[index] = "close failed"
+        except Exception as e:
+            if self.errors[index] is None:
+                self.errors[index] = e
+
+    def run(self, source):
+        """
+        Copies everything readable from the source file object to every sink.
+        Returns a list with one entry per sink: None on success otherwise the error.
+        """
+        Queues = [queue.Queue(self.queue_depth) for sink in self.sinks]
+        Threads = [threading.Thread(target = self._drain, args = (i, q)) for i, q in enumerate(Queues)]
+        for thread in Threads:
+            thread.start()
+        try:
+            while True:
+                Data = source.read(self.chunk_size)
+                if not Data:
+                    break
+                self.bytes_read = self.bytes_read + len(Data)
+                for index, sinkQueue in enumerate(Queues):
+                    if self.errors[index] is None:
+                        sinkQueue.put(Data)
+        except Exception as e:
+            # A read error fails every sink
+            self.errors = [err or e for err in self.errors]
+        finally:
+            for sinkQueue in Queues:
+                sinkQueue.put(None)
+            for thread in Threads:
+                thread.join()
+        return(self.errors)
+
+def which(program):
+    """
+    Returns the full path of program if it is found on the PATH otherwise None.
+    """
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        Candidate = os.path.join(directory, program)
+        if os.path.isfile(Candidate) and os.access(Candidate, os.X_OK):
+            return(Candidate)
+    return(None)
+
+def detect_codec(archive_path):
+    """
+    Returns the ROOTFS_CODECS key of an archive based on its magic bytes, or None.
+    """
+    with open(archive_path, "rb") as f:
+        Header = f.read(8)
+    for codec, (ext, level, magic) in ROOTFS_CODECS.items():
+        if Header.startswith(magic):
+            return(codec)
+    return(None)
+
+def archive_extension(path):
+    """
+    Returns the tar archive extension (.tar, .tar.<codec>, .tgz, .txz, ...) of a path, or
+    "" if it does not have one.
+    """
+    Match = re.search(r"(\.tar(\.[A-Za-z0-9]+)?|\.t(gz|zst|lz4|xz|bz2?))$", path)
+    return(Match.group(0) if Match else "")
+
+def extension_codec(extension):
+    """
+    Returns the ROOTFS_CODECS key of an archive extension (see archive_extension), or
+    None if it is not one of the codecs.
+    """
+    for codec, (ext, level, magic) in ROOTFS_CODECS.items():
+        if extension == ext:
+            return(codec)
+    return(ROOTFS_SHORT_EXTENSIONS.get(extension))
+
+def compress_command(codec, level = None):
+    """
+    Returns the (multithreaded where possible) compressor command line for the codec.
+    """
+    if level is None:
+        level = ROOTFS_CODECS[codec][1]
+    if codec == "gz":
+        # pigz uses every core by default
+        return([which("pigz") and "pigz" or "gzip", "-" + str(level)])
+    if codec == "zstd":
+        return(["zstd", "-T0", "-q", "-" + str(level)])
+    if codec == "lz4":
+        return(["lz4", "-q", "-" + str(level)])
+    return(["xz", "-T0", "-" + str(level)])
+
+def decompressor_args(codec):
+    """
+    Returns the command line that decompresses codec data from stdin (or from the files
+    appended to it) to stdout. A parallel decompressor is used when one is installed.
+    """
+    if codec == "zstd":
+        return(["zstd", "-dcq"])
+    if codec == "lz4":
+        return(["lz4", "-dcq"])
+    if codec == "xz":
+        return(["xz", "-T0", "-dc"])
+    if codec is None:
+        # Not compressed
+        return(["cat"])
+    if which("pigz"):
+        return(["pigz", "-dc"])
+    return(["gzip", "-dc"])
+
+def decompress_command(archive_path):
+    """
+    Returns the command line that writes the decompressed archive to stdout. The codec is
+    detected from the archive.
+    """
+    return(decompressor_args(detect_codec(archive_path)) + [archive_path])
+
+class RootfsExtractor(object):
+    """
+    Extracts a tar stream into a directory. A tar stream can only be read in order, so the
+    members are read by one thread, while the data of small files is written by a pool of
+    threads (a rootfs is mostly small files so the per-file open/write/chown/chmod cost
+    dominates). Ownership is kept numerically, as are modes, times, symlinks, hard links and
+    device nodes. Directory metadata is applied last, deepest first.
+    """
+
+    def __init__(self, dest_dir, threads = EXTRACT_THREADS):
+        self.dest_dir = dest_dir
+        self.threads = threads
+        self.errors = []
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(EXTRACT_QUEUE_DEPTH)
+        self._last_report = 0
+        # Directories under dest_dir known not to be symlinks
+        self._real_dirs = set([os.path.normpath(dest_dir)])
+
+    def _target(self, member):
+        Name = member.name.lstrip("/")
+        if Name in ("", "."):
+            return(self.dest_dir)
+        if ".." in Name.split("/"):
+            raise IOError("unsafe path in archive: " + member.name)
+        Path = os.path.normpath(os.path.join(self.dest_dir, Name))
+        self._check_parents(os.path.dirname(Path), member)
+        return(Path)
+
+    def _check_parents(self, parent, member):
+        """
+        Raises IOError if a directory the member would be written to is a symlink (it could
+        point outside of dest_dir). Only called from the thread reading the archive.
+        """
+        Checked = []
+        while parent not in self._real_dirs:
+            try:
+                Mode = os.lstat(parent).st_mode
+            except OSError:
+                # Does not exist yet, makedirs creates it as a directory.
+                Mode = None
+            if Mode is not None:
+                if stat.S_ISLNK(Mode):
+                    raise IOError("unsafe path in archive (symlinked parent): " + member.name)
+                Checked.append(parent)
+            Next = os.path.dirname(parent)
+            if Next == parent:
+                break
+            parent = Next
+        self._real_dirs.update(Checked)
+
+    def _set_attributes(self, path, member):
+        os.lchown(path, member.uid, member.gid)
+        if not member.issym():
+            # chmod after chown since chown clears the setuid/setgid bits
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+        elif os.utime in getattr(os, "supports_follow_symlinks", ()):
+            os.utime(path, (member.mtime, member.mtime), follow_symlinks = False)
+
+    def _remove_existing(self, path):
+        if os.path.islink(path) or (os.path.lexists(path) and not os.path.isdir(path)):
+            os.unlink(path)
+
+    def _write_file(self, path, member, data):
+        self._remove_existing(path)
+        with open(path, "wb") as f:
+            f.write(data)
+        self._set_attributes(path, member)
+        self._add_bytes(len(data))
+
+    def _add_bytes(self, count):
+        with self._lock:
+            self.bytes_written = self.bytes_written + count
+
+    def _worker(self):
+        while True:
+            Item = self._queue.get()
+            if Item is None:
+                break
+            try:
+                self._write_file(*Item)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append(Item[0] + ": " + str(e))
+
+    def _report(self, start, final = False):
+        Now = time.time()
+        if not final and Now - self._last_report < 1.0:
+            return
+        self._last_report = Now
+        Elapsed = max(Now - start, 0.001)
+        print("\r  {:.1f}MiB written at {:.1f}MiB/s ".format(self.bytes_written / float(MIB),
+                                                         self.bytes_written / Elapsed / MIB),
+              end = "\n" if final else "")
+        sys.stdout.flush()
+
+    def extract(self, stream, only = None):
+        """
+        Extracts the tar stream (a file object). If only is given just the members whose
+        normalized names are in it are extracted. Returns True on success.
+        """
+        Workers = [threading.Thread(target = self._worker) for i in range(self.threads)]
+        for worker in Workers:
+            worker.start()
+        Directories = []
+        HardLinks = []
+        Start = time.time()
+        try:
+            Archive = tarfile.open(fileobj = stream, mode = "r|")
+            for member in Archive:
+                if only is not None and os.path.normpath(member.name.lstrip("/")) not in only:
+                    continue
+                Path = self._target(member)
+                if member.isdir():
+                    if Path != os.path.normpath(self.dest_dir):
+                        # Replaces a symlink (or file) with a real directory.
+                        self._remove_existing(Path)
+                    if not os.path.isdir(Path):
+                        os.makedirs(Path)
+                    Directories.append((Path, member))
+                    continue
+                Parent = os.path.dirname(Path)
+                if not os.path.isdir(Parent):
+                    os.makedirs(Parent)
+                if member.isreg():
+                    Source = Archive.extractfile(member)
+                    if member.size <= EXTRACT_SMALL_FILE_SIZE:
+                        self._queue.put((Path, member, Source.read()))
+                    else:
+                        self._remove_existing(Path)
+                        with open(Path, "wb") as f:
+                            while True:
+                                Data = Source.read(FANOUT_CHUNK_SIZE)
+                                if not Data:
+                                    break
+                                f.write(Data)
+                                self._add_bytes(len(Data))
+                        self._set_attributes(Path, member)
+                elif member.islnk():
+                    # The link target may still be queued so hard links are made at the end.
+                    HardLinks.append((Path, member))
+                elif member.issym():
+                    self._remove_existing(Path)
+                    os.symlink(member.linkname, Path)
+                    self._set_attributes(Path, member)
+                elif member.ischr() or member.isblk() or member.isfifo():
+                    self._remove_existing(Path)
+                    if member.ischr():
+                        Type = stat.S_IFCHR
+                    elif member.isblk():
+                        Type = stat.S_IFBLK
+                    else:
+                        Type = stat.S_IFIFO
+                    os.mknod(Path, member.mode | Type, os.makedev(member.devmajor, member.devminor))
+                    self._set_attributes(Path, member)
+                self._report(Start)
+        except Exception as e:
+            self.errors.append(str(e))
+        finally:
+            for worker in Workers:
+                self._queue.put(None)
+            for worker in Workers:
+                worker.join()
+        for path, member in HardLinks:
+            try:
+                self._remove_existing(path)
+                os.link(self._target(tarfile.TarInfo(member.linkname)), path)
+            except Exception as e:
+                self.errors.append(path + ": " + str(e))
+        # Deepest first so setting a directory's mtime is not undone by its children.
+        for path, member in sorted(Directories, key = lambda d: d[0].count("/"), reverse = True):
+            try:
+                self._set_attributes(path, member)
+            except Exception as e:
+                self.errors.append(path + ": " + str(e))
+        self._report(Start, final = True)
+        return(not self.errors)
+
+def image_data_ranges(fd, size, block_size = BMAP_BLOCK_SIZE):
+    """
+    Returns the [first, last] block ranges of a (sparse) file that contain data. The
+    holes of the file are found with SEEK_DATA/SEEK_HOLE.
+    """
+    Ranges = []
+    Offset = 0
+    while Offset < size:
+        try:
+            Start = os.lseek(fd, Offset, SEEK_DATA)
+        except OSError:
+            # ENXIO: no more data after Offset
+            break
+        End = os.lseek(fd, Start, SEEK_HOLE)
+        First = Start // block_size
+        Last = (min(End, size) + block_size - 1) // block_size - 1
+        if Ranges and First <= Ranges[-1][1] + 1:
+            Ranges[-1][1] = max(Ranges[-1][1], Last)
+        else:
+            Ranges.append([First, Last])
+        Offset = End
+    return(Ranges)
+
+def hash_range(fd, first, last, block_size, on_chunk = None):
+    """
+    Returns the sha256 of blocks first to last (inclusive) of an open file. on_chunk is
+    called with each chunk read and its offset so a caller can write it elsewhere too.
+    """
+    Hash = hashlib.sha256()
+    Offset = first * block_size
+    Remaining = (last - first + 1) * block_size
+    while Remaining > 0:
+        os.lseek(fd, Offset, os.SEEK_SET)
+        Data = os.read(fd, min(Remaining, FLASH_CHUNK_SIZE))
+        if not Data:
+            break
+        Hash.update(Data)
+        if on_chunk:
+            on_chunk(Data, Offset)
+        Offset = Offset + len(Data)
+        Remaining = Remaining - len(Data)
+    return(Hash.hexdigest())
+
+def write_at(fd, data, offset):
+    """
+    Writes all of data at offset of an open file.
+    """
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        Written = os.write(fd, data)
+        data = data[Written:]
+
+def buffer_slice(data, start, end):
+    """
+    Returns bytes start to end of a buffer (such as an mmap) without copying them, so a
+    page aligned buffer stays aligned for O_DIRECT writes.
+    """
+    if sys.version_info[0] >= 3:
+        return(memoryview(data)[start:end])
+    return(buffer(data, start, end - start))
+
+def write_all(fd, data):
+    """
+    Writes all of data to an open file, retrying short writes.
+    """
+    Done = 0
+    while Done < len(data):
+        # Slicing a Python 2 buffer copies it, so the first write passes data as is.
+        Written = os.write(fd, data[Done:] if Done else data)
+        if Written <= 0:
+            raise IOError("short write")
+        Done = Done + Written
+
+class ImageFlasher(object):
+    """
+    Writes a (possibly compressed) card image to a device. A feeder thread pipes the
+    compressed file into a decompressor process, a reader thread fills page aligned
+    buffers from its output and the calling thread writes full buffers to the device
+    opened with O_DIRECT (when the device supports it). The buffers are handed over through
+    bounded queues so decompression and writing overlap.
+    """
+
+    def __init__(self, image_path, device_path, chunk_size = FLASH_CHUNK_SIZE, buffers = FLASH_BUFFERS):
+        self.image_path = image_path
+        self.device_path = device_path
+        self.chunk_size = chunk_size
+        self.buffers = buffers
+        self.bytes_in = 0
+        self.bytes_written = 0
+        self.error = None
+        # Set when run() stops taking buffers (after a write error)
+        self._stopped = threading.Event()
+
+    def _put(self, q, item):
+        """
+        Puts item on a bounded queue. Returns False, without blocking for good, once the
+        writer has stopped.
+        """
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout = 0.1)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+
+    def _get(self, q):
+        """
+        Returns the next item of a queue or None once the writer has stopped.
+        """
+        while not self._stopped.is_set():
+            try:
+                return(q.get(timeout = 0.1))
+            except queue.Empty:
+                pass
+        return(None)
+
+    def _feed(self, process):
+        try:
+            with open(self.image_path, "rb") as f:
+                while True:
+                    Data = f.read(self.chunk_size)
+                    if not Data:
+                        break
+                    process.stdin.write(Data)
+                    self.bytes_in = self.bytes_in + len(Data)
+        except Exception as e:
+            # The decompressor exited early; the reader sees the error.
+            self.error = self.error or e
+        finally:
+            try:
+                process.stdin.close()
+            except Exception:
+                pass
+
+    def _fill(self, process, free, full):
+        try:
+            while True:
+                Buffer = self._get(free)
+                if Buffer is None:
+                    break
+                Length = 0
+                while Length < self.chunk_size:
+                    Data = process.stdout.read(self.chunk_size - Length)
+                    if not Data:
+                        break
+                    Buffer[Length:Length + len(Data)] = Data
+                    Length = Length + len(Data)
+                if Length and not self._put(full, (Buffer, Length)):
+                    break
+                if Length < self.chunk_size:
+                    break
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            self._put(full, None)
+
+    def _open_device(self):
+        """
+        Returns (fd, direct). Falls back to buffered I/O where O_DIRECT is not supported.
+        """
+        if hasattr(os, "O_DIRECT"):
+            try:
+                return(os.open(self.device_path, os.O_WRONLY | os.O_DIRECT), True)
+            except OSError:
+                pass
+        return(os.open(self.device_path, os.O_WRONLY), False)
+
+    def _report(self, start, total, final = False):
+        Elapsed = max(time.time() - start, 0.001)
+        Rate = self.bytes_written / Elapsed
+        Text = "\r  {:.1f}MiB written at {:.1f}MiB/s".format(self.bytes_written / float(MIB), Rate / MIB)
+        if total and self.bytes_in and not final:
+            # The compressed input read so far gives the fraction done.
+            Remaining = Elapsed * (total - self.bytes_in) / float(self.bytes_in)
+            Text = Text + "  {:3d}%  ETA {:d}:{:02d}".format(int(100 * self.bytes_in / total),
+                                                           int(Remaining) // 60, int(Remaining) % 60)
+        print(Text + "      ", end = "\n" if final else "")
+        sys.stdout.flush()
+
+    def run(self):
+        """
+        Writes the image. Returns True on success.
+        """
+        Total = os.path.getsize(self.image_path)
+        Process = subprocess.Popen(decompressor_args(detect_codec(self.image_path)),
+                                   stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        # mmap memory is page aligned, as O_DIRECT requires.
+        Free = queue.Queue()
+        for i in range(self.buffers + 1):
+            Free.put(mmap.mmap(-1, self.chunk_size))
+        Full = queue.Queue(self.buffers)
+        Feeder = threading.Thread(target = self._feed, args = (Process,))
+        Reader = threading.Thread(target = self._fill, args = (Process, Free, Full))
+        Feeder.start()
+        Reader.start()
+        Device, Direct = self._open_device()
+        Start = time.time()
+        LastReport = Start
+        try:
+            while True:
+                Item = Full.get()
+                if Item is None:
+                    break
+                Buffer, Length = Item
+                if Direct and Length % SECTOR_SIZE:
+                    # An unaligned tail can not be written with O_DIRECT.
+                    os.close(Device)
+                    Device, Direct = os.open(self.device_path, os.O_WRONLY), False
+                    os.lseek(Device, self.bytes_written, os.SEEK_SET)
+                write_all(Device, buffer_slice(Buffer, 0, Length))
+                self.bytes_written = self.bytes_written + Length
+                Free.put(Buffer)
+                if time.time() - LastReport >= 1.0:
+                    LastReport = time.time()
+                    self._report(Start, Total)
+            os.fsync(Device)
+        except Exception as e:
+            self.error = self.error or e
+            Process.kill()
+            # Make the reader give up, taking what it already queued so it is not blocked.
+            self._stopped.set()
+            while Reader.is_alive():
+                try:
+                    Full.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+        finally:
+            os.close(Device)
+            Reader.join()
+            Feeder.join()
+        if Process.wait() != 0 and not self.error:
+            self.error = "decompressing failed with code {}".format(Process.returncode)
+        self._report(Start, Total, final = True)
+        return(self.error is None)
+
+def chs_address(lba):
+    """
+    Returns the 3 byte CHS address of an LBA using the usual 255 head / 63 sector geometry.
+    Addresses past cylinder 1023 are given the 'use LBA' marker.
+    """
+    Cylinder = lba // (255 * 63)
+    if Cylinder > 1023:
+        return(b"\xfe\xff\xff")
+    Head = (lba // 63) % 255
+    Sector = (lba % 63) + 1
+    return(struct.pack("<BBB", Head, Sector | ((Cylinder >> 2) & 0xC0), Cylinder & 0xFF))
+
+def build_mbr(partitions, disk_signature = None):
+    """
+    Returns the 512 byte master boot record for up to four primary partitions given as
+    (start sector, sector count, type, bootable) tuples.
+    """
+    if len(partitions) > 4:
+        raise ValueError("an MBR holds at most 4 primary partitions")
+    if disk_signature is None:
+        disk_signature = random.randint(1, 0xFFFFFFFF)
+    Table = b""
+    for start, count, ptype, bootable in partitions:
+        if start < 1 or count < 1 or start + count > 0xFFFFFFFF:
+            raise ValueError("partition does not fit in an MBR")
+        if not 0 < ptype < 256:
+            raise ValueError("partition type must be between 0x01 and 0xFF")
+        Table = Table + struct.pack("<B", 0x80 if bootable else 0x00) + chs_address(start) + \
+                struct.pack("<B", ptype) + chs_address(start + count - 1) + struct.pack("<II", start, count)
+    Table = Table + b"\x00" * (64 - len(Table))
+    return(b"\x00" * 440 + struct.pack("<IH", disk_signature, 0) + Table + b"\x55\xaa")
+
+def fat32_geometry(total_sectors, reserved = FAT32_RESERVED_SECTORS, align = 1, hidden = 0):
+    """
+    Returns (sectors per cluster, reserved sectors, sectors per FAT, cluster count) for a
+    FAT32 file system of total_sectors 512 byte sectors. The largest cluster size (up to
+    4KiB) that still gives a valid FAT32 cluster count is used. The FAT size is worked out
+    the way mkfs.fat does, so mkfs.fat -a given the same reserved sectors lays out the
+    same file system. Reserved sectors are added until the data area starts on a multiple
+    of align sectors from the start of the device (the partition starts at sector hidden).
+    """
+    for spc in (8, 4, 2, 1):
+        Reserved = reserved
+        while True:
+            Clusters = ((total_sectors - Reserved) * SECTOR_SIZE + 2 * 8) // (spc * SECTOR_SIZE + 2 * 4)
+            FatSectors = ((Clusters + 2) * 4 + SECTOR_SIZE - 1) // SECTOR_SIZE
+            Misaligned = (hidden + Reserved + 2 * FatSectors) % align
+            if not Misaligned:
+                break
+            Reserved = Reserved + align - Misaligned
+        Clusters = min((total_sectors - Reserved - 2 * FatSectors) // spc, FatSectors * SECTOR_SIZE // 4 - 2)
+        if Clusters >= FAT32_MIN_CLUSTERS:
+            return(spc, Reserved, FatSectors, Clusters)
+    raise ValueError("partition is too small for FAT32")
+
+def fat_alignment(eraseBlock):
+    """
+    Returns the alignment in sectors of the FAT data area for an erase block size.
+    """
+    return(min(eraseBlock, FAT32_MAX_ALIGNMENT) // SECTOR_SIZE)
+
+def ext4_stripe_options(eraseBlock):
+    """
+    Returns the mkfs.ext4 stride and stripe width options for an erase block size.
+    """
+    return("stride={},stripe-width={}".format(EXT4_STRIDE, max(EXT4_STRIDE, eraseBlock // 4096)))
+
+def detect_erase_block(device):
+    """
+    Returns (size in bytes, source) of the erase block (allocation unit) of a device. The
+    AU size in the SD Status register is used first, then the preferred erase size the
+    MMC driver reports and then a discard granularity of at least 1MiB. Otherwise the
+    card is assumed to have DEFAULT_ERASE_BLOCK.
+    """
+    SysPath = os.path.join(SYS_BLOCK, os.path.basename(device.path))
+    Size, Source = 0, ""
+    Ssr = read_sysfs(os.path.join(SysPath, "device", "ssr"))
+    if len(Ssr) == 128:
+        # AU_SIZE is bits 431:428 of the 512 bit register
+        Size, Source = SD_AU_SIZES[int(Ssr[20], 16)], "SD status AU_SIZE"
+    if not Size:
+        Size, Source = int(read_sysfs(os.path.join(SysPath, "device", "preferred_erase_size"), "0")), "preferred_erase_size"
+    if not Size:
+        Size = int(read_sysfs(os.path.join(SysPath, "queue", "discard_granularity"), "0"))
+        Source = "discard_granularity"
+        if Size < SECTOR_ALIGNMENT * SECTOR_SIZE:
+            Size = 0
+    if not Size:
+        return(DEFAULT_ERASE_BLOCK, "default")
+    # Whole MiBs between 1MiB and MAX_ERASE_BLOCK
+    Size = min(max(Size, MIB), MAX_ERASE_BLOCK)
+    return((Size + MIB - 1) // MIB * MIB, Source)
+
+def dos_datetime(timestamp):
+    """
+    Returns the (date, time) words of a FAT directory entry for a unix timestamp.
+    """
+    t = time.localtime(max(timestamp, 315532800))
+    return((((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)))
+
+class Fat32ImageBuilder(object):
+    """
+    Builds a FAT32 file system image holding a flat set of files (the boot files) without
+    mounting anything. Every file is given a contiguous run of clusters and the image is
+    written from start to end in one sequential pass. Free space is left as a hole.
+    """
+
+    def __init__(self, label = FAT_LABEL):
+        self.label = label
+        self.files = []
+
+    def add_file(self, name, path):
+        # Python 2 lists byte string names; the long names are written as UTF-16.
+        if not isinstance(name, type(u"")):
+            try:
+                name = name.decode(sys.getfilesystemencoding() or "utf-8")
+            except UnicodeDecodeError:
+                name = name.decode("utf-8", "replace")
+        self.files.append((name, path))
+
+    def _short_names(self):
+        """
+        Returns, for each file, (11 byte 8.3 name, NT case flags, needs long name).
+        """
+        Used = set()
+        Result = []
+        for name, path in self.files:
+            Base, Ext = os.path.splitext(name)
+            Ext = Ext[1:]
+            Valid = lambda part: all(ord(c) < 128 and (c.isalnum() or c in "$%'-_@~`!(){}^#&") for c in part)
+            Fits = 0 < len(Base) <= 8 and len(Ext) <= 3 and Valid(Base) and Valid(Ext) and "." not in Base
+            Cased = lambda part: part == part.upper() or part == part.lower()
+            if Fits and Cased(Base) and Cased(Ext):
+                # A plain 8.3 name; lower case is kept with the NT case flags
+                Flags = (0x08 if Base != Base.upper() else 0) | (0x10 if Ext != Ext.upper() else 0)
+                Short = Base.upper().ljust(8) + Ext.upper().ljust(3)
+                Long = False
+            else:
+                # Characters outside ASCII become "_" in the short name, as Windows does.
+                Clean = lambda part: "".join("_" if ord(c) >= 128 else c for c in part.upper()
+                                             if ord(c) >= 128 or c.isalnum() or c in "$%'-_@~`!(){}^#&")
+                Index = 1
+                while True:
+                    Tail = "~" + str(Index)
+                    Short = (Clean(Base)[:8 - len(Tail)] + Tail).ljust(8) + Clean(Ext)[:3].ljust(3)
+                    if Short not in Used:
+                        break
+                    Index = Index + 1
+                Flags = 0
+                Long = True
+            Used.add(Short)
+            Result.append((Short.encode("ascii"), Flags, Long))
+        return(Result)
+
+    def _directory_entries(self, first_clusters):
+        Entries = [struct.pack("<11sBBBHHHHHHHI", self.label.upper().ljust(11)[:11].encode("ascii"),
+                               0x08, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)]
+        for (name, path), (short, flags, long_name), cluster in zip(self.files, self._short_names(), first_clusters):
+            st = os.stat(path)
+            Date, Time = dos_datetime(st.st_mtime)
+            if long_name:
+                Checksum = 0
+                for c in bytearray(short):
+                    Checksum = (((Checksum & 1) << 7) + (Checksum >> 1) + c) & 0xFF
+                Chars = name.encode("utf-16-le")
+                Chars = Chars + b"\x00\x00"
+                Pieces = (len(Chars) + 25) // 26
+                Chars = Chars.ljust(Pieces * 26, b"\xff")
+                for seq in range(Pieces, 0, -1):
+                    Part = Chars[(seq - 1) * 26:seq * 26]
+                    Entries.append(struct.pack("<B10sBBB12sH4s", seq | (0x40 if seq == Pieces else 0),
+                                               Part[0:10], 0x0F, 0, Checksum, Part[10:22], 0, Part[22:26]))
+            Entries.append(struct.pack("<11sBBBHHHHHHHI", short, 0x20, flags, 0, Time, Date, Date,
+                                       cluster >> 16, Time, Date, cluster & 0xFFFF if st.st_size else 0,
+                                       st.st_size))
+        return(b"".join(Entries))
+
+    def write(self, image_path, size_bytes, hidden_sectors = 0, align = 1):
+        """
+        Writes the image. The data area is aligned to align sectors. Raises ValueError if
+        the files do not fit.
+        """
+        TotalSectors = size_bytes // SECTOR_SIZE
+        SPC, Reserved, FatSectors, Clusters = fat32_geometry(TotalSectors, FAT32_RESERVED_SECTORS, align, hidden_sectors)
+        ClusterBytes = SPC * SECTOR_SIZE
+        ClustersFor = lambda size: (size + ClusterBytes - 1) // ClusterBytes
+
+        # The root directory is cluster 2, the files follow it in order.
+        Sizes = [os.path.getsize(path) for name, path in self.files]
+        RootBytes = len(self._directory_entries([0] * len(self.files))) + 32
+        RootClusters = ClustersFor(RootBytes)
+        FirstClusters = []
+        Next = 2 + RootClusters
+        for size in Sizes:
+            FirstClusters.append(Next if size else 0)
+            Next = Next + ClustersFor(size)
+        if Next - 2 > Clusters:
+            raise ValueError("boot files do not fit in the FAT partition")
+
+        Fat = bytearray(FatSectors * SECTOR_SIZE)
+        struct.pack_into("<II", Fat, 0, 0x0FFFFFF8, FAT32_EOC)
+        Chains = [(2, RootClusters)] + [(first, ClustersFor(size)) for first, size in zip(FirstClusters, Sizes) if size]
+        for first, count in Chains:
+            for cluster in range(first, first + count):
+                struct.pack_into("<I", Fat, cluster * 4, cluster + 1 if cluster < first + count - 1 else FAT32_EOC)
+        Free = Clusters - (Next - 2)
+
+        BootSector = struct.pack("<3s8sHBHBHHBHHHII", b"\xeb\x58\x90", b"mkfs.fat", SECTOR_SIZE, SPC, Reserved,
+                                 2, 0, 0, 0xF8, 0, 63, 255, hidden_sectors, TotalSectors)
+        BootSector = BootSector + struct.pack("<IHHIHH12sBBBI11s8s", FatSectors, 0, 0, 2, 1, 6, b"", 0x80, 0, 0x29,
+                                              random.randint(0, 0xFFFFFFFF),
+                                              self.label.upper().ljust(11)[:11].encode("ascii"), b"FAT32   ")
+        BootSector = BootSector.ljust(510, b"\x00") + b"\x55\xaa"
+        FsInfo = struct.pack("<I480sI", 0x41615252, b"", 0x61417272) + \
+                 struct.pack("<II12sI", Free, Next, b"", 0xAA550000)
+        ReservedArea = bytearray(Reserved * SECTOR_SIZE)
+        for sector, data in ((0, BootSector), (1, FsInfo), (6, BootSector), (7, FsInfo)):
+            ReservedArea[sector * SECTOR_SIZE:sector * SECTOR_SIZE + SECTOR_SIZE] = data
+        # The third sector of each boot record also carries the signature
+        ReservedArea[2 * SECTOR_SIZE + 510:2 * SECTOR_SIZE + 512] = b"\x55\xaa"
+        ReservedArea[8 * SECTOR_SIZE + 510:8 * SECTOR_SIZE + 512] = b"\x55\xaa"
+
+        with open(image_path, "wb") as f:
+            f.write(ReservedArea)
+            f.write(Fat)
+            f.write(Fat)
+            f.write(self._directory_entries(FirstClusters).ljust(RootClusters * ClusterBytes, b"\x00"))
+            for (name, path), size in zip(self.files, Sizes):
+                with open(path, "rb") as source:
+                    shutil.copyfileobj(source, f, FLASH_CHUNK_SIZE)
+                f.write(b"\x00" * (ClustersFor(size) * ClusterBytes - size))
+            f.truncate(size_bytes)
+
+def run_parallel(function, items, threads):
+    """
+    Calls function(item) for every item on a pool of threads. Returns the results in the
+    order of items. An exception raised by function is returned as the item's result.
+    """
+    Results = [None] * len(items)
+    Work = queue.Queue()
+    for index, item in enumerate(items):
+        Work.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = Work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                Results[index] = function(item)
+            except Exception as e:
+                Results[index] = e
+
+    Threads = [threading.Thread(target = worker) for i in range(max(1, min(threads, len(items))))]
+    for thread in Threads:
+        thread.start()
+    for thread in Threads:
+        thread.join()
+    return(Results)
+
+def hash_file(path, length = None, drop_cache = True):
+    """
+    Returns (size, sha256) of a file or block device, reading at most length bytes.
+    Unless drop_cache is False the file's cached pages are dropped first (so what is on
+    the media is read) where the OS supports it.
+    """
+    Hash = hashlib.sha256()
+    Size = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if drop_cache:
+            if stat.S_ISBLK(os.fstat(fd).st_mode):
+                fcntl.ioctl(fd, BLKFLSBUF)
+            elif hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        while length is None or Size < length:
+            Want = VERIFY_CHUNK_SIZE if length is None else min(VERIFY_CHUNK_SIZE, length - Size)
+            Data = os.read(fd, Want)
+            if not Data:
+                break
+            Hash.update(Data)
+            Size = Size + len(Data)
+    finally:
+        os.close(fd)
+    return(Size, Hash.hexdigest())
+
+def build_rootfs_manifest(archive_path):
+    """
+    Returns a manifest of a rootfs archive: normalized path -> [type, size, mtime, mode,
+    uid, gid, sha256 (files) or link target (links)]. Type is one of f, d, l (symlink),
+    h (hard link), c, b, p.
+    """
+    Manifest = {}
+    Decompressor = subprocess.Popen(decompress_command(archive_path), stdout = subprocess.PIPE)
+    Archive = tarfile.open(fileobj = Decompressor.stdout, mode = "r|")
+    for member in Archive:
+        Name = os.path.normpath(member.name.lstrip("/"))
+        Extra = ""
+        if member.isreg():
+            Type = "f"
+            Hash = hashlib.sha256()
+            Source = Archive.extractfile(member)
+            while True:
+                Data = Source.read(VERIFY_CHUNK_SIZE)
+                if not Data:
+                    break
+                Hash.update(Data)
+            Extra = Hash.hexdigest()
+        elif member.isdir():
+            Type = "d"
+        elif member.issym():
+            Type, Extra = "l", member.linkname
+        elif member.islnk():
+            Type, Extra = "h", os.path.normpath(member.linkname.lstrip("/"))
+        elif member.ischr():
+            Type = "c"
+        elif member.isblk():
+            Type = "b"
+        else:
+            Type = "p"
+        Manifest[Name] = [Type, member.size, member.mtime, member.mode, member.uid, member.gid, Extra]
+    Decompressor.stdout.close()
+    if Decompressor.wait() != 0:
+        raise IOError("decompressing '" + archive_path + "' failed")
+    return(Manifest)
+
+def rootfs_manifest_path(archive_path):
+    """
+    Returns the path of the manifest sidecar written by CopyRootFS for an archive.
+    """
+    for codec, (ext, level, magic) in ROOTFS_CODECS.items():
+        if archive_path.endswith(ext):
+            return(archive_path[:-len(ext)] + ROOTFS_MANIFEST_EXTENSION)
+    return(archive_path + ROOTFS_MANIFEST_EXTENSION)
+
+def build_manifest(spl_path = None, boot_dir = None, rootfs_archive = None, user_dir = None):
+    """
+    Returns a manifest (dict) of what provisioning writes to a card: the SPL, the files
+    copied to the FAT and USER partitions and the rootfs tree. Files map to [size, sha256]
+    and rootfs symlinks to ["->", target].
+    """
+    Manifest = {"version": 1}
+    if spl_path:
+        Manifest["spl"] = list(hash_file(spl_path))
+    if boot_dir:
+        # WriteBootFiles only copies the files at the top of the boot directory
+        Manifest["fat"] = {}
+        for name in sorted(os.listdir(boot_dir)):
+            if os.path.isfile(os.path.join(boot_dir, name)):
+                Manifest["fat"][name] = list(hash_file(os.path.join(boot_dir, name)))
+    if user_dir:
+        Manifest["user"] = {}
+        for root, dirnames, filenames in os.walk(user_dir):
+            for name in filenames:
+                Path = os.path.join(root, name)
+                if os.path.isfile(Path) and not os.path.islink(Path):
+                    Manifest["user"][os.path.relpath(Path, user_dir)] = list(hash_file(Path))
+    if rootfs_archive:
+        Manifest["rootfs"] = {}
+        for name, entry in build_rootfs_manifest(rootfs_archive).items():
+            if entry[0] == "f":
+                Manifest["rootfs"][name] = [entry[1], entry[6]]
+            elif entry[0] == "l":
+                Manifest["rootfs"][name] = ["->", entry[6]]
+    return(Manifest)
+
+def tree_size(path):
+    """
+    Returns the bytes (in whole 4KiB blocks) and the number of inodes of the files and
+    directories in a directory tree. Hard linked files are counted once.
+    """
+    Bytes, Count = 0, 0
+    Seen = set()
+    for root, dirnames, filenames in os.walk(path):
+        Count = Count + 1
+        Bytes = Bytes + 4096
+        for name in filenames:
+            Stat = os.lstat(os.path.join(root, name))
+            if Stat.st_nlink > 1:
+                if (Stat.st_dev, Stat.st_ino) in Seen:
+                    continue
+                Seen.add((Stat.st_dev, Stat.st_ino))
+            Count = Count + 1
+            if stat.S_ISREG(Stat.st_mode):
+                Bytes = Bytes + (Stat.st_size + 4095) // 4096 * 4096
+    return(Bytes, Count)
+
+def scan_rootfs_archive(archive_path):
+    """
+    Returns the bytes (in whole 4KiB blocks) and the number of inodes the members of a
+    rootfs archive take once extracted. Only the member headers are looked at; hard links
+    share the inode of their target.
+    """
+    Bytes, Count = 0, 0
+    Decompressor = subprocess.Popen(decompress_command(archive_path), stdout = subprocess.PIPE)
+    Archive = tarfile.open(fileobj = Decompressor.stdout, mode = "r|")
+    for member in Archive:
+        if member.islnk():
+            continue
+        Count = Count + 1
+        if member.isreg():
+            Bytes = Bytes + (member.size + 4095) // 4096 * 4096
+        elif member.isdir():
+            Bytes = Bytes + 4096
+    Decompressor.stdout.close()
+    if Decompressor.wait() != 0:
+        raise IOError("decompressing '" + archive_path + "' failed")
+    return(Bytes, Count)
+
+def rootfs_content(archive_path):
+    """
+    Returns the bytes (in whole 4KiB blocks) and the number of inodes the rootfs archive
+    takes once extracted. The manifest written by CopyRootFS is used if there is one.
+    """
+    ManifestPath = rootfs_manifest_path(archive_path)
+    if not os.path.isfile(ManifestPath):
+        print("Measuring '" + archive_path + "'")
+        return(scan_rootfs_archive(archive_path))
+    with open(ManifestPath) as f:
+        Manifest = json.load(f)
+    Bytes, Count = 0, 0
+    for entry in Manifest.values():
+        if entry[0] == "h":
+            continue
+        Count = Count + 1
+        if entry[0] == "f":
+            Bytes = Bytes + (entry[1] + 4095) // 4096 * 4096
+        elif entry[0] == "d":
+            Bytes = Bytes + 4096
+    return(Bytes, Count)
+
+def ext4_fit_size(dataBytes, inodes):
+    """
+    Returns the size of an ext4 file system (mke2fs defaults) that holds dataBytes of
+    file and directory blocks in the given number of inodes.
+    """
+    Usable = 1.0 - EXT4_RESERVED - float(EXT4_INODE_SIZE) / EXT4_INODE_RATIO
+    return(int(max(dataBytes / Usable, inodes * EXT4_INODE_RATIO)) + EXT4_FIT_SLACK)
+
+def AutoLayout(args):
+    """
+    Returns the --layout auto layout: the FAT and ROOTFS partitions sized to what is
+    installed on them plus args.headroom percent, and USER taking the rest of the card.
+    A partition without a source on the command line keeps its DEFAULT_LAYOUT size.
+    """
+    Data = copy.deepcopy(DEFAULT_LAYOUT)
+    Sources = {"fat": args.boot_loc, "rootfs": args.rootfs_loc}
+    for partition in Data["partitions"]:
+        if partition["name"] not in Sources:
+            continue
+        if Sources[partition["name"]]:
+            partition["size"] = "fit+{}%".format(args.headroom)
+        else:
+            print(Fore.YELLOW + "No source for the " + partition["name"].upper() + " partition, it is given " +
+                  partition["size"] + "." + Fore.RESET)
+    return(PartitionLayout(Data, "auto"))
+
+class PartitionLayout(object):
+    """
+    Sizes, types and file systems of the card partitions (see DEFAULT_LAYOUT). The layout
+    is checked when it is loaded; resolve() works out the sectors for a card.
+    """
+
+    def __init__(self, data, source = "built-in"):
+        self.Source = source
+        self.Content = {}
+        if not isinstance(data, dict) or not isinstance(data.get("partitions"), list):
+            raise ValueError("a 'partitions' list is required")
+        for key in data:
+            if key not in ("partitions", "mkfs_profiles"):
+                raise ValueError("unknown key '" + key + "'")
+        Custom = data.get("mkfs_profiles", {})
+        if not isinstance(Custom, dict) or \
+           not all(isinstance(k, string_types) and isinstance(v, string_types) for k, v in Custom.items()):
+            raise ValueError("'mkfs_profiles' must map profile names to mkfs option strings")
+        Profiles = dict(MKFS_PROFILES)
+        Profiles.update(Custom)
+        self.Partitions = []
+        for entry in data["partitions"]:
+            if not isinstance(entry, dict):
+                raise ValueError("each partition must be a table of name, size, ...")
+            Name = entry.get("name")
+            if not isinstance(Name, string_types) or Name not in PARTITION_NAMES:
+                raise ValueError("partition name must be one of " + ", ".join(sorted(PARTITION_NAMES)))
+            if Name in [p["name"] for p in self.Partitions]:
+                raise ValueError("partition '" + Name + "' is listed twice")
+            for key in entry:
+                if key not in ("name", "size", "type", "fs", "bootable", "mkfs"):
+                    raise ValueError(Name + ": unknown key '" + key + "'")
+            Fs = entry.get("fs", PARTITION_FILESYSTEMS[Name])
+            if Fs != PARTITION_FILESYSTEMS[Name]:
+                raise ValueError(Name + ": only a " + PARTITION_FILESYSTEMS[Name] + " file system is supported")
+            try:
+                Type = int(str(entry.get("type", "0x0B" if Fs == "vfat" else "0xA2" if Fs == "raw" else "0x83")), 0)
+            except ValueError:
+                Type = -1
+            if not 0 < Type < 256:
+                raise ValueError(Name + ": type must be an MBR partition id (e.g., 0x83)")
+            Size = entry.get("size", "")
+            if isinstance(Size, bool) or not isinstance(Size, string_types + (int, float)):
+                raise ValueError(Name + ": size must be a string or a number of bytes")
+            if not isinstance(entry.get("bootable", False), bool):
+                raise ValueError(Name + ": bootable must be true or false")
+            if entry.get("mkfs") is not None and \
+               (not isinstance(entry["mkfs"], string_types) or entry["mkfs"] not in Profiles):
+                raise ValueError(Name + ": unknown mkfs profile '" + str(entry["mkfs"]) + "'")
+            self.Partitions.append({"name": Name, "number": PARTITION_NAMES[Name],
+                                    "size": self.parse_size(Name, str(Size)),
+                                    "type": Type, "bootable": bool(entry.get("bootable", False)),
+                                    "mkfs": Profiles[entry["mkfs"]] if entry.get("mkfs") is not None else None})
+        Missing = set(PARTITION_NAMES) - set(p["name"] for p in self.Partitions)
+        if Missing:
+            raise ValueError("partitions " + ", ".join(sorted(Missing)) + " are missing")
+        if len([p for p in self.Partitions if p["size"][0] == "rest"]) > 1:
+            raise ValueError("only one partition can take the rest of the card")
+
+    def parse_size(self, name, text):
+        """
+        Returns ("bytes", n), ("percent", n), ("fit", margin bytes, margin percent) or ("rest",).
+        """
+        text = text.strip()
+        if text == "rest":
+            return(("rest",))
+        if text.startswith("fit"):
+            Margin = text[3:].strip()
+            if not Margin:
+                return(("fit", 0, 0.0))
+            if Margin.startswith("+"):
+                Margin = Margin[1:].strip()
+                if Margin.endswith("%"):
+                    try:
+                        Percent = float(Margin[:-1])
+                    except ValueError:
+                        Percent = -1
+                    if Percent >= 0:
+                        return(("fit", 0, Percent))
+                elif parse_size(Margin) is not None and parse_size(Margin) >= 0:
+                    return(("fit", parse_size(Margin), 0.0))
+        elif text.endswith("%"):
+            try:
+                Percent = float(text[:-1])
+            except ValueError:
+                Percent = 0
+            if 0 < Percent < 100:
+                return(("percent", Percent))
+        elif parse_size(text) is not None and parse_size(text) > 0:
+            return(("bytes", parse_size(text)))
+        raise ValueError(name + ": size '" + text + "' is not valid")
+
+    def mkfs_options(self, name):
+        """
+        Returns the mkfs options of the profile of partition name, or None to use the
+        built-in tuning.
+        """
+        return([p for p in self.Partitions if p["name"] == name][0]["mkfs"])
+
+    def entry(self, number):
+        return([p for p in self.Partitions if p["number"] == number][0])
+
+    def measure(self, args):
+        """
+        Measures what will be installed on each partition sized to "fit".
+        """
+        for partition in self.Partitions:
+            if partition["size"][0] != "fit":
+                continue
+            Name = partition["name"]
+            Source = {"fat": args.boot_loc, "raw": args.spl_loc, "rootfs": args.rootfs_loc,
+                      "user": args.user_loc}[Name]
+            if not Source:
+                raise ValueError(Name + ": a \"fit\" size needs the partition's source on the command line")
+            Inodes = 0
+            if Name == "raw":
+                Bytes = os.path.getsize(Source)
+            elif Name in ("rootfs", "user"):
+                if Name == "rootfs":
+                    Data, Inodes = rootfs_content(RootfsArchivePath(Source))
+                else:
+                    Data, Inodes = tree_size(Source)
+                Bytes = ext4_fit_size(Data, Inodes)
+            else:
+                # WriteBootFiles only copies the files at the top of the boot directory
+                Names = [name for name in os.listdir(Source) if os.path.isfile(os.path.join(Source, name))]
+                Inodes = len(Names)
+                Bytes = sum((os.path.getsize(os.path.join(Source, name)) + 4095) // 4096 * 4096 for name in Names)
+            self.Content[Name] = Bytes
+            print("  {:<7} content needs {:.1f}MiB ({} inodes)".format(Name.upper(), Bytes / float(MIB), Inodes))
+
+    def resolve(self, totalSectors, eraseBlock = DEFAULT_ERASE_BLOCK):
+        """
+        Returns the [(first sector, sectors)] of the partitions (indexed by partition
+        number - 1) on a card of totalSectors. Raises ValueError if they do not fit.
+        """
+        Align = max(SECTOR_ALIGNMENT, eraseBlock // SECTOR_SIZE)
+        AlignUp = lambda sectors: (sectors + Align - 1) // Align * Align
+        Sectors = {}
+        for partition in self.Partitions:
+            Name, Size = partition["name"], partition["size"]
+            if Size[0] == "bytes":
+                Bytes = Size[1]
+            elif Size[0] == "percent":
+                Bytes = int(totalSectors * Size[1] / 100.0) * SECTOR_SIZE
+            elif Size[0] == "fit":
+                if Name not in self.Content:
+                    raise ValueError(Name + ": the content of a \"fit\" partition has not been measured")
+                Bytes = int(self.Content[Name] * (1 + Size[2] / 100.0)) + Size[1]
+                if Name == "fat":
+                    Bytes = max(Bytes, FAT32_MIN_SIZE)
+            else:
+                continue
+            Sectors[Name] = AlignUp((Bytes + SECTOR_SIZE - 1) // SECTOR_SIZE)
+        Free = (totalSectors - Align - sum(Sectors.values())) // Align * Align
+        for partition in self.Partitions:
+            if partition["size"][0] == "rest":
+                if Free <= 0:
+                    raise ValueError(partition["name"] + ": no space is left on the card")
+                Sectors[partition["name"]] = Free
+        Layout = [None] * len(self.Partitions)
+        Start = Align
+        for partition in self.Partitions:
+            Name = partition["name"]
+            Layout[partition["number"] - 1] = (Start, Sectors[Name])
+            Start = Start + Sectors[Name]
+            if Name == "fat":
+                try:
+                    fat32_geometry(Sectors[Name], FAT32_RESERVED_SECTORS, fat_alignment(eraseBlock))
+                except ValueError:
+                    raise ValueError("fat: {}MiB is too small for FAT32".format(Sectors[Name] * SECTOR_SIZE // MIB))
+            if Name in self.Content and Sectors[Name] * SECTOR_SIZE < self.Content[Name]:
+                raise ValueError(Name + ": the content does not fit")
+        if Start > totalSectors or Start >= 1 << 32:
+            raise ValueError("the partitions need {:.2f}GiB, the card has {:.2f}GiB".format(
+                             Start * SECTOR_SIZE / float(GIB), totalSectors * SECTOR_SIZE / float(GIB)))
+        return(Layout)
+
+def LoadLayout(path):
+    """
+    Returns the PartitionLayout of a JSON or TOML (.toml) layout file.
+    """
+    try:
+        if path.endswith(".toml"):
+            try:
+                import tomllib
+                with open(path, "rb") as f:
+                    Data = tomllib.load(f)
+            except ImportError:
+                import toml
+                Data = toml.load(path)
+        else:
+            with open(path) as f:
+                Data = json.load(f)
+        return(PartitionLayout(Data, path))
+    except ImportError:
+        print(Fore.RED + "ERROR: TOML layout files need Python 3.11 or the toml module." + Fore.RESET)
+    except (IOError, OSError, ValueError) as e:
+        print(Fore.RED + "ERROR: layout '" + path + "' is not valid: " + str(e) + Fore.RESET)
+    exit(-1)
+
+class PartitionImageCache(object):
+    """
+    Directory of ready to write partition images. Each image is stored as <key>.img with
+    a <key>.json description, where the key is a hash of everything the image is built
+    from. The modification time of an image is its last use. Images handed out by
+    lookup() and store() are pinned (never pruned) until they are released.
+    """
+
+    def __init__(self, cache_dir, budget):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.lock = threading.Lock()
+        # key -> number of holders of the image
+        self.pinned = {}
+
+    def key(self, kind, input_paths, options):
+        """
+        Returns the key of an image of the given kind built from the contents of
+        input_paths with the given format options (any JSON serialisable value).
+        """
+        Hash = hashlib.sha256()
+        Hash.update(json.dumps([IMAGE_CACHE_VERSION, kind, options], sort_keys = True).encode("utf-8"))
+        for path in input_paths:
+            Hash.update(("\0" + os.path.basename(path) + "\0" + hash_file(path, drop_cache = False)[1]).encode("utf-8"))
+        return(kind + "-" + Hash.hexdigest())
+
+    def _image(self, key):
+        return(os.path.join(self.cache_dir, key + ".img"))
+
+    def lookup(self, key):
+        """
+        Returns the path of the cached image for key (marking it used and pinning it) or
+        None.
+        """
+        Path = self._image(key)
+        with self.lock:
+            if not os.path.isfile(Path):
+                return(None)
+            os.utime(Path, None)
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+        return(Path)
+
+    def release(self, path):
+        """
+        Unpins an image returned by lookup() or store().
+        """
+        Key = os.path.basename(path)[:-len(".img")]
+        with self.lock:
+            if self.pinned.get(Key, 0) > 1:
+                self.pinned[Key] = self.pinned[Key] - 1
+            else:
+                self.pinned.pop(Key, None)
+
+    def new_image_path(self, key):
+        """
+        Returns a temporary path in the cache directory to build the image for key in.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd, Path = tempfile.mkstemp(prefix = key + ".", suffix = ".tmp", dir = self.cache_dir)
+        os.close(fd)
+        return(Path)
+
+    def store(self, key, built_path, description):
+        """
+        Moves an image built at new_image_path(key) into the cache and evicts the least
+        recently used images above the budget. Returns the cached image path, pinned.
+        """
+        Path = self._image(key)
+        with self.lock:
+            with open(os.path.join(self.cache_dir, key + ".json"), "w") as f:
+                json.dump(description, f)
+            os.rename(built_path, Path)
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+        self.prune()
+        return(Path)
+
+    def contains(self, path):
+        return(os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.cache_dir))
+
+    def entries(self):
+        """
+        Returns [(key, allocated bytes, last use, description)], least recently used first.
+        """
+        Entries = []
+        if not os.path.isdir(self.cache_dir):
+            return(Entries)
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".img"):
+                continue
+            Key = name[:-len(".img")]
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, Key + ".json")) as f:
+                    Description = json.load(f)
+            except (IOError, OSError, ValueError):
+                Description = {}
+            Entries.append((Key, st.st_blocks * 512, st.st_mtime, Description))
+        Entries.sort(key = lambda entry: entry[2])
+        return(Entries)
+
+    def prune(self, budget = None):
+        """
+        Removes least recently used images, other than pinned ones, until the cache fits
+        the budget, plus temporary files left behind by interrupted builds. Returns the
+        bytes freed.
+        """
+        Budget = self.budget if budget is None else budget
+        Freed = 0
+        with self.lock:
+            if os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    Path = os.path.join(self.cache_dir, name)
+                    if name.endswith(".tmp") and time.time() - os.path.getmtime(Path) > 24 * 3600:
+                        os.unlink(Path)
+            Entries = self.entries()
+            Total = sum(entry[1] for entry in Entries)
+            for key, size, used, description in Entries:
+                if Total <= Budget:
+                    break
+                if self.pinned.get(key):
+                    continue
+                for ext in (".img", ".json"):
+                    if os.path.exists(os.path.join(self.cache_dir, key + ext)):
+                        os.unlink(os.path.join(self.cache_dir, key + ext))
+                Total = Total - size
+                Freed = Freed + size
+        return(Freed)
+
+    def print_stats(self):
+        Entries = self.entries()
+        Total = sum(entry[1] for entry in Entries)
+        print("Partition image cache " + self.cache_dir)
+        print("  {} images, {:.1f}MiB of {:.1f}MiB".format(len(Entries), Total / float(MIB), self.budget / float(MIB)))
+        for key, size, used, description in reversed(Entries):
+            print("  {:<24} {:>9.1f}MiB  {}  {}".format(key[:24], size / float(MIB),
+                  time.strftime("%Y-%m-%d %H:%M", time.localtime(used)), description.get("source", "")))
+
+class RunReport(object):
+    """
+    Collects the wall time, bytes moved and result of every stage and command of a run
+    for the timing table printed at the end and the --report file. The stage running on
+    a thread is tracked per thread so commands, phases and bytes are charged to it.
+    Internal phases (copy, extract, verify, ...) and the thread of every record are kept
+    for the --trace timeline.
+    """
+
+    def __init__(self):
+        self.Start = time.time()
+        self.Stages = []
+        self.Commands = []
+        self.Phases = []
+        self.Lock = threading.Lock()
+        self.Local = threading.local()
+
+    def current(self):
+        return(getattr(self.Local, "stage", None))
+
+    def stage(self, name, device, function):
+        """
+        Runs function() as stage name of device and returns its result.
+        """
+        Record = {"name": name, "device": device, "start": round(time.time() - self.Start, 3),
+                  "seconds": 0.0, "bytes": 0, "result": "ok", "thread": threading.current_thread().name}
+        Parent = self.current()
+        self.Local.stage = Record
+        Start = time.time()
+        try:
+            return(function())
+        except BaseException:
+            Record["result"] = "failed"
+            raise
+        finally:
+            Record["seconds"] = round(time.time() - Start, 3)
+            self.Local.stage = Parent
+            with self.Lock:
+                self.Stages.append(Record)
+
+    def command(self, result):
+        """
+        Records a finished command from its cmd_runner CommandResult.
+        """
+        Stage = self.current()
+        with self.Lock:
+            self.Commands.append({"command": result.cmd, "stage": Stage["name"] if Stage else "",
+                                  "device": Stage["device"] if Stage else "",
+                                  "start": round(time.time() - result.seconds - self.Start, 3),
+                                  "seconds": round(result.seconds, 3), "result": result.returncode,
+                                  "cpu_seconds": round(result.user_seconds + result.system_seconds, 3),
+                                  "max_rss_kib": result.max_rss_kib, "thread": threading.current_thread().name})
+
+    def phase(self, name, start, count = 0):
+        """
+        Records an internal phase of the running stage that began at time start (and
+        ended now), with the number of bytes it moved.
+        """
+        Stage = self.current()
+        with self.Lock:
+            self.Phases.append({"name": name, "stage": Stage["name"] if Stage else "",
+                                "device": Stage["device"] if Stage else "",
+                                "start": round(start - self.Start, 3), "seconds": round(time.time() - start, 3),
+                                "bytes": count, "thread": threading.current_thread().name})
+        self.add_bytes(count)
+
+    def add_bytes(self, count):
+        """
+        Adds count bytes read or written to the stage running on this thread.
+        """
+        Stage = self.current()
+        if Stage is not None:
+            Stage["bytes"] = Stage["bytes"] + count
+
+    def write(self, path):
+        for record in self.Stages:
+            record["mib_per_s"] = round(record["bytes"] / max(record["seconds"], 0.001) / MIB, 2)
+        with open(path, "w") as f:
+            json.dump({"version": 1, "started": self.Start, "seconds": round(time.time() - self.Start, 3),
+                       "stages": sorted(self.Stages, key = lambda record: record["start"]),
+                       "commands": self.Commands}, f, indent = 1)
+
+    def write_trace(self, path):
+        """
+        Writes the run as a Chrome Trace Event Format file (chrome://tracing, Perfetto).
+        Every device is a process and every thread that worked on it is a track.
+        """
+        Events = []
+        Pids = {}
+        Tids = {}
+        for category, records in (("stage", self.Stages), ("command", self.Commands), ("phase", self.Phases)):
+            for record in records:
+                Device = record["device"]
+                if Device not in Pids:
+                    Pids[Device] = len(Pids) + 1
+                    Events.append({"name": "process_name", "ph": "M", "pid": Pids[Device], "tid": 0,
+                                   "args": {"name": Device or "host"}})
+                Track = (Device, record["thread"])
+                if Track not in Tids:
+                    Tids[Track] = len(Tids) + 1
+                    Events.append({"name": "thread_name", "ph": "M", "pid": Pids[Device], "tid": Tids[Track],
+                                   "args": {"name": record["thread"]}})
+                Event = {"name": record.get("name") or record["command"].split()[0], "cat": category, "ph": "X",
+                         "ts": int(record["start"] * 1000000), "dur": max(int(record["seconds"] * 1000000), 1),
+                         "pid": Pids[Device], "tid": Tids[Track], "args": {}}
+                for key in ("command", "stage", "bytes", "result", "cpu_seconds", "max_rss_kib"):
+                    if record.get(key) not in (None, ""):
+                        Event["args"][key] = record[key]
+                Events.append(Event)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": Events, "displayTimeUnit": "ms"}, f)
+
+    def print_table(self):
+        print("")
+        print(Fore.YELLOW + "#### TIMING REPORT ####" + Fore.RESET)
+        print("  {:<24} {:<14} {:>8} {:>9} {:>8}".format("Stage", "Device", "Seconds", "MiB", "MiB/s"))
+        for record in sorted(self.Stages, key = lambda record: record["start"]):
+            Rate = "{:8.1f}".format(record["bytes"] / max(record["seconds"], 0.001) / MIB) if record["bytes"] else "       -"
+            Text = "  {:<24} {:<14} {:8.1f} {:9.1f} {}".format(record["name"], record["device"] or "*",
+                                                              record["seconds"], record["bytes"] / float(MIB), Rate)
+            print(Text if record["result"] == "ok" else Fore.RED + Text + "  FAILED" + Fore.RESET)
+        # Where the command time went, by program
+        Totals = {}
+        for record in self.Commands:
+            Name = record["command"].split()[0] if record["command"].split() else ""
+            Count, Seconds, Cpu = Totals.get(Name, (0, 0.0, 0.0))
+            Totals[Name] = (Count + 1, Seconds + record["seconds"], Cpu + record.get("cpu_seconds", 0.0))
+        if Totals:
+            print("  {:<24} {:>6} {:>8} {:>8}".format("Command", "Runs", "Seconds", "CPU"))
+            for name, (count, seconds, cpu) in sorted(Totals.items(), key = lambda item: -item[1][1])[:8]:
+                print("  {:<24} {:>6} {:8.1f} {:8.1f}".format(name, count, seconds, cpu))
+        print("  Total {:.1f}s".format(time.time() - self.Start))
+
 class SystemDevicesInterface(object):
 
     LastCommandResult = 0
+    LastCommandOutput = []
+    # Name of the operation currently running (used by the multi-device summary).
+    CurrentStage = ""
 
     def __init__(self, logFile, echo_cmds = False):
         self.EchoCmds = echo_cmds
-        # Uses reparted get a list of all the drives in the system.
-        self.devices = reparted.device.probe_standard_devices()
-        if self.devices:
-            print(self.devices)
-        self._shell_helper = ShellHelper(logFile)
+        # The drives in the system, read from sysfs. libparted is only opened on the
+        # device that gets partitioned.
+        self.devices = probe_block_devices()
+        self._runner = CommandRunner(logFile)
         # This is the largest SDCARD size we expect to see and is used to validate the target
         # device (as a safety measure).
         self.max_size_to_be_an_sdcard = reparted.Size(64, "GiB")
+        # Set when each device must use its own mount points (multi-device mode).
+        self.PrivateMounts = False
+        # Shared by the clones of this interface.
+        self.Report = RunReport()
+        self.Mounts = MountTable()
+        # Node path -> True/False (reads back as zeroes) for nodes erased by erase_node.
+        self.Erased = {}
+        # Erase block size given on the command line, and the ones detected (by device path).
+        self.EraseBlock = None
+        self.EraseBlocks = {}
+        # Card layout (--layout or the built-in one).
+        self.Layout = PartitionLayout(DEFAULT_LAYOUT)
+
+    def clone_for_stage(self):
+        """
+        Returns a copy of this interface for a stage that runs alongside other stages. The
+        copy shares the log file but has its own command result state.
+        """
+        Clone = copy.copy(self)
+        Clone.LastCommandResult = 0
+        Clone.LastCommandOutput = []
+        Clone.CurrentStage = ""
+        return(Clone)
+
+    def clone_for_worker(self, logFile):
+        """
+        Returns a copy of this interface for use by a per-device worker thread. The copy
+        has its own log file and command result state and uses private mount points.
+        """
+        Clone = copy.copy(self)
+        Clone._runner = CommandRunner(logFile)
+        Clone.LastCommandResult = 0
+        Clone.LastCommandOutput = []
+        Clone.CurrentStage = ""
+        Clone.PrivateMounts = True
+        return(Clone)
 
     def find_device(self, deviceName):
         for device in self.devices:
@@ -121,55 +2095,129 @@ class SystemDevicesInterface(object):
         # Found target in drive list and its size is ok
         return(True)
 
+    def node_path(self, targetDevice, node_index):
+        """
+        Returns the device node of partition node_index (1,2,...) on the target device.
+        Devices whose name ends in a digit (loop0, mmcblk0) use a 'p' separator.
+        """
+        if targetDevice.path[-1].isdigit():
+            return(targetDevice.path + "p" + str(node_index))
+        return(targetDevice.path + str(node_index))
+
+    def mount_point(self, targetDevice, node_index):
+        """
+        Returns the directory partition node_index of the target device is mounted on.
+        The directory is created if it does not exist.
+        """
+        if self.PrivateMounts:
+            Name = os.path.basename(targetDevice.path)
+            MountPoint = os.path.join(PRIVATE_MOUNT_ROOT, "sdcard_" + Name + "_p" + str(node_index))
+        else:
+            MountPoint = {FAT_PARTITION: FAT_MOUNT_POINT,
+                          ROOTFS_PARTITION: ROOTFS_MOUNT_POINT,
+                          USER_PARTITION: USER_MOUNT_POINT}[node_index]
+        if not os.path.isdir(MountPoint):
+            os.makedirs(MountPoint)
+        return(MountPoint)
+
+    def attach_image(self, image_path, size_bytes):
+        """
+        Creates a new (sparse) image file of the given size and attaches it to a loop device.
+        Returns an ImageFileDevice or None on failure.
+        """
+        image_path = os.path.abspath(image_path)
+        try:
+            with open(image_path, "wb") as f:
+                f.truncate(size_bytes)
+        except IOError as e:
+            print(Fore.RED + "ERROR: Unable to create image file '" + image_path + "': " + str(e) + Fore.RESET)
+            return(None)
+        cmd = "losetup --find --show --partscan '" + image_path + "'"
+        if not self.run_cmd(cmd):
+            return(None)
+        LoopPath = self.LastCommandOutput[0].strip()
+        print(Fore.GREEN + "Image '" + image_path + "' attached to " + LoopPath + Fore.RESET)
+        return(ImageFileDevice(image_path, LoopPath, size_bytes))
+
+    def detach_image(self, targetDevice):
+        """
+        Detaches the loop device backing an image target.
+        """
+        sync()
+        cmd = "losetup --detach " + targetDevice.path
+        if not self.run_cmd(cmd):
+            return(False)
+        return(True)
+
     def list_devices(self):
         for device in self.devices:
             Text = device.path + " [{0}]".format(device.size.pretty(units = "GiB"))
+            if device.description():
+                Text = Text + "  " + device.description()
             if device.size <= self.max_size_to_be_an_sdcard:
                 print(Fore.GREEN + Text + Fore.RESET)
             else:
                 print(Style.DIM + Text + "  Not an SDCard" + Style.RESET_ALL)
 
-    def run_cmd(self, cmd, workingDir = "", inputStr = None, suppress_errors={}):
+    def run_cmd(self, cmd, workingDir = "", inputStr = None, suppress_errors={}, timeout = None):
         """
         Runs the speicifed command and reports any errors.
         Returns True if command had no errors otherwise False.
         LastCommandResult holds the command result code.
+        The command is ended if it runs longer than timeout seconds.
         """
-        r = self._shell_helper.RunCmdCaptureOutput(cmd, workingDir, inputStr, echo_cmd = self.EchoCmds)
-        if self.EchoCmds:
-            if r[1]:
-                for line in r[1]:
-                    print("  " + line)
-        self.LastCommandResult = r[0]
+        r = self._runner.run(cmd, workingDir, inputStr, echo = self.EchoCmds, timeout = timeout)
+        self.Report.command(r)
+        self.LastCommandResult = r.returncode
+        self.LastCommandOutput = list(r.stdout)
         # Check for errors (non-zero return code)
         if self.LastCommandResult != 0 and (not self.LastCommandResult in suppress_errors):
-            if r[2]:
-                for line in r[2]:
-                    print(Fore.RED + "  " + line + Fore.RESET)
+            for line in r.stderr:
+                print(Fore.RED + "  " + line + Fore.RESET)
             cmdName = cmd.split()[0]
-            print(Fore.RED + "ERROR: "+cmdName+" failed with code {}.".format(r[0]) + Fore.RESET)
+            if r.timed_out:
+                print(Fore.RED + "ERROR: "+cmdName+" timed out after {:.0f}s.".format(timeout) + Fore.RESET)
+            else:
+                print(Fore.RED + "ERROR: "+cmdName+" failed with code {}.".format(r.returncode) + Fore.RESET)
             return(False)
         return(True)
 
+
+    def device_numbers(self, targetDevice):
+        """
+        Returns the "major:minor" of the target device and of each of its partitions.
+        """
+        Name = os.path.basename(targetDevice.path)
+        Devs = set([device_number(targetDevice.path)])
+        for path in glob.glob(os.path.join("/sys/class/block", Name, Name + "*", "dev")):
+            Devs.add(read_sysfs(path))
+        Devs.discard(None)
+        return(Devs)
+
     def unmount_device(self, targetDevice):
         """
-        Unmounts any mounted partitions on the target device
+        Unmounts any mounted partitions on the target device (and anything mounted below
+        them). Mounts at the same depth are unmounted in parallel, deepest first.
         """
-        # The file '/proc/mounts' contains a list of mounts.  Parse this file and grab any that
-        # are part of the target drive.
-        Mounts = []
-        for line in file('/proc/mounts'):
-            if line[0] == '/':
-                MountPath = line.split()[0]
-                if MountPath.startswith(targetDevice.path):
-                    Mounts.append(MountPath)
-
-        for mount in Mounts:
-            print("Unmounting '" + mount + "'")
-            cmd = 'umount ' + mount
-            if not self.run_cmd(cmd):
-                return(False)
-        return(True)
+        MountPaths = self.Mounts.under(self.device_numbers(targetDevice))
+        Failed = []
+
+        def unmount(path):
+            print("Unmounting '" + path + "'")
+            if not self.run_cmd("umount '" + path + "'"):
+                Failed.append(path)
+
+        while MountPaths and not Failed:
+            Depth = MountPaths[0].rstrip("/").count("/")
+            Level = [path for path in MountPaths if path.rstrip("/").count("/") == Depth]
+            MountPaths = MountPaths[len(Level):]
+            Workers = [threading.Thread(target = unmount, args = (path,)) for path in Level[1:]]
+            for worker in Workers:
+                worker.start()
+            unmount(Level[0])
+            for worker in Workers:
+                worker.join()
+        return(not Failed)
 
     def is_mounted(self, targetDevice, node_index):
         """
@@ -178,13 +2226,10 @@ class SystemDevicesInterface(object):
 
         node_index is a number (1,2,...)
         """
-        # The file '/proc/mounts' contains a list of mounts.  Parse this file and look for the
-        # target node.
-        NodePath = targetDevice.path + str(node_index)
-        for line in file('/proc/mounts'):
-            LineParts = line.split()
-            if LineParts[0] == NodePath:
-                return(LineParts[1])
+        Dev = device_number(self.node_path(targetDevice, node_index))
+        if Dev:
+            for path in self.Mounts.mount_points(Dev):
+                return(path)
         return(None)
 
     def zero_first_1mb(self, targetDevice):
@@ -194,7 +2239,7 @@ class SystemDevicesInterface(object):
         if not self.validate_device(targetDevice):
             print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
             return(False)
-        cmd = "dd if=/dev/zero of=" + targetDevice.path + " bs=1024 count=1025"
+        cmd = "dd if=/dev/zero of=" + targetDevice.path + " bs=1025K count=1 conv=fsync"
         if not self.run_cmd(cmd):
             return(False)
         return(True)
@@ -206,9 +2251,10 @@ class SystemDevicesInterface(object):
         if not self.validate_device(targetDevice):
             print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
             return(False)
-        cmd = "dd if='"+file_path+"' of=" + nodePath + " bs=512"
+        cmd = "dd if='"+file_path+"' of=" + nodePath + " bs=1M conv=fsync"
         if not self.run_cmd(cmd):
             return(False)
+        self.Report.add_bytes(os.path.getsize(file_path))
         print(Fore.GREEN + "SPL written" + Fore.RESET)
         return(True)
 
@@ -220,14 +2266,89 @@ class SystemDevicesInterface(object):
         if not self.validate_device(targetDevice):
             print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
             return(False)
-        SFDiskArgs = ""
-        for part in partitions:
-            for item in part:
-                SFDiskArgs = SFDiskArgs + item + ','
-            SFDiskArgs = SFDiskArgs + "\n"
-        Cmd = "sfdisk " + targetDevice.path
-        if not self.run_cmd(Cmd, inputStr = SFDiskArgs):
+        Table = [(int(start), int(count), int(ptype, 0), bootable == "*") for start, count, ptype, bootable in partitions]
+        try:
+            self.write_mbr(targetDevice.path, build_mbr(Table))
+        except (IOError, OSError, ValueError, struct.error) as e:
+            print(Fore.RED + "ERROR: writing partition table to " + targetDevice.path + " failed: " + str(e) + Fore.RESET)
             return(False)
+        if stat.S_ISBLK(os.stat(targetDevice.path).st_mode):
+            return(self.reread_partitions(targetDevice, Table))
+        return(True)
+
+    def write_mbr(self, path, mbr):
+        """
+        Writes the MBR to the first sector of a device or image file as one aligned write.
+        Block devices are written with O_DIRECT (one logical sector, read-modify-write when
+        the logical sector is larger than 512 bytes) so it goes straight to the media.
+        """
+        fd = os.open(path, os.O_RDWR)
+        try:
+            if not stat.S_ISBLK(os.fstat(fd).st_mode):
+                write_at(fd, mbr, 0)
+                os.fsync(fd)
+                return
+            SectorSize = struct.unpack("i", fcntl.ioctl(fd, BLKSSZGET, struct.pack("i", 0)))[0]
+            # mmap memory is page aligned, as O_DIRECT requires.
+            Buffer = mmap.mmap(-1, SectorSize)
+            Buffer[:] = os.read(fd, SectorSize)
+            Buffer[:len(mbr)] = mbr
+        finally:
+            os.close(fd)
+        fd = os.open(path, os.O_WRONLY | getattr(os, "O_DIRECT", 0))
+        try:
+            if os.write(fd, Buffer) != SectorSize:
+                raise IOError("short write")
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def reread_partitions(self, targetDevice, partitions):
+        """
+        Asks the kernel to re-read the partition table (BLKRRPART) and waits until it reports
+        the new partitions and their device nodes exist, rather than sleeping a fixed time.
+        """
+        Deadline = time.time() + PARTITION_NODE_TIMEOUT
+        fd = os.open(targetDevice.path, os.O_RDONLY)
+        try:
+            while True:
+                try:
+                    fcntl.ioctl(fd, BLKRRPART)
+                    break
+                except IOError as e:
+                    # EBUSY while something still holds a partition open
+                    if time.time() > Deadline:
+                        print(Fore.RED + "ERROR: re-reading partition table failed: " + str(e) + Fore.RESET)
+                        return(False)
+                    sleep(PARTITION_NODE_POLL)
+        finally:
+            os.close(fd)
+        return(self.wait_for_partitions(targetDevice, partitions, Deadline))
+
+    def wait_for_partitions(self, targetDevice, partitions, deadline = None):
+        """
+        Waits until sysfs shows each partition with its new start/size and its device node
+        exists. partitions is a list of (start, count, ...) tuples in partition order.
+        """
+        if deadline is None:
+            deadline = time.time() + PARTITION_NODE_TIMEOUT
+        for index, part in enumerate(partitions):
+            Node = self.node_path(targetDevice, index + 1)
+            SysPath = os.path.join("/sys/class/block", os.path.basename(Node))
+            while True:
+                try:
+                    with open(os.path.join(SysPath, "start")) as f:
+                        Start = int(f.read())
+                    with open(os.path.join(SysPath, "size")) as f:
+                        Count = int(f.read())
+                    if (Start, Count) == (part[0], part[1]) and os.path.exists(Node):
+                        break
+                except (IOError, OSError, ValueError):
+                    pass
+                if time.time() > deadline:
+                    print(Fore.RED + "ERROR: timed out waiting for " + Node + Fore.RESET)
+                    return(False)
+                sleep(PARTITION_NODE_POLL)
         return(True)
 
     def format_fat_partition(self, targetDevice):
@@ -238,14 +2359,28 @@ class SystemDevicesInterface(object):
             print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
             return(False)
 
-        NodePath = targetDevice.path + NODE_SUFFIX_FAT
+        NodePath = self.node_path(targetDevice, FAT_PARTITION)
         print("Formatting " + NodePath + ' as BOOT:FAT32')
         # First zero out the first sector per http://linux.die.net/man/8/fdisk
-        Cmd = 'dd if=/dev/zero of='+NodePath+' bs=512 count=1'
-        if not self.run_cmd(Cmd):
+        # (unless it was erased to zeroes).
+        if not self.Erased.pop(NodePath, False):
+            Cmd = 'dd if=/dev/zero of='+NodePath+' bs=512 count=1'
+            if not self.run_cmd(Cmd):
+                return(False)
+        # The format. The reserved sectors pad the data area to the erase block; -a keeps
+        # mkfs.vfat from changing them.
+        try:
+            SPC, Reserved, FatSectors, Clusters = fat32_geometry(self.partition_size(NodePath) // SECTOR_SIZE,
+                                                                 FAT32_RESERVED_SECTORS,
+                                                                 fat_alignment(self.erase_block(targetDevice)),
+                                                                 self.partition_start(NodePath))
+        except (OSError, ValueError) as e:
+            print(Fore.RED + "ERROR: " + NodePath + " can not hold a FAT32 file system: " + str(e) + Fore.RESET)
             return(False)
-        # The format
-        Cmd = 'mkfs.vfat -F 32 -n "BOOT" ' + NodePath
+        Cmd = 'mkfs.vfat -F 32 -a -s {} -R {} -n "BOOT" '.format(SPC, Reserved)
+        if self.Layout.mkfs_options("fat"):
+            Cmd = Cmd + self.Layout.mkfs_options("fat") + ' '
+        Cmd = Cmd + NodePath
         if not self.run_cmd(Cmd):
             return(False)
         return(True)
@@ -257,12 +2392,19 @@ class SystemDevicesInterface(object):
         if not self.validate_device(targetDevice):
             print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
             return(False)
-        NodePath = targetDevice.path + NODE_SUFFIX_ROOTFS
+        NodePath = self.node_path(targetDevice, ROOTFS_PARTITION)
         print("Formatting " + NodePath + ' as ROOTFS:EXT4')
         # These values are suppose to work well for SDCARDS.
         # See http://docs.pikatech.com/display/DEV/Optimizing+File+System+Parameters+of+SD+card+for+use+on+WARP+V3
         # See https://developer.ridgerun.com/wiki/index.php/High_performance_SD_card_tuning_using_the_EXT4_file_system
-        Cmd = 'mkfs.ext4 -O ^has_journal -E stride=2,stripe-width=256 -b 4096 -L "ROOTFS" '+ NodePath
+        Extended = ext4_stripe_options(self.erase_block(targetDevice)) + self.mkfs_discard(NodePath)
+        Profile = self.Layout.mkfs_options("rootfs")
+        if Profile is not None:
+            # A layout mkfs profile replaces the tuning below
+            if not self.run_cmd('mkfs.ext4 ' + Profile + ' -E ' + Extended + ' -b 4096 -L "ROOTFS" ' + NodePath):
+                return(False)
+            return(self.run_cmd('e2fsck -fpv ' + NodePath, suppress_errors={1}))
+        Cmd = 'mkfs.ext4 -O ^has_journal -E ' + Extended + ' -b 4096 -L "ROOTFS" '+ NodePath
         if not self.run_cmd(Cmd):
             return(False)
         Cmd = 'tune2fs -o journal_data_writeback '+ NodePath
@@ -287,11 +2429,18 @@ class SystemDevicesInterface(object):
         if not self.validate_device(targetDevice):
             print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
             return(False)
-        NodePath = targetDevice.path + NODE_SUFFIX_USER
+        NodePath = self.node_path(targetDevice, USER_PARTITION)
         print("Formatting " + NodePath + ' as USER:EXT4')
         # These values are suppose to work well for SDCARDS.
         # See http://docs.pikatech.com/display/DEV/Optimizing+File+System+Parameters+of+SD+card+for+use+on+WARP+V3
         # See https://developer.ridgerun.com/wiki/index.php/High_performance_SD_card_tuning_using_the_EXT4_file_system
+        Extended = ext4_stripe_options(self.erase_block(targetDevice)) + self.mkfs_discard(NodePath)
+        Profile = self.Layout.mkfs_options("user")
+        if Profile is not None:
+            # A layout mkfs profile replaces the journal question and the tuning below
+            if not self.run_cmd('mkfs.ext4 ' + Profile + ' -E ' + Extended + ' -b 4096 -L "USER" ' + NodePath):
+                return(False)
+            return(self.run_cmd('e2fsck -fpv ' + NodePath, suppress_errors={1}))
         if autoMode:
             # If in automode then force journal
             UserInput = "yes"
@@ -299,92 +2448,642 @@ class SystemDevicesInterface(object):
             print("Enter YES for journal support on USER partition or NO (default) for data_writeback:")
             UserInput = raw_input("Type " + Fore.RED + "yes" + Fore.RESET + " or anything else for default: ")
         if UserInput == "yes":
-            Cmd = 'mkfs.ext4 -E stride=2,stripe-width=256 -b 4096 -L "USER" '+ NodePath
+            Cmd = 'mkfs.ext4 -E ' + Extended + ' -b 4096 -L "USER" '+ NodePath
+            if not self.run_cmd(Cmd):
+                return(False)
+        else:
+            Cmd = 'mkfs.ext4 -O ^has_journal -E ' + Extended + ' -b 4096 -L "USER" '+ NodePath
+            if not self.run_cmd(Cmd):
+                return(False)
+            Cmd = 'tune2fs -o journal_data_writeback '+ NodePath
+            if not self.run_cmd(Cmd):
+                return(False)
+            Cmd = 'tune2fs -O ^has_journal '+ NodePath
             if not self.run_cmd(Cmd):
                 return(False)
-        else:
-            Cmd = 'mkfs.ext4 -O ^has_journal -E stride=2,stripe-width=256 -b 4096 -L "USER" '+ NodePath
+        Cmd = 'tune2fs -O ^huge_file '+ NodePath
+        if not self.run_cmd(Cmd):
+            return(False)
+        Cmd = 'e2fsck -fpv '+ NodePath
+        # Return value 1 just means the command 'fixed' any issues.
+        if not self.run_cmd(Cmd, suppress_errors={1}):
+            return(False)
+        return(True)
+
+    def mount_fat_partition(self, targetDevice):
+        """
+        Mounts the rootfs partition using udisks
+        """
+        if not self.validate_device(targetDevice):
+            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
+            return(False)
+        NodePath = self.node_path(targetDevice, FAT_PARTITION)
+        print("Mounting " + NodePath)
+        user = os.getenv("SUDO_UID")
+        Cmd = 'sudo  mount '+NodePath+' '+self.mount_point(targetDevice, FAT_PARTITION)+' -o uid='+user+',gid='+user+',utf8,dmask=027,fmask=137'
+        if not self.run_cmd(Cmd):
+            return(False)
+        return(True)
+
+    def mount_rootfs_partition(self, targetDevice):
+        """
+        Mounts the rootfs partition using udisks
+        """
+        if not self.validate_device(targetDevice):
+            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
+            return(False)
+        NodePath = self.node_path(targetDevice, ROOTFS_PARTITION)
+        print("Mounting " + NodePath)
+        Cmd = 'sudo  mount '+NodePath+' '+self.mount_point(targetDevice, ROOTFS_PARTITION)
+        if not self.run_cmd(Cmd):
+            return(False)
+        return(True)
+
+    def mount_user_partition(self, targetDevice):
+        """
+        Mounts the user partition using udisks
+        """
+        if not self.validate_device(targetDevice):
+            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
+            return(False)
+        NodePath = self.node_path(targetDevice, USER_PARTITION)
+        print("Mounting " + NodePath)
+        Cmd = 'sudo  mount '+NodePath+' '+self.mount_point(targetDevice, USER_PARTITION)
+        if not self.run_cmd(Cmd):
+            return(False)
+        return(True)
+
+    def copy_rootfs_to_archive(self, nodePath, dst_file_path, codec = "gz", level = None):
+        """
+        Copies all the rootfs files to a compressed tar archive using the codec given.
+        """
+        cmd = "tar --numeric-owner --one-file-system --exclude=./proc --exclude=./lost+found"
+        cmd = cmd + " --exclude=./sys --exclude=./mnt --exclude=./media --exclude=./dev"
+        cmd = cmd + " -I '" + " ".join(compress_command(codec, level)) + "' -cpf '"+dst_file_path+"' ."
+        if not self.run_cmd(cmd, workingDir=nodePath):
+            return(False)
+        self.Report.add_bytes(os.path.getsize(dst_file_path))
+        user = os.getenv("SUDO_USER")
+        return(self.change_file_owner(dst_file_path, user))
+
+    def extract_rootfs_archive(self, nodePath, archive_path):
+        """
+        Extracts a rootfs archive into the rootfs on the SDCARD. Decompression runs in its
+        own process while the files are written by a pool of threads.
+        """
+        Start = time.time()
+        Decompressor = subprocess.Popen(decompress_command(archive_path), stdout = subprocess.PIPE)
+        Extractor = RootfsExtractor(nodePath)
+        Ok = Extractor.extract(Decompressor.stdout)
+        Decompressor.stdout.close()
+        self.Report.phase("extract", Start, Extractor.bytes_written)
+        if Decompressor.wait() != 0:
+            print(Fore.RED + "ERROR: decompressing '" + archive_path + "' failed." + Fore.RESET)
+            Ok = False
+        for error in Extractor.errors[:20]:
+            print(Fore.RED + "  " + error + Fore.RESET)
+        sync()
+        return(Ok)
+
+    def fan_out(self, source, sinks):
+        """
+        Streams a source file object to all of the sinks. Returns the list of sink names
+        that failed (empty on success).
+        """
+        Writer = FanOutWriter(sinks)
+        Start = time.time()
+        Errors = Writer.run(source)
+        Elapsed = max(time.time() - Start, 0.001)
+        self.Report.phase("fan out", Start, Writer.bytes_read * len(sinks))
+        Failed = []
+        for sink, error in zip(sinks, Errors):
+            if error is not None:
+                print(Fore.RED + "ERROR: writing " + sink.name + " failed: " + str(error) + Fore.RESET)
+                Failed.append(sink.name)
+        print("  {:.1f}MiB to {} targets at {:.1f}MiB/s".format(Writer.bytes_read / float(MIB),
+                                                             len(sinks), Writer.bytes_read / Elapsed / MIB))
+        return(Failed)
+
+    def fan_out_spl(self, file_path, nodePaths):
+        """
+        Writes the 2nd stage bootloader to the RAW partition of several devices, reading it once.
+        """
+        Sinks = [FileSink(path, path) for path in nodePaths]
+        with open(file_path, "rb") as source:
+            return(self.fan_out(source, Sinks))
+
+    def fan_out_files(self, src_dir, dest_dirs):
+        """
+        Copies the files in src_dir to every destination directory, reading each file once.
+        """
+        Failed = set()
+        for File in sorted(os.listdir(src_dir)):
+            AbsFile = os.path.join(src_dir, File)
+            if not os.path.isfile(AbsFile):
+                continue
+            print('  Coping "' + File + '"')
+            Sinks = [FileSink(dest, os.path.join(dest, File)) for dest in dest_dirs if dest not in Failed]
+            with open(AbsFile, "rb") as source:
+                Failed.update(self.fan_out(source, Sinks))
+        sync()
+        return(sorted(Failed))
+
+    def fan_out_rootfs(self, archive_path, dest_dirs):
+        """
+        Decompresses the rootfs archive once and feeds the tar stream to one 'tar -x'
+        per destination rootfs.
+        """
+        Decompressor = subprocess.Popen(decompress_command(archive_path), stdout = subprocess.PIPE)
+        Sinks = [ProcessSink(dest, ["tar", "--numeric-owner", "-xpf", "-"], cwd = dest) for dest in dest_dirs]
+        Failed = self.fan_out(Decompressor.stdout, Sinks)
+        Decompressor.stdout.close()
+        if Decompressor.wait() != 0:
+            print(Fore.RED + "ERROR: decompressing '" + archive_path + "' failed." + Fore.RESET)
+            Failed = list(dest_dirs)
+        sync()
+        return(Failed)
+
+    def write_block_map(self, image_path, bmap_path = None):
+        """
+        Writes a block map (JSON) of the ranges of a card image that hold data, with a
+        sha256 per range. Returns the block map path or None on failure.
+        """
+        if not bmap_path:
+            bmap_path = image_path + BMAP_EXTENSION
+        ImageSize = os.path.getsize(image_path)
+        fd = os.open(image_path, os.O_RDONLY)
+        try:
+            # Flush delayed allocations so they are reported as data and not holes.
+            os.fsync(fd)
+            Ranges = image_data_ranges(fd, ImageSize)
+            for r in Ranges:
+                r.append(hash_range(fd, r[0], r[1], BMAP_BLOCK_SIZE))
+        finally:
+            os.close(fd)
+        Mapped = sum(r[1] - r[0] + 1 for r in Ranges)
+        BlockMap = {"version": 1,
+                    "image_size": ImageSize,
+                    "block_size": BMAP_BLOCK_SIZE,
+                    "mapped_blocks": Mapped,
+                    "ranges": Ranges}
+        with open(bmap_path, "w") as f:
+            json.dump(BlockMap, f)
+        print(Fore.GREEN + "Block map '" + bmap_path + "': {:.1f}MiB of {:.1f}MiB mapped in {} ranges".format(
+              Mapped * BMAP_BLOCK_SIZE / float(MIB), ImageSize / float(MIB), len(Ranges)) + Fore.RESET)
+        return(bmap_path)
+
+    def flash_block_map(self, targetDevice, image_path, bmap_path = None):
+        """
+        Writes only the mapped ranges of a card image to the target device using large
+        writes, then reads every range back from the device and checks its sha256.
+        """
+        if not self.validate_device(targetDevice):
+            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
+            return(False)
+        if not bmap_path:
+            bmap_path = image_path + BMAP_EXTENSION
+        with open(bmap_path) as f:
+            BlockMap = json.load(f)
+        BlockSize = BlockMap["block_size"]
+        if BlockMap["image_size"] > targetDevice.size.to("B"):
+            print(Fore.RED + "ERROR: image is larger than " + targetDevice.path + Fore.RESET)
+            return(False)
+        Start = time.time()
+        Source = os.open(image_path, os.O_RDONLY)
+        Target = os.open(targetDevice.path, os.O_WRONLY)
+        try:
+            for first, last, checksum in BlockMap["ranges"]:
+                if hash_range(Source, first, last, BlockSize,
+                              lambda data, offset: write_at(Target, data, offset)) != checksum:
+                    print(Fore.RED + "ERROR: image does not match its block map at block {}".format(first) + Fore.RESET)
+                    return(False)
+            os.fsync(Target)
+        finally:
+            os.close(Source)
+            os.close(Target)
+        Bytes = BlockMap["mapped_blocks"] * BlockSize
+        Elapsed = max(time.time() - Start, 0.001)
+        self.Report.phase("write mapped blocks", Start, Bytes)
+        print("  {:.1f}MiB written at {:.1f}MiB/s".format(Bytes / float(MIB), Bytes / Elapsed / MIB))
+        print("Verifying " + targetDevice.path)
+        Start = time.time()
+        Target = os.open(targetDevice.path, os.O_RDONLY)
+        try:
+            # Drop the cached copy of what was just written so the media is read back.
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(Target, 0, 0, os.POSIX_FADV_DONTNEED)
+            for first, last, checksum in BlockMap["ranges"]:
+                if hash_range(Target, first, last, BlockSize) != checksum:
+                    print(Fore.RED + "ERROR: verify failed at block {}".format(first) + Fore.RESET)
+                    return(False)
+        finally:
+            os.close(Target)
+        self.Report.phase("verify mapped blocks", Start, Bytes)
+        # Make the kernel pick up the new partition table.
+        if stat.S_ISBLK(os.stat(targetDevice.path).st_mode):
+            self.run_cmd("blockdev --rereadpt " + targetDevice.path)
+        print(Fore.GREEN + "Image written and verified." + Fore.RESET)
+        return(True)
+
+    def flash_image(self, targetDevice, image_path):
+        """
+        Writes a whole card image (raw or gz/zstd/lz4/xz compressed) to the target device.
+        """
+        if not self.validate_device(targetDevice):
+            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
+            return(False)
+        Start = time.time()
+        Flasher = ImageFlasher(image_path, targetDevice.path)
+        Ok = Flasher.run()
+        self.Report.phase("flash", Start, Flasher.bytes_written)
+        if not Ok:
+            print(Fore.RED + "ERROR: writing '" + image_path + "' failed: " + str(Flasher.error) + Fore.RESET)
+            return(False)
+        if stat.S_ISBLK(os.stat(targetDevice.path).st_mode):
+            self.run_cmd("blockdev --rereadpt " + targetDevice.path)
+        print(Fore.GREEN + "Image written." + Fore.RESET)
+        return(True)
+
+    def verify_against_manifest(self, targetDevice, manifest, mountPaths):
+        """
+        Reads back what the manifest lists from the target device and compares it. mountPaths
+        maps FAT_PARTITION/ROOTFS_PARTITION/USER_PARTITION to their mount points. Pending
+        writes are synced first (hash_file then drops each file's cached pages) and the
+        files are hashed on a pool of threads, with the partitions interleaved so they are
+        read in parallel. Returns a list of failures.
+        """
+        sync()
+        Checks = []
+        if "spl" in manifest:
+            Checks.append(("RAW", self.node_path(targetDevice, RAW_PARTITION), manifest["spl"]))
+        Lists = []
+        for key, node_index in (("fat", FAT_PARTITION), ("rootfs", ROOTFS_PARTITION), ("user", USER_PARTITION)):
+            if key in manifest:
+                Lists.append([(key, os.path.join(mountPaths[node_index], name), expected)
+                              for name, expected in sorted(manifest[key].items())])
+        while any(Lists):
+            for entries in Lists:
+                if entries:
+                    Checks.append(entries.pop())
+
+        def check(item):
+            Label, Path, Expected = item
+            if Expected[0] == "->":
+                if not os.path.islink(Path) or os.readlink(Path) != Expected[1]:
+                    return(Label + ": " + Path + " symlink differs")
+                return(None)
+            if not os.path.lexists(Path):
+                return(Label + ": " + Path + " is missing")
+            # The SPL is compared over its own length since the RAW partition is larger.
+            Size, Digest = hash_file(Path, Expected[0] if Label == "RAW" else None)
+            if [Size, Digest] != Expected:
+                return(Label + ": " + Path + " differs")
+            return(None)
+
+        Start = time.time()
+        Results = run_parallel(check, Checks, VERIFY_THREADS)
+        Failures = [str(r) for r in Results if r is not None]
+        Bytes = sum(c[2][0] for c in Checks if c[2][0] != "->")
+        Elapsed = max(time.time() - Start, 0.001)
+        self.Report.phase("verify", Start, Bytes)
+        print("  {} items, {:.1f}MiB verified at {:.1f}MiB/s".format(len(Checks), Bytes / float(MIB),
+                                                                  Bytes / Elapsed / MIB))
+        return(Failures)
+
+    def delta_rootfs(self, nodePath, archive_path, manifest):
+        """
+        Brings the rootfs at nodePath up to date with an archive using its manifest. Only
+        members that were added or changed are extracted and paths that are no longer in the
+        archive are removed. A file whose size matches but whose mtime does not is hashed
+        and, if the content is the same, only its attributes are updated.
+        """
+        Changed = set()
+        Start = time.time()
+        for name, entry in manifest.items():
+            Type, Size, Mtime, Mode, Uid, Gid, Extra = entry
+            Path = os.path.join(nodePath, name)
+            try:
+                st = os.lstat(Path)
+            except OSError:
+                Changed.add(name)
+                continue
+            Kind = {"f": stat.S_ISREG, "h": stat.S_ISREG, "d": stat.S_ISDIR, "l": stat.S_ISLNK,
+                    "c": stat.S_ISCHR, "b": stat.S_ISBLK, "p": stat.S_ISFIFO}[Type]
+            if not Kind(st.st_mode) or (st.st_uid, st.st_gid) != (Uid, Gid):
+                Changed.add(name)
+            elif Type == "l":
+                if os.readlink(Path) != Extra:
+                    Changed.add(name)
+            elif Type == "f":
+                if st.st_size != Size:
+                    Changed.add(name)
+                elif int(st.st_mtime) != Mtime or stat.S_IMODE(st.st_mode) != Mode:
+                    if hash_file(Path)[1] != Extra:
+                        Changed.add(name)
+                    else:
+                        os.chmod(Path, Mode)
+                        os.utime(Path, (Mtime, Mtime))
+            elif stat.S_IMODE(st.st_mode) != Mode:
+                Changed.add(name)
+        # A hard link is remade when its target is
+        for name, entry in manifest.items():
+            if entry[0] == "h" and entry[6] in Changed:
+                Changed.add(name)
+        # Directories holding changed entries get their metadata (mtime) reapplied
+        for name in list(Changed):
+            Parent = name
+            while Parent != ".":
+                Parent = os.path.dirname(Parent) or "."
+                if Parent not in manifest or Parent in Changed:
+                    break
+                Changed.add(Parent)
+
+        Removed = 0
+        for root, dirnames, filenames in os.walk(nodePath, topdown = True):
+            Rel = os.path.relpath(root, nodePath)
+            if Rel == ".":
+                dirnames[:] = [d for d in dirnames if d not in ROOTFS_EXCLUDED_DIRS]
+                filenames = [f for f in filenames if f not in ROOTFS_EXCLUDED_DIRS]
+            for name in list(dirnames):
+                Path = os.path.join(root, name)
+                if os.path.normpath(os.path.join(Rel, name)) not in manifest:
+                    print("  Removing " + Path)
+                    if os.path.islink(Path):
+                        os.unlink(Path)
+                    else:
+                        shutil.rmtree(Path)
+                    dirnames.remove(name)
+                    Removed = Removed + 1
+            for name in filenames:
+                if os.path.normpath(os.path.join(Rel, name)) not in manifest:
+                    print("  Removing " + os.path.join(root, name))
+                    os.unlink(os.path.join(root, name))
+                    Removed = Removed + 1
+
+        print("  {} of {} entries changed, {} removed ({:.1f}s to compare)".format(
+              len(Changed), len(manifest), Removed, time.time() - Start))
+        self.Report.phase("compare", Start)
+        if not Changed:
+            return(True)
+        Start = time.time()
+        Decompressor = subprocess.Popen(decompress_command(archive_path), stdout = subprocess.PIPE)
+        Extractor = RootfsExtractor(nodePath)
+        Ok = Extractor.extract(Decompressor.stdout, only = Changed)
+        self.Report.phase("extract", Start, Extractor.bytes_written)
+        Decompressor.stdout.close()
+        if Decompressor.wait() != 0:
+            print(Fore.RED + "ERROR: decompressing '" + archive_path + "' failed." + Fore.RESET)
+            Ok = False
+        for error in Extractor.errors[:20]:
+            print(Fore.RED + "  " + error + Fore.RESET)
+        sync()
+        return(Ok)
+
+    def unmount_partition(self, targetDevice, node_index):
+        """
+        Unmounts partition node_index of the target device if it is mounted.
+        """
+        MountPath = self.is_mounted(targetDevice, node_index)
+        if MountPath:
+            print("Unmounting '" + MountPath + "'")
+            if not self.run_cmd("umount " + MountPath):
+                return(False)
+        return(True)
+
+    def partition_size(self, nodePath):
+        """
+        Returns the size in bytes of a partition node (or image file).
+        """
+        fd = os.open(nodePath, os.O_RDONLY)
+        try:
+            return(os.lseek(fd, 0, os.SEEK_END))
+        finally:
+            os.close(fd)
+
+    def erase_node(self, nodePath, secure = False, zeroFallback = False):
+        """
+        Erases a whole device or partition node with BLKDISCARD (BLKSECDISCARD if secure).
+        Where the device does not support it only the first ERASE_ZERO_HEAD bytes are zeroed
+        (BLKZEROOUT), or the whole node if zeroFallback. Records in Erased whether the whole
+        node now reads back as zeroes.
+        """
+        Start = time.time()
+        try:
+            Length = self.partition_size(nodePath)
+            fd = os.open(nodePath, os.O_RDWR)
+        except OSError as e:
+            print(Fore.RED + "ERROR: opening " + nodePath + " failed: " + str(e) + Fore.RESET)
+            return(False)
+        try:
+            Range = struct.pack("QQ", 0, Length)
+            Method = "secure discard" if secure else "discard"
+            try:
+                fcntl.ioctl(fd, BLKSECDISCARD if secure else BLKDISCARD, Range)
+            except IOError as e:
+                if not zeroFallback:
+                    # Zeroing a whole card can take a long time, so only the metadata is cleared.
+                    print(Fore.YELLOW + nodePath + " does not support " + Method + " (" + str(e) + "), only zeroing the first "
+                          "{}MiB. Use --erase-zero-fallback to zero all of it.".format(ERASE_ZERO_HEAD // MIB) + Fore.RESET)
+                    fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", 0, min(Length, ERASE_ZERO_HEAD)))
+                    return(True)
+                print(Fore.YELLOW + nodePath + " does not support " + Method + " (" + str(e) + "), writing zeros to all "
+                      "{:.2f}GiB.".format(Length / float(GIB)) + Fore.RESET)
+                Method = "zeroing"
+                fcntl.ioctl(fd, BLKZEROOUT, Range)
+            Zeroes = True
+            for offset in sorted(set([0, (Length // 2) & ~(SECTOR_SIZE - 1), max(Length - ERASE_CHECK_SIZE, 0)])):
+                os.lseek(fd, offset, os.SEEK_SET)
+                Data = os.read(fd, ERASE_CHECK_SIZE)
+                if Data.count(b"\0") != len(Data):
+                    Zeroes = False
+                    break
+        except (IOError, OSError) as e:
+            print(Fore.RED + "ERROR: erasing " + nodePath + " failed: " + str(e) + Fore.RESET)
+            return(False)
+        finally:
+            os.close(fd)
+        self.Erased[nodePath] = Zeroes
+        self.Report.phase("erase", Start)
+        print("  {} ({:.2f}GiB) erased by {} in {:.2f}s, {}".format(nodePath, Length / float(GIB), Method, time.time() - Start,
+              "reads back as zeroes" if Zeroes else "does not read back as zeroes"))
+        return(True)
+
+    def erase_block(self, targetDevice):
+        """
+        Returns the erase block (allocation unit) size in bytes of the target device used to
+        align the partitions and file systems. It is detected once per device unless it was
+        given on the command line.
+        """
+        if self.EraseBlock:
+            return(self.EraseBlock)
+        if targetDevice.path not in self.EraseBlocks:
+            Size, Source = detect_erase_block(targetDevice)
+            self.EraseBlocks[targetDevice.path] = Size
+            print("Erase block of " + targetDevice.path + " is {}MiB ({})".format(Size // MIB, Source))
+        return(self.EraseBlocks[targetDevice.path])
+
+    def clear_erased(self, targetDevice):
+        """
+        Forgets the erase results of the target device and its partitions.
+        """
+        self.Erased.pop(targetDevice.path, None)
+        for node_index in PARTITION_NAMES.values():
+            self.Erased.pop(self.node_path(targetDevice, node_index), None)
+
+    def mkfs_discard(self, nodePath):
+        """
+        Returns the mkfs.ext4 extended option for discarding the blocks of a partition. A
+        partition erased just before is not discarded again.
+        """
+        if self.Erased.pop(nodePath, None) is not None:
+            return(",nodiscard")
+        return(",discard")
+
+    def rootfs_image_mkfs_options(self, erase_block = DEFAULT_ERASE_BLOCK):
+        """
+        Returns the mkfs.ext4 options of an offline ROOTFS image: the layout's mkfs profile
+        for the rootfs partition, if it has one, in place of the built-in tuning.
+        """
+        Profile = self.Layout.mkfs_options("rootfs")
+        if Profile is None:
+            return(ROOTFS_IMAGE_MKFS_OPTIONS.format(ext4_stripe_options(erase_block)))
+        return(Profile + " -E " + ext4_stripe_options(erase_block) + ",lazy_itable_init=1,root_owner=0:0 -b 4096")
+
+    def build_rootfs_image(self, archive_path, image_path, size_bytes, work_dir = None, erase_block = DEFAULT_ERASE_BLOCK):
+        """
+        Builds an ext4 file system image of size_bytes holding the rootfs archive, without
+        mounting anything: the archive is extracted to a staging directory on the host and
+        mkfs.ext4 -d populates the new file system from it. The same tuning (or mkfs
+        profile) as format_rootfs_partition is applied.
+        """
+        Staging = tempfile.mkdtemp(prefix = "rootfs_", dir = work_dir)
+        try:
+            print("Extracting '" + archive_path + "' to " + Staging)
+            Start = time.time()
+            Decompressor = subprocess.Popen(decompress_command(archive_path), stdout = subprocess.PIPE)
+            Extractor = RootfsExtractor(Staging)
+            Ok = Extractor.extract(Decompressor.stdout)
+            self.Report.phase("extract", Start, Extractor.bytes_written)
+            Decompressor.stdout.close()
+            if Decompressor.wait() != 0 or not Ok:
+                for error in Extractor.errors[:20]:
+                    print(Fore.RED + "  " + error + Fore.RESET)
+                print(Fore.RED + "ERROR: extracting '" + archive_path + "' failed." + Fore.RESET)
+                return(False)
+            with open(image_path, "wb") as f:
+                f.truncate(size_bytes)
+            print("Building ROOTFS:EXT4 image " + image_path)
+            Cmd = "mkfs.ext4 -F -q " + self.rootfs_image_mkfs_options(erase_block)
+            Cmd = Cmd + " -L \"ROOTFS\" -d '" + Staging + "' '" + image_path + "'"
             if not self.run_cmd(Cmd):
                 return(False)
-            Cmd = 'tune2fs -o journal_data_writeback '+ NodePath
-            if not self.run_cmd(Cmd):
+            if self.Layout.mkfs_options("rootfs") is None and \
+               not self.run_cmd("tune2fs -o journal_data_writeback '" + image_path + "'"):
                 return(False)
-            Cmd = 'tune2fs -O ^has_journal '+ NodePath
-            if not self.run_cmd(Cmd):
+            # Return value 1 just means the command 'fixed' any issues.
+            if not self.run_cmd("e2fsck -fp '" + image_path + "'", suppress_errors={1}):
                 return(False)
-        Cmd = 'tune2fs -O ^huge_file '+ NodePath
-        if not self.run_cmd(Cmd):
-            return(False)
-        Cmd = 'e2fsck -fpv '+ NodePath
-        # Return value 1 just means the command 'fixed' any issues.
-        if not self.run_cmd(Cmd, suppress_errors={1}):
-            return(False)
-        return(True)
+            return(True)
+        finally:
+            shutil.rmtree(Staging, ignore_errors = True)
 
-    def mount_fat_partition(self, targetDevice):
+    def partition_start(self, nodePath):
         """
-        Mounts the rootfs partition using udisks
+        Returns the first sector of a partition node from sysfs, 0 if it is not a partition.
         """
-        if not self.validate_device(targetDevice):
-            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
-            return(False)
-        NodePath = targetDevice.path + NODE_SUFFIX_FAT
-        print("Mounting " + NodePath)
-        user = os.getenv("SUDO_UID")
-        Cmd = 'sudo  mount '+NodePath+' '+FAT_MOUNT_POINT+' -o uid='+user+',gid='+user+',utf8,dmask=027,fmask=137'
-        if not self.run_cmd(Cmd):
-            return(False)
-        return(True)
+        try:
+            with open("/sys/class/block/" + os.path.basename(os.path.realpath(nodePath)) + "/start") as f:
+                return(int(f.read()))
+        except (IOError, OSError, ValueError):
+            return(0)
 
-    def mount_rootfs_partition(self, targetDevice):
+    def build_fat_image(self, boot_dir, image_path, size_bytes, hidden_sectors = 0, erase_block = DEFAULT_ERASE_BLOCK):
         """
-        Mounts the rootfs partition using udisks
+        Builds a FAT32 file system image of size_bytes holding the files of boot_dir, without
+        mounting anything. Sub-directories are skipped just like WriteBootFiles does.
         """
-        if not self.validate_device(targetDevice):
-            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
-            return(False)
-        NodePath = targetDevice.path + NODE_SUFFIX_ROOTFS
-        print("Mounting " + NodePath)
-        Cmd = 'sudo  mount '+NodePath+' '+ROOTFS_MOUNT_POINT
-        if not self.run_cmd(Cmd):
+        Builder = Fat32ImageBuilder()
+        for name in sorted(os.listdir(boot_dir)):
+            if os.path.isfile(os.path.join(boot_dir, name)):
+                Builder.add_file(name, os.path.join(boot_dir, name))
+        print("Building BOOT:FAT32 image " + image_path)
+        Start = time.time()
+        try:
+            Builder.write(image_path, size_bytes, hidden_sectors, fat_alignment(erase_block))
+            self.Report.phase("build FAT image", Start, sum(os.path.getsize(path) for name, path in Builder.files))
+        except (ValueError, IOError, OSError) as e:
+            print(Fore.RED + "ERROR: building '" + image_path + "' failed: " + str(e) + Fore.RESET)
             return(False)
         return(True)
 
-    def mount_user_partition(self, targetDevice):
+    def write_partition_image(self, image_path, nodePath):
         """
-        Mounts the user partition using udisks
+        Writes a (sparse) partition image to a partition node. Only the ranges of the image
+        holding data are written, in large sequential chunks.
         """
-        if not self.validate_device(targetDevice):
-            print(Fore.RED + "ERROR: " + targetDevice.path + " is not a valid SDCard device. Aborting." + Fore.RESET)
-            return(False)
-        NodePath = targetDevice.path + str(USER_PARTITION)
-        print("Mounting " + NodePath)
-        Cmd = 'sudo  mount '+NodePath+' '+USER_MOUNT_POINT
-        if not self.run_cmd(Cmd):
+        Size = os.path.getsize(image_path)
+        if Size > self.partition_size(nodePath):
+            print(Fore.RED + "ERROR: '" + image_path + "' is larger than " + nodePath + Fore.RESET)
             return(False)
-        return(True)
+        Start = time.time()
+        Source = os.open(image_path, os.O_RDONLY)
+        Target = os.open(nodePath, os.O_WRONLY)
+        Written = [0]
 
-    def copy_rootfs_to_gz_archive(self, nodePath, dst_file_path):
-        """
-        Copies all the rootfs files to a tar.gz archive.
-        """
-        cmd = "tar --numeric-owner --one-file-system -cpzf --exclude=./proc --exclude=./lost+found"
-        cmd = cmd + " --exclude=./sys --exclude=./mnt --exclude=./media --exclude=./dev '"+dst_file_path+"' ."
-        if not self.run_cmd(cmd, workingDir=nodePath):
+        def write_chunk(data, offset):
+            write_at(Target, data, offset)
+            Written[0] = Written[0] + len(data)
+
+        try:
+            for first, last in image_data_ranges(Source, Size):
+                hash_range(Source, first, last, BMAP_BLOCK_SIZE, write_chunk)
+            os.fsync(Target)
+        except (IOError, OSError) as e:
+            print(Fore.RED + "ERROR: writing " + nodePath + " failed: " + str(e) + Fore.RESET)
             return(False)
-        user = os.getenv("SUDO_USER")
-        return(self.change_file_owner(dst_file_path, user))
+        finally:
+            os.close(Source)
+            os.close(Target)
+        Elapsed = max(time.time() - Start, 0.001)
+        self.Report.phase("write image", Start, Written[0])
+        print("  {:.1f}MiB written to {} at {:.1f}MiB/s".format(Written[0] / float(MIB), nodePath,
+                                                              Written[0] / Elapsed / MIB))
+        return(True)
 
-    def untar_gz_archive_to_sdcard_rootfs(self, nodePath, src_script_path):
+    def sync_files(self, src_dir, dest_dir):
         """
-        Un tars a tar.gz archive into the rootfs on the SDCARD using the scipt specified.
+        Makes the files at the top of dest_dir match the files at the top of src_dir. A file
+        is copied only if its size differs or, when the sizes match, its content hash does.
+        Files no longer in src_dir are deleted. Reports the bytes not rewritten.
         """
-        script = os.path.basename(src_script_path)
-        script_loc = os.path.dirname(src_script_path)
-        cmd = "sh '"+script+"' "+nodePath
-        if not self.run_cmd(cmd, workingDir=script_loc):
+        SourceFiles = set(f for f in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, f)))
+        Copied = 0
+        Saved = 0
+        Start = time.time()
+        try:
+            for File in sorted(SourceFiles):
+                Source = os.path.join(src_dir, File)
+                Dest = os.path.join(dest_dir, File)
+                Size = os.path.getsize(Source)
+                if os.path.isfile(Dest) and os.path.getsize(Dest) == Size:
+                    # Sizes match so the card copy has to be read to compare content
+                    if hash_file(Source, drop_cache = False)[1] == hash_file(Dest)[1]:
+                        Saved = Saved + Size
+                        continue
+                print('  Coping "' + File + '" to ' + Dest)
+                shutil.copyfile(Source, Dest)
+                Copied = Copied + Size
+            for File in sorted(os.listdir(dest_dir)):
+                Dest = os.path.join(dest_dir, File)
+                if File not in SourceFiles and os.path.isfile(Dest):
+                    print("  Deleting file " + Dest)
+                    os.unlink(Dest)
+        except (IOError, OSError) as e:
+            print(Fore.RED + "ERROR: sync to " + dest_dir + " failed: " + str(e) + Fore.RESET)
             return(False)
         sync()
+        self.Report.phase("sync", Start, Copied)
+        print("  {:.1f}MiB copied, {:.1f}MiB unchanged and not rewritten".format(Copied / float(MIB), Saved / float(MIB)))
         return(True)
 
     def change_file_owner(self, file_path, new_owner):
@@ -407,6 +3106,8 @@ def get_drive_selection(sysDevicesIF):
         for i, device in enumerate(sysDevicesIF.devices):
             Text = '  ' + str(i + 1) + ")  " + device.path + \
                    " [{0}]".format(device.size.pretty(units = "GiB"))
+            if device.description():
+                Text = Text + "  " + device.description()
             if device.size <= sysDevicesIF.max_size_to_be_an_sdcard:
                 print(Fore.GREEN + Text + Fore.RESET)
                 FoundPossibleSDCard = True
@@ -451,6 +3152,24 @@ def get_operation_selection(selectedDevice, operations):
     print(Fore.RED + "ERROR: Invalid choice." + Fore.RESET)
     exit(-1)
 
+def MountedPath(sysDevicesIF, selectedDevice, node_index):
+    """
+    Returns the mount point of partition node_index, mounting the partition first if needed.
+    """
+    MountPath = sysDevicesIF.is_mounted(selectedDevice, node_index)
+    if not MountPath:
+        MountFunction = {FAT_PARTITION: sysDevicesIF.mount_fat_partition,
+                         ROOTFS_PARTITION: sysDevicesIF.mount_rootfs_partition,
+                         USER_PARTITION: sysDevicesIF.mount_user_partition}[node_index]
+        if not MountFunction(selectedDevice):
+            exit(-1)
+        MountPath = sysDevicesIF.is_mounted(selectedDevice, node_index)
+        if not MountPath:
+            Label = {FAT_PARTITION: "BOOT", ROOTFS_PARTITION: "ROOTFS", USER_PARTITION: "USER"}[node_index]
+            print(Fore.RED + "ERROR: Unable to determine " + Label + " mount point." + Fore.RESET)
+            exit(-1)
+    return(MountPath)
+
 def MountAllPartitions(sysDevicesIF, selectedDevice, args):
     if not sysDevicesIF.mount_fat_partition(selectedDevice):
         exit(-1)
@@ -463,20 +3182,42 @@ def UnmountAllPartitions(sysDevicesIF, selectedDevice, args):
     if not sysDevicesIF.unmount_device(selectedDevice):
         exit(-1)
 
+def CardLayout(selectedDevice, eraseBlock = DEFAULT_ERASE_BLOCK, layout = None):
+    """
+    Returns the [(first sector, sectors)] of the FAT, RAW, ROOTFS and USER partitions
+    (indexed by partition number - 1) and the number of sectors in the device.
+    """
+    if layout is None:
+        layout = PartitionLayout(DEFAULT_LAYOUT)
+    SectorsInDevice = int(selectedDevice.size.to("B") // SECTOR_SIZE)
+    try:
+        Layout = layout.resolve(SectorsInDevice, eraseBlock)
+    except ValueError as e:
+        print(Fore.RED + "ERROR: " + layout.Source + " layout does not fit " + selectedDevice.path + ": " + str(e) + Fore.RESET)
+        exit(-1)
+    return(Layout, SectorsInDevice)
+
 def PrepareSDCard(sysDevicesIF, selectedDevice, args, verifyOp = True):
-    # Set the SDCARD geometry such that the partitions align on cylinder boundaries.
-    SectorsInDevice = int(selectedDevice.size.to("B") / SECTOR_SIZE)
-    StartOfFatPartition    = ((1*1024*1024) / SECTOR_SIZE)
-    SectorsInFatPartition  = ((256*1024*1024) / SECTOR_SIZE) - StartOfFatPartition # ~256MiB
+    if not PartitionCard(sysDevicesIF, selectedDevice, args, verifyOp):
+        return
+    print(Fore.GREEN + "Formatting and mounting partitions." + Fore.RESET)
+    PrepareFatPartition(sysDevicesIF, selectedDevice, args)
+    PrepareRootfsPartition(sysDevicesIF, selectedDevice, args)
+    PrepareUserPartition(sysDevicesIF, selectedDevice, args, verifyOp)
+    print(Fore.GREEN + "Repartitioning and Formatting complete." + Fore.RESET)
+
+def PartitionCard(sysDevicesIF, selectedDevice, args, verifyOp = True):
+    """
+    Writes a new partition table to the card. Returns False if the user aborted.
+    """
+    Layout, SectorsInDevice = CardLayout(selectedDevice, sysDevicesIF.erase_block(selectedDevice), sysDevicesIF.Layout)
+    StartOfFatPartition, SectorsInFatPartition = Layout[FAT_PARTITION-1]
     BytesInFatPartition    = SectorsInFatPartition * float(SECTOR_SIZE)
-    StartOfRawPartition   = StartOfFatPartition + SectorsInFatPartition
-    SectorsInRawPartition = ((16*1024*1024) / SECTOR_SIZE) # 16MiB
+    StartOfRawPartition, SectorsInRawPartition = Layout[RAW_PARTITION-1]
     BytesInRawPartition    = SectorsInRawPartition * float(SECTOR_SIZE)
-    StartOfRootfsPartition    = StartOfRawPartition + SectorsInRawPartition
-    SectorsInRootfsPartition  = ((1280*1024*1024) / SECTOR_SIZE)
+    StartOfRootfsPartition, SectorsInRootfsPartition = Layout[ROOTFS_PARTITION-1]
     BytesInRootfsPartition    = SectorsInRootfsPartition * float(SECTOR_SIZE)
-    StartOfUserPartition   = StartOfRootfsPartition + SectorsInRootfsPartition
-    SectorsInUserPartition = int((SectorsInDevice-StartOfUserPartition)) & 0xFFFFFF00
+    StartOfUserPartition, SectorsInUserPartition = Layout[USER_PARTITION-1]
     BytesInUserPartition    = SectorsInUserPartition * float(SECTOR_SIZE)
 
     if verifyOp:
@@ -486,7 +3227,7 @@ def PrepareSDCard(sysDevicesIF, selectedDevice, args, verifyOp = True):
         print(Fore.RED + "!!!ALL DATA WILL BE LOST!!!" + Fore.RESET)
         print(Fore.RED + "##########################################################" + Fore.RESET)
         try:
-            TargetDisk = reparted.Disk(selectedDevice)
+            TargetDisk = reparted.Disk(selectedDevice.parted())
             print("")
             print("Existing partitions on " + selectedDevice.path + ":")
             index = 1
@@ -512,45 +3253,69 @@ def PrepareSDCard(sysDevicesIF, selectedDevice, args, verifyOp = True):
         UserInput = raw_input("or anything else to abort: ")
         if UserInput != "yippie ki-yay":
             print(Fore.RED + "User abort." + Fore.RESET)
-            return
+            return(False)
 
     print(Fore.GREEN + "Dis-mounting all mounts on " + selectedDevice.path + "..." + Fore.RESET)
     if not sysDevicesIF.unmount_device(selectedDevice):
         exit(-1)
-    print(Fore.GREEN + "Writting zeros to first 1MB+1024 of SDCard to clear any left over data." + Fore.RESET)
-    if not sysDevicesIF.zero_first_1mb(selectedDevice):
-        exit(-1)
+    sysDevicesIF.clear_erased(selectedDevice)
+    if args.erase and not args.erase_partitions:
+        print(Fore.GREEN + "Erasing " + selectedDevice.path + "." + Fore.RESET)
+        if not sysDevicesIF.erase_node(selectedDevice.path, args.erase == "secure", args.erase_zero_fallback):
+            exit(-1)
+    if sysDevicesIF.Erased.get(selectedDevice.path):
+        print(Fore.GREEN + "SDCard was erased to zeroes, left over data is already cleared." + Fore.RESET)
+    else:
+        print(Fore.GREEN + "Writting zeros to first 1MB+1024 of SDCard to clear any left over data." + Fore.RESET)
+        if not sysDevicesIF.zero_first_1mb(selectedDevice):
+            exit(-1)
     print(Fore.GREEN + "Repartitioning to create FAT32 and Linux partitions." + Fore.RESET)
     # [ start, size, id/type, bootable ]
     Partitions = [ None, None, None, None ]
-    Partitions[FAT_PARTITION-1]      = (str(StartOfFatPartition) , str(SectorsInFatPartition) , "0x0B", "*")
-    Partitions[RAW_PARTITION-1]      = (str(StartOfRawPartition), str(SectorsInRawPartition), "0xA2", "-")
-    Partitions[ROOTFS_PARTITION-1]   = (str(StartOfRootfsPartition), str(SectorsInRootfsPartition), "0x83", "-")
-    Partitions[USER_PARTITION-1]     = (str(StartOfUserPartition), str(SectorsInUserPartition), "0x83", "-")
+    for index, (start, count) in enumerate(Layout):
+        Entry = sysDevicesIF.Layout.entry(index + 1)
+        Partitions[index] = (str(start), str(count), hex(Entry["type"]), "*" if Entry["bootable"] else "-")
     if not sysDevicesIF.create_partitions(selectedDevice, Partitions):
         exit(-1)
+    if selectedDevice.path in sysDevicesIF.Erased:
+        # The new partitions lie on the erased card (the MBR is outside all of them).
+        Zeroes = sysDevicesIF.Erased.pop(selectedDevice.path)
+        for node_index in PARTITION_NAMES.values():
+            sysDevicesIF.Erased[sysDevicesIF.node_path(selectedDevice, node_index)] = Zeroes
+    elif args.erase:
+        print(Fore.GREEN + "Erasing partitions " + args.erase_partitions + "." + Fore.RESET)
+        for name in args.erase_partitions.split(","):
+            NodePath = sysDevicesIF.node_path(selectedDevice, PARTITION_NAMES[name.strip()])
+            if not sysDevicesIF.erase_node(NodePath, args.erase == "secure", args.erase_zero_fallback):
+                exit(-1)
+    return(True)
 
-    print(Fore.GREEN + "Formatting partitions." + Fore.RESET)
+def PrepareFatPartition(sysDevicesIF, selectedDevice, args):
+    # An offline built FAT image replaces the whole partition so formatting it is wasted.
+    if args.offline_fat and args.boot_loc:
+        return
     if not sysDevicesIF.format_fat_partition(selectedDevice):
         exit(-1)
-    if not sysDevicesIF.format_rootfs_partition(selectedDevice):
-        exit(-1)
-    if not sysDevicesIF.format_user_partition(selectedDevice, not verifyOp):
+    if not sysDevicesIF.mount_fat_partition(selectedDevice):
         exit(-1)
 
-    sleep(1)
-    print(Fore.GREEN + "Mounting partitions." + Fore.RESET)
-    if not sysDevicesIF.mount_fat_partition(selectedDevice):
+def PrepareRootfsPartition(sysDevicesIF, selectedDevice, args):
+    # Likewise for an offline built ROOTFS image.
+    if args.offline_rootfs and args.rootfs_loc:
+        return
+    if not sysDevicesIF.format_rootfs_partition(selectedDevice):
         exit(-1)
     if not sysDevicesIF.mount_rootfs_partition(selectedDevice):
         exit(-1)
+
+def PrepareUserPartition(sysDevicesIF, selectedDevice, args, verifyOp = True):
+    if not sysDevicesIF.format_user_partition(selectedDevice, not verifyOp):
+        exit(-1)
     if not sysDevicesIF.mount_user_partition(selectedDevice):
         exit(-1)
 
-    print(Fore.GREEN + "Repartitioning and Formatting complete." + Fore.RESET)
-
 def InstallSPL(sysDevicesIF, selectedDevice, args):
-    NodePath = selectedDevice.path + NODE_SUFFIX_RAW
+    NodePath = sysDevicesIF.node_path(selectedDevice, RAW_PARTITION)
     if args.spl_loc:
         SourceLoc = args.spl_loc
     else:
@@ -615,16 +3380,15 @@ def DeleteDirContents(sysDevicesIF, DestPath):
             print("Deteting dir "+file_object_path)
             shutil.rmtree(file_object_path)
 
-def WriteBootFiles(sysDevicesIF, selectedDevice, args, verifyOp = True):
-    DestPath = sysDevicesIF.is_mounted(selectedDevice, FAT_PARTITION)
-    if not DestPath:
-        if not sysDevicesIF.mount_fat_partition(selectedDevice):
+def WriteBootFiles(sysDevicesIF, selectedDevice, args, verifyOp = True, imagePath = None):
+    if args.offline_fat:
+        # The partition is written as a whole so it must not be mounted
+        if not sysDevicesIF.unmount_partition(selectedDevice, FAT_PARTITION):
             exit(-1)
-        DestPath = sysDevicesIF.is_mounted(selectedDevice, FAT_PARTITION)
-        if not DestPath:
-            print(Fore.RED + "ERROR: Unable to determine BOOT mount point." + Fore.RESET)
-            exit(-1)
-    if verifyOp:
+        DestPath = sysDevicesIF.node_path(selectedDevice, FAT_PARTITION)
+    else:
+        DestPath = MountedPath(sysDevicesIF, selectedDevice, FAT_PARTITION)
+    if verifyOp and not args.sync and not args.offline_fat:
         print("")
         print("Delete all current files on FAT partition?")
         UserInput = raw_input("Type " + Fore.RED + "'yes'" + Fore.RESET + " or 'no (default)': ")
@@ -657,6 +3421,25 @@ def WriteBootFiles(sysDevicesIF, selectedDevice, args, verifyOp = True):
             print(Fore.RED + "User abort." + Fore.RESET)
             return
 
+    if args.offline_fat:
+        ImagePath = imagePath
+        if not ImagePath:
+            ImagePath = BuildFatImage(sysDevicesIF, SourceLoc, sysDevicesIF.partition_size(DestPath),
+                                      sysDevicesIF.partition_start(DestPath), sysDevicesIF.erase_block(selectedDevice), args)
+        Ok = sysDevicesIF.write_partition_image(ImagePath, DestPath)
+        ReleaseImage(ImagePath, args)
+        if not Ok:
+            exit(-1)
+        print(Fore.GREEN + "BOOT image has been written to FAT partition." + Fore.RESET)
+        return
+
+    if args.sync:
+        # Only copy what changed and remove what is no longer in the source
+        if not sysDevicesIF.sync_files(SourceLoc, DestPath):
+            exit(-1)
+        print(Fore.GREEN + "BOOT files on FAT partition are in sync." + Fore.RESET)
+        return
+
     # Copy each file in the file_list to the dest directory
     FileList = os.listdir(SourceLoc)
     for File in FileList:
@@ -665,20 +3448,40 @@ def WriteBootFiles(sysDevicesIF, selectedDevice, args, verifyOp = True):
             Dest = os.path.join(DestPath, File)
             print('  Coping "' + File + '" to ' + Dest)
             shutil.copyfile(AbsFile, Dest)
+            sysDevicesIF.Report.add_bytes(os.path.getsize(AbsFile))
     sync()
     print(Fore.GREEN + "BOOT files have been copied to FAT partition." + Fore.RESET)
 
+def SyncBootFiles(sysDevicesIF, selectedDevice, args, verifyOp = True):
+    SyncArgs = copy.copy(args)
+    SyncArgs.sync = True
+    WriteBootFiles(sysDevicesIF, selectedDevice, SyncArgs, verifyOp)
+
 def CopyRootFS(sysDevicesIF, selectedDevice, args, verifyOp = True):
-    SrcPath = sysDevicesIF.is_mounted(selectedDevice, ROOTFS_PARTITION)
-    if not SrcPath:
-        if not sysDevicesIF.mount_rootfs_partition(selectedDevice):
+    SrcPath = MountedPath(sysDevicesIF, selectedDevice, ROOTFS_PARTITION)
+    Codec = args.rootfs_codec
+    Given = archive_extension(args.rootfs_copy_loc or "")
+    if Given:
+        # A given archive extension is kept and picks the codec if none was given
+        if extension_codec(Given) is None:
+            print(Fore.RED + "ERROR: a ROOTFS copy can not be written as a '" + Given + "' archive. Use one of " +
+                  ", ".join(sorted([ext for ext, level, magic in ROOTFS_CODECS.values()] + list(ROOTFS_SHORT_EXTENSIONS))) +
+                  "." + Fore.RESET)
             exit(-1)
-        SrcPath = sysDevicesIF.is_mounted(selectedDevice, ROOTFS_PARTITION)
-        if not SrcPath:
-            print(Fore.RED + "ERROR: Unable to determine ROOTFS mount point." + Fore.RESET)
+        if Codec and Codec != extension_codec(Given):
+            print(Fore.RED + "ERROR: '" + args.rootfs_copy_loc + "' does not match --rootfs-codec " + Codec +
+                  " (" + ROOTFS_CODECS[Codec][0] + ")." + Fore.RESET)
             exit(-1)
+        Codec = extension_codec(Given)
+    Codec = Codec or ROOTFS_DEFAULT_CODEC
+    Ext = ROOTFS_CODECS[Codec][0]
     if args.rootfs_copy_loc:
         DestLoc = args.rootfs_copy_loc
+        if Given:
+            BaseLoc = DestLoc[:-len(Given)]
+        else:
+            BaseLoc = DestLoc
+            DestLoc = BaseLoc + Ext
     else:
         print("")
         print("ROOTFS copy will be stored in the default image directory:")
@@ -689,8 +3492,8 @@ def CopyRootFS(sysDevicesIF, selectedDevice, args, verifyOp = True):
         if (BaseLoc == ""):
             print(Fore.RED + "User abort." + Fore.RESET)
             return
-        BaseLoc = os.path.join(DestLoc, raw_input(">"))
-        DestLoc = BaseLoc + ".tar.gz"
+        BaseLoc = os.path.join(DestLoc, BaseLoc)
+        DestLoc = BaseLoc + Ext
     print("ROOTFS files will be read from : " + SrcPath)
     print("ROOTFS files will be written to: " + DestLoc)
     if verifyOp:
@@ -699,7 +3502,8 @@ def CopyRootFS(sysDevicesIF, selectedDevice, args, verifyOp = True):
         if UserInput != "yes":
             print(Fore.RED + "User abort." + Fore.RESET)
             return
-    sysDevicesIF.copy_rootfs_to_gz_archive(SrcPath, DestLoc)
+    if not sysDevicesIF.copy_rootfs_to_archive(SrcPath, DestLoc, Codec, args.codec_level):
+        exit(-1)
     # Now write out a simple script that can be used to write the ROOTFS to an SDCARD
     ScriptLoc = BaseLoc + ".sh"
     text_file = open(ScriptLoc, "w")
@@ -717,7 +3521,8 @@ if [ -z "$1" ]
     exit -1
 fi
 
-tar -C $1 -xzpf """
+# tar detects the archive compression (gz, zst, lz4, xz) by itself
+tar -C $1 --numeric-owner -xpf """
                     )
     text_file.write(os.path.basename(DestLoc)+"\n")
     text_file.close()
@@ -725,6 +3530,11 @@ tar -C $1 -xzpf """
     user = os.getenv("SUDO_USER")
     sysDevicesIF.change_file_owner(ScriptLoc, user)
     sysDevicesIF.change_file_permissions(ScriptLoc, "a+x")
+    # and a manifest of the archive for delta installs
+    ManifestLoc = rootfs_manifest_path(DestLoc)
+    with open(ManifestLoc, "w") as f:
+        json.dump(build_rootfs_manifest(DestLoc), f)
+    sysDevicesIF.change_file_owner(ManifestLoc, user)
 
 
 def DeleteAllOnRootFs(sysDevicesIF, selectedDevice, args):
@@ -769,15 +3579,88 @@ def DeleteAllOnUserFs(sysDevicesIF, selectedDevice, args):
         pass
     print(Fore.GREEN + "Formatting USER partition complete." + Fore.RESET)
 
-def InstallRootFS(sysDevicesIF, selectedDevice, args, verifyOp = True):
-    DestPath = sysDevicesIF.is_mounted(selectedDevice, ROOTFS_PARTITION)
-    if not DestPath:
-        if not sysDevicesIF.mount_rootfs_partition(selectedDevice):
-            exit(-1)
-        DestPath = sysDevicesIF.is_mounted(selectedDevice, ROOTFS_PARTITION)
-        if not DestPath:
-            print(Fore.RED + "ERROR: Unable to determine ROOTFS mount point." + Fore.RESET)
+def RootfsArchivePath(sourceLoc):
+    """
+    Returns the archive extracted by a ROOTFS install script written by CopyRootFS.
+    If sourceLoc is not a script it is assumed to be the archive itself.
+    """
+    if not sourceLoc.endswith(".sh"):
+        return(sourceLoc)
+    for line in open(sourceLoc):
+        if line.startswith("tar "):
+            return(os.path.join(os.path.dirname(os.path.abspath(sourceLoc)), line.split()[-1]))
+    return(None)
+
+def BuildFatImage(sysDevicesIF, bootLoc, sizeBytes, hiddenSectors, eraseBlock, args):
+    """
+    Builds a FAT partition image of sizeBytes, for a partition starting at sector
+    hiddenSectors of a card with the given erase block size, from the boot directory in
+    the work directory. Returns the image path (the caller releases it with ReleaseImage).
+    """
+    Cache = args.image_cache
+    if Cache:
+        Files = [os.path.join(bootLoc, name) for name in sorted(os.listdir(bootLoc))
+                 if os.path.isfile(os.path.join(bootLoc, name))]
+        # The directory entries carry the modification times of the files
+        Key = Cache.key("fat", Files, [sizeBytes, hiddenSectors, FAT_LABEL, FAT32_RESERVED_SECTORS,
+                                       fat_alignment(eraseBlock), [int(os.path.getmtime(f)) for f in Files]])
+        ImagePath = Cache.lookup(Key)
+        if ImagePath:
+            print("Using cached BOOT:FAT32 image " + ImagePath)
+            return(ImagePath)
+        ImagePath = Cache.new_image_path(Key)
+    else:
+        fd, ImagePath = tempfile.mkstemp(prefix = "boot_", suffix = ".vfat", dir = args.work_dir)
+        os.close(fd)
+    if not sysDevicesIF.build_fat_image(bootLoc, ImagePath, sizeBytes, hiddenSectors, eraseBlock):
+        os.unlink(ImagePath)
+        exit(-1)
+    if Cache:
+        ImagePath = Cache.store(Key, ImagePath, {"source": os.path.abspath(bootLoc), "size": sizeBytes})
+    return(ImagePath)
+
+def BuildRootfsImage(sysDevicesIF, archivePath, sizeBytes, eraseBlock, args):
+    """
+    Builds a ROOTFS partition image of sizeBytes, tuned for the given erase block size,
+    from the archive in the work directory. Returns the image path (the caller releases
+    it with ReleaseImage).
+    """
+    Cache = args.image_cache
+    if Cache:
+        Key = Cache.key("rootfs", [archivePath], [sizeBytes, sysDevicesIF.rootfs_image_mkfs_options(eraseBlock)])
+        ImagePath = Cache.lookup(Key)
+        if ImagePath:
+            print("Using cached ROOTFS:EXT4 image " + ImagePath)
+            return(ImagePath)
+        ImagePath = Cache.new_image_path(Key)
+    else:
+        fd, ImagePath = tempfile.mkstemp(prefix = "rootfs_", suffix = ".ext4", dir = args.work_dir)
+        os.close(fd)
+    if not sysDevicesIF.build_rootfs_image(archivePath, ImagePath, sizeBytes, args.work_dir, eraseBlock):
+        os.unlink(ImagePath)
+        exit(-1)
+    if Cache:
+        ImagePath = Cache.store(Key, ImagePath, {"source": os.path.abspath(archivePath), "size": sizeBytes})
+    return(ImagePath)
+
+def ReleaseImage(imagePath, args):
+    """
+    Removes a partition image returned by BuildFatImage/BuildRootfsImage, or unpins it if
+    it is kept in the image cache.
+    """
+    if args.image_cache and args.image_cache.contains(imagePath):
+        args.image_cache.release(imagePath)
+    else:
+        os.unlink(imagePath)
+
+def InstallRootFS(sysDevicesIF, selectedDevice, args, verifyOp = True, imagePath = None):
+    if args.offline_rootfs:
+        # The partition is written as a whole so it must not be mounted
+        if not sysDevicesIF.unmount_partition(selectedDevice, ROOTFS_PARTITION):
             exit(-1)
+        DestPath = sysDevicesIF.node_path(selectedDevice, ROOTFS_PARTITION)
+    else:
+        DestPath = MountedPath(sysDevicesIF, selectedDevice, ROOTFS_PARTITION)
     if args.rootfs_loc:
         SourceLoc = args.rootfs_loc
     else:
@@ -805,20 +3688,39 @@ def InstallRootFS(sysDevicesIF, selectedDevice, args, verifyOp = True):
             print(Fore.RED + "User abort." + Fore.RESET)
             return
 
-    if sysDevicesIF.untar_gz_archive_to_sdcard_rootfs(DestPath, SourceLoc):
+    ArchivePath = RootfsArchivePath(SourceLoc)
+    if not ArchivePath or not os.path.isfile(ArchivePath):
+        print(Fore.RED + "ERROR: No ROOTFS archive found for '" + SourceLoc + "'." + Fore.RESET)
+        exit(-1)
+    if args.offline_rootfs:
+        ImagePath = imagePath
+        if not ImagePath:
+            ImagePath = BuildRootfsImage(sysDevicesIF, ArchivePath, sysDevicesIF.partition_size(DestPath),
+                                         sysDevicesIF.erase_block(selectedDevice), args)
+        Ok = sysDevicesIF.write_partition_image(ImagePath, DestPath)
+        ReleaseImage(ImagePath, args)
+        if not Ok:
+            exit(-1)
+        print(Fore.GREEN + "ROOTFS image has been written to ROOTFS partition." + Fore.RESET)
+    elif args.rootfs_delta:
+        ManifestPath = rootfs_manifest_path(ArchivePath)
+        if os.path.isfile(ManifestPath):
+            with open(ManifestPath) as f:
+                Manifest = json.load(f)
+        else:
+            print(Fore.YELLOW + "No manifest '" + ManifestPath + "', building it from the archive." + Fore.RESET)
+            Manifest = build_rootfs_manifest(ArchivePath)
+        if sysDevicesIF.delta_rootfs(DestPath, ArchivePath, Manifest):
+            print(Fore.GREEN + "ROOTFS partition has been updated." + Fore.RESET)
+        else:
+            exit(-1)
+    elif sysDevicesIF.extract_rootfs_archive(DestPath, ArchivePath):
         print(Fore.GREEN + "ROOTFS files have been copied to ROOTFS partition." + Fore.RESET)
     else:
         exit(-1)
 
 def InstallUserFiles(sysDevicesIF, selectedDevice, args, verifyOp = True):
-    DestPath = sysDevicesIF.is_mounted(selectedDevice, USER_PARTITION)
-    if not DestPath:
-        if not sysDevicesIF.mount_user_partition(selectedDevice):
-            exit(-1)
-        DestPath = sysDevicesIF.is_mounted(selectedDevice, USER_PARTITION)
-        if not DestPath:
-            print(Fore.RED + "ERROR: Unable to determine USER mount point." + Fore.RESET)
-            exit(-1)
+    DestPath = MountedPath(sysDevicesIF, selectedDevice, USER_PARTITION)
     if verifyOp:
         print("")
         print("Delete all current files on USER partition?")
@@ -857,6 +3759,694 @@ def InstallUserFiles(sysDevicesIF, selectedDevice, args, verifyOp = True):
     sync()
     print(Fore.GREEN + "USER files have been copied to USER partition." + Fore.RESET)
 
+def FlashCardImage(sysDevicesIF, selectedDevice, args, verifyOp = True):
+    if verifyOp:
+        print(Fore.RED + "THIS OPERATION WILL OVERWRITE THE ENTIRE " + selectedDevice.path + " DEVICE" + Fore.RESET)
+        print("Type in 'yippie ki-yay' then press <enter> to perform the operation")
+        UserInput = raw_input("or anything else to abort: ")
+        if UserInput != "yippie ki-yay":
+            print(Fore.RED + "User abort." + Fore.RESET)
+            return
+    print(Fore.GREEN + "Dis-mounting all mounts on " + selectedDevice.path + "..." + Fore.RESET)
+    if not sysDevicesIF.unmount_device(selectedDevice):
+        exit(-1)
+    if args.flash_bmap:
+        print("Writing mapped blocks of '" + args.flash_bmap + "' to " + selectedDevice.path)
+        if not sysDevicesIF.flash_block_map(selectedDevice, args.flash_bmap):
+            exit(-1)
+    else:
+        print("Writing '" + args.flash + "' to " + selectedDevice.path)
+        if not sysDevicesIF.flash_image(selectedDevice, args.flash):
+            exit(-1)
+
+def LoadManifest(args):
+    """
+    Returns the manifest used by --verify. An existing --manifest file is loaded, otherwise
+    the manifest is built from the command line sources (and saved if --manifest is given).
+    """
+    if args.manifest and os.path.isfile(args.manifest):
+        with open(args.manifest) as f:
+            return(json.load(f))
+    print("Building manifest from sources...")
+    Manifest = build_manifest(args.spl_loc, args.boot_loc,
+                              args.rootfs_loc and RootfsArchivePath(args.rootfs_loc), args.user_loc)
+    if args.manifest:
+        with open(args.manifest, "w") as f:
+            json.dump(Manifest, f)
+        print(Fore.GREEN + "Manifest written to '" + args.manifest + "'" + Fore.RESET)
+    return(Manifest)
+
+def VerifyCard(sysDevicesIF, selectedDevice, args):
+    """
+    Reads back the card and compares it with the manifest (args.manifest_data).
+    """
+    print(Fore.GREEN + "Verifying " + selectedDevice.path + "..." + Fore.RESET)
+    Manifest = args.manifest_data
+    MountPaths = {}
+    for key, node_index in (("fat", FAT_PARTITION), ("rootfs", ROOTFS_PARTITION), ("user", USER_PARTITION)):
+        if key in Manifest:
+            MountPaths[node_index] = MountedPath(sysDevicesIF, selectedDevice, node_index)
+    Failures = sysDevicesIF.verify_against_manifest(selectedDevice, Manifest, MountPaths)
+    if Failures:
+        for failure in Failures[:20]:
+            print(Fore.RED + "  " + failure + Fore.RESET)
+        print(Fore.RED + "ERROR: verify of " + selectedDevice.path + " failed ({} differences)".format(len(Failures)) + Fore.RESET)
+        exit(-1)
+    print(Fore.GREEN + "Verify of " + selectedDevice.path + " passed." + Fore.RESET)
+
+def ProvisionDevice(sysDevicesIF, selectedDevice, args, verifyOp = True):
+    """
+    Runs the operations selected on the command line against one device. The operations
+    are split into stages that run as soon as the stages they depend on are done, up to
+    --stage-jobs at a time (one at a time when the operations prompt the user).
+    """
+    Prebuilt = {}
+    Scheduler = StageScheduler(ProvisionPlan(sysDevicesIF, selectedDevice, args, verifyOp, Prebuilt),
+                               1 if verifyOp else args.stage_jobs, sysDevicesIF.Report)
+    if args.plan:
+        Scheduler.print_plan()
+        return
+    Failed = Scheduler.run()
+    for path in Prebuilt.values():
+        ReleaseImage(path, args)
+    FinishReport(sysDevicesIF, args)
+    if Failed:
+        for stage in Failed:
+            print(Fore.RED + "  " + stage.Name + " " + stage.State + Fore.RESET)
+        # A user abort exits with 0 and only skips what depends on it
+        exit(0 if all(stage.ExitCode == 0 for stage in Failed if stage.State == "failed") else -1)
+
+def ProvisionPlan(sysDevicesIF, selectedDevice, args, verifyOp, prebuilt):
+    """
+    Returns the stages of the command line selected operations for one device. Offline
+    partition images are built without waiting for the card and stored in prebuilt
+    (partition number -> image path) for the install stages to write.
+    """
+    Stages = []
+
+    def add(name, function, dependsOn = ()):
+        StageIF = sysDevicesIF.clone_for_stage()
+        StageIF.CurrentStage = name
+        Stages.append(Stage(name, lambda: function(StageIF, selectedDevice), dependsOn, selectedDevice.path))
+
+    if args.flash_bmap or args.flash:
+        # A full card image replaces the partition/format/copy operations.
+        add("FlashCardImage", lambda sdi, dev: FlashCardImage(sdi, dev, args, verifyOp))
+    else:
+        # Stages that need a partition formatted (or just the partition table)
+        After = {FAT_PARTITION: [], RAW_PARTITION: [], ROOTFS_PARTITION: [], USER_PARTITION: []}
+        Layout = None
+        if args.prepare_card:
+            Layout = CardLayout(selectedDevice, sysDevicesIF.erase_block(selectedDevice), sysDevicesIF.Layout)[0]
+
+            def partition(sdi, dev):
+                if not PartitionCard(sdi, dev, args, verifyOp):
+                    exit(0)
+
+            add("PartitionCard", partition)
+            for index in After:
+                After[index] = ["PartitionCard"]
+            if not (args.offline_fat and args.boot_loc):
+                add("PrepareFatPartition", lambda sdi, dev: PrepareFatPartition(sdi, dev, args), After[FAT_PARTITION])
+                After[FAT_PARTITION] = ["PrepareFatPartition"]
+            if not (args.offline_rootfs and args.rootfs_loc):
+                add("PrepareRootfsPartition", lambda sdi, dev: PrepareRootfsPartition(sdi, dev, args),
+                    After[ROOTFS_PARTITION])
+                After[ROOTFS_PARTITION] = ["PrepareRootfsPartition"]
+            add("PrepareUserPartition", lambda sdi, dev: PrepareUserPartition(sdi, dev, args, verifyOp),
+                After[USER_PARTITION])
+            After[USER_PARTITION] = ["PrepareUserPartition"]
+
+        def partition_geometry(sdi, dev, index):
+            # (size in bytes, first sector) of a partition, from the new layout if the card
+            # is being partitioned.
+            if Layout:
+                return(Layout[index-1][1] * SECTOR_SIZE, Layout[index-1][0])
+            NodePath = sdi.node_path(dev, index)
+            return(sdi.partition_size(NodePath), sdi.partition_start(NodePath))
+
+        if args.spl_loc:
+            add("InstallSPL", lambda sdi, dev: InstallSPL(sdi, dev, args), After[RAW_PARTITION])
+
+        if args.boot_loc:
+            if args.offline_fat:
+                def build_fat(sdi, dev):
+                    Size, Start = partition_geometry(sdi, dev, FAT_PARTITION)
+                    prebuilt[FAT_PARTITION] = BuildFatImage(sdi, args.boot_loc, Size, Start, sdi.erase_block(dev), args)
+
+                add("BuildFatImage", build_fat)
+                After[FAT_PARTITION] = After[FAT_PARTITION] + ["BuildFatImage"]
+            add("WriteBootFiles",
+                lambda sdi, dev: WriteBootFiles(sdi, dev, args, verifyOp, prebuilt.pop(FAT_PARTITION, None)),
+                After[FAT_PARTITION])
+
+        if args.rootfs_loc:
+            if args.offline_rootfs:
+                def build_rootfs(sdi, dev):
+                    ArchivePath = RootfsArchivePath(args.rootfs_loc)
+                    if not ArchivePath or not os.path.isfile(ArchivePath):
+                        print(Fore.RED + "ERROR: No ROOTFS archive found for '" + args.rootfs_loc + "'." + Fore.RESET)
+                        exit(-1)
+                    Size = partition_geometry(sdi, dev, ROOTFS_PARTITION)[0]
+                    prebuilt[ROOTFS_PARTITION] = BuildRootfsImage(sdi, ArchivePath, Size, sdi.erase_block(dev), args)
+
+                add("BuildRootfsImage", build_rootfs)
+                After[ROOTFS_PARTITION] = After[ROOTFS_PARTITION] + ["BuildRootfsImage"]
+            add("InstallRootFS",
+                lambda sdi, dev: InstallRootFS(sdi, dev, args, verifyOp, prebuilt.pop(ROOTFS_PARTITION, None)),
+                After[ROOTFS_PARTITION])
+
+        if args.user_loc:
+            add("InstallUserFiles", lambda sdi, dev: InstallUserFiles(sdi, dev, args, verifyOp),
+                After[USER_PARTITION])
+
+    def last_stages():
+        # The stages nothing else depends on yet
+        return([stage.Name for stage in Stages if not any(stage.Name in other.DependsOn for other in Stages)])
+
+    if args.verify:
+        add("VerifyCard", lambda sdi, dev: VerifyCard(sdi, dev, args), last_stages())
+    add("UnmountAllPartitions", lambda sdi, dev: UnmountAllPartitions(sdi, dev, args), last_stages())
+    return(Stages)
+
+class Stage(object):
+    """
+    One step of a provisioning plan. function() performs the step (the operations call
+    exit() on failure) once every stage named in dependsOn is done.
+    """
+
+    def __init__(self, name, function, dependsOn = (), device = ""):
+        self.Name = name
+        self.Function = function
+        self.DependsOn = list(dependsOn)
+        self.Device = device
+        self.State = "pending"
+        self.ExitCode = None
+        self.Seconds = 0.0
+
+class StageScheduler(object):
+    """
+    Runs a DAG of stages, at most jobs at a time. When a stage fails every stage that
+    depends on it is skipped while the stages that do not depend on it keep running.
+    """
+
+    def __init__(self, stages, jobs, report = None):
+        self.Stages = stages
+        self.Jobs = max(1, jobs)
+        self.Report = report
+        self.Running = 0
+        self.Condition = threading.Condition()
+        self.ByName = {}
+        for stage in stages:
+            if stage.Name in self.ByName:
+                raise ValueError("duplicate stage " + stage.Name)
+            self.ByName[stage.Name] = stage
+        for stage in stages:
+            for name in stage.DependsOn:
+                if name not in self.ByName:
+                    raise ValueError(stage.Name + " depends on unknown stage " + name)
+        self.waves()
+
+    def waves(self):
+        """
+        Returns the stages grouped in waves: a stage only depends on stages in earlier
+        waves. Raises ValueError if the dependencies have a cycle.
+        """
+        Depth = {}
+        Remaining = list(self.Stages)
+        while Remaining:
+            Ready = [stage for stage in Remaining if all(name in Depth for name in stage.DependsOn)]
+            if not Ready:
+                raise ValueError("stage dependency cycle in " + ", ".join(stage.Name for stage in Remaining))
+            for stage in Ready:
+                Depth[stage.Name] = 1 + max([Depth[name] for name in stage.DependsOn] or [-1])
+            Remaining = [stage for stage in Remaining if stage.Name not in Depth]
+        Waves = [[] for i in range(max(Depth.values()) + 1)] if Depth else []
+        for stage in self.Stages:
+            Waves[Depth[stage.Name]].append(stage)
+        return(Waves)
+
+    def print_plan(self):
+        print(Fore.YELLOW + "#### PROVISIONING PLAN ({} stages at a time) ####".format(self.Jobs) + Fore.RESET)
+        for i, wave in enumerate(self.waves()):
+            for stage in wave:
+                print("  {:>2}  {:<24} after: {}".format(i + 1, stage.Name, ", ".join(stage.DependsOn) or "-"))
+
+    def _run_stage(self, stage):
+        Start = time.time()
+        State = "done"
+        try:
+            if self.Report:
+                self.Report.stage(stage.Name, stage.Device, stage.Function)
+            else:
+                stage.Function()
+        except SystemExit as e:
+            State = "failed"
+            stage.ExitCode = e.code
+        except Exception as e:
+            State = "failed"
+            print(Fore.RED + "ERROR: " + stage.Name + " failed: " + str(e) + Fore.RESET)
+        stage.Seconds = time.time() - Start
+        with self.Condition:
+            stage.State = State
+            self.Running = self.Running - 1
+            self.Condition.notify()
+
+    def run(self):
+        """
+        Runs the stages and returns the ones that failed or were skipped. Interrupting the
+        run ends the commands the stages are running.
+        """
+        try:
+            self._schedule()
+        except KeyboardInterrupt:
+            cancel_all()
+            raise
+        return([stage for stage in self.Stages if stage.State != "done"])
+
+    def _schedule(self):
+        with self.Condition:
+            while True:
+                # Skip everything downstream of a failure
+                Changed = True
+                while Changed:
+                    Changed = False
+                    for stage in self.Stages:
+                        if stage.State == "pending" and \
+                           any(self.ByName[name].State in ("failed", "skipped") for name in stage.DependsOn):
+                            stage.State = "skipped"
+                            Changed = True
+                Ready = [stage for stage in self.Stages if stage.State == "pending" and
+                         all(self.ByName[name].State == "done" for name in stage.DependsOn)]
+                for stage in Ready[:self.Jobs - self.Running]:
+                    stage.State = "running"
+                    self.Running = self.Running + 1
+                    Worker = threading.Thread(target = self._run_stage, args = (stage,), name = stage.Name)
+                    Worker.daemon = True
+                    Worker.start()
+                if self.Running == 0:
+                    break
+                # A timeout keeps the wait interruptible
+                self.Condition.wait(0.5)
+
+class DeviceSlot(object):
+    """
+    State of one device in a multi-device run. Each slot has its own copy of the
+    SystemDevicesInterface (log file, private mount points).
+    """
+
+    def __init__(self, sysDevicesIF, selectedDevice, logFile):
+        self.Device = selectedDevice
+        Base, Ext = os.path.splitext(logFile)
+        self.SysDevicesIF = sysDevicesIF.clone_for_worker(Base + "_" + os.path.basename(selectedDevice.path) + Ext)
+        self.Passed = True
+        self.FailedStage = ""
+        self.Seconds = 0.0
+
+    def fail(self, stage):
+        self.Passed = False
+        self.FailedStage = stage
+        print(Fore.RED + "FAIL " + self.Device.path + " in " + stage + Fore.RESET)
+
+    def run(self, stage, function, report = True):
+        """
+        Runs function(sysDevicesIF, device) and returns its result. The operations call
+        exit() on failure so SystemExit (and any exception) marks the slot as failed.
+        With report the run is recorded as a stage of this device in the run report.
+        """
+        if not self.Passed:
+            return(None)
+        Start = time.time()
+        self.SysDevicesIF.CurrentStage = stage
+        Result = None
+        try:
+            if report:
+                Result = self.SysDevicesIF.Report.stage(stage, self.Device.path,
+                                                        lambda: function(self.SysDevicesIF, self.Device))
+            else:
+                Result = function(self.SysDevicesIF, self.Device)
+        except SystemExit:
+            self.fail(self.SysDevicesIF.CurrentStage or stage)
+        except Exception as e:
+            self.fail((self.SysDevicesIF.CurrentStage or stage) + " (" + str(e) + ")")
+        self.Seconds = self.Seconds + time.time() - Start
+        return(Result)
+
+class ProvisionWorker(threading.Thread):
+    """
+    Runs one stage for a single device on its own thread.
+    """
+
+    def __init__(self, slot, stage, function, semaphore):
+        threading.Thread.__init__(self, name = os.path.basename(slot.Device.path))
+        self.Slot = slot
+        self.Stage = stage
+        self.Function = function
+        self.Semaphore = semaphore
+
+    def run(self):
+        with self.Semaphore:
+            self.Slot.run(self.Stage, self.Function)
+
+def ParallelStage(slots, stage, function, jobs):
+    """
+    Runs a per-device stage on every device that has not failed, at most jobs at a time.
+    """
+    Semaphore = threading.BoundedSemaphore(max(1, jobs))
+    Workers = [ProvisionWorker(slot, stage, function, Semaphore) for slot in slots if slot.Passed]
+    for worker in Workers:
+        worker.start()
+    for worker in Workers:
+        worker.join()
+
+def FanOutStage(slots, stage, target, fan_out):
+    """
+    Runs a stage that writes the same data to every device. target(sysDevicesIF, device)
+    returns the device's destination (node or directory) and fan_out(destinations)
+    writes the data to all of them at once, returning the destinations that failed.
+    """
+    print(Fore.GREEN + stage + " on all devices." + Fore.RESET)
+    Targets = []
+    for slot in slots:
+        Dest = slot.run(stage, target, report = False)
+        if slot.Passed:
+            Targets.append((Dest, slot))
+    if not Targets:
+        return
+    Start = time.time()
+    Failed = fan_out([dest for dest, slot in Targets])
+    Elapsed = time.time() - Start
+    for dest, slot in Targets:
+        slot.Seconds = slot.Seconds + Elapsed
+        if dest in Failed:
+            slot.fail(stage)
+
+def FinishReport(sysDevicesIF, args):
+    """
+    Prints the timing table of the run and writes the --report and --trace files.
+    """
+    sysDevicesIF.Report.print_table()
+    try:
+        if args.report:
+            sysDevicesIF.Report.write(args.report)
+        if args.trace:
+            sysDevicesIF.Report.write_trace(args.trace)
+    except (IOError, OSError) as e:
+        print(Fore.RED + "ERROR: writing the run report failed: " + str(e) + Fore.RESET)
+
+def ProvisionDevices(sysDevicesIF, devices, args):
+    """
+    Provisions several devices at once and prints a combined summary. Per-device work
+    (partitioning, formatting, user files) runs on one worker per device. Data that is the
+    same for every card (SPL, boot files, rootfs) is read and decompressed once and fanned
+    out to all of the cards. Returns True if every device passed.
+    """
+    # The cards share one layout (and partition images), aligned to the largest erase block.
+    if not sysDevicesIF.EraseBlock:
+        sysDevicesIF.EraseBlock = max(sysDevicesIF.erase_block(device) for device in devices)
+    if args.prepare_card:
+        # Check the layout fits every card before anything is written
+        Layouts = [CardLayout(device, sysDevicesIF.EraseBlock, sysDevicesIF.Layout)[0] for device in devices]
+        # Offline images are built once, for the first card's partitions (percent and
+        # "rest" sizes depend on the size of the card).
+        for name, index, enabled in (("FAT", FAT_PARTITION, args.boot_loc and args.offline_fat),
+                                     ("ROOTFS", ROOTFS_PARTITION, args.rootfs_loc and args.offline_rootfs)):
+            if enabled and any(layout[index-1] != Layouts[0][index-1] for layout in Layouts):
+                print(Fore.RED + "ERROR: the " + name + " partition would differ between the cards, "
+                      "so one offline image can not be written to all of them. Use cards of the same size "
+                      "or give the partition a fixed size." + Fore.RESET)
+                exit(-1)
+    Slots = [DeviceSlot(sysDevicesIF, device, args.logfile) for device in devices]
+    Prebuilt = {}
+    Scheduler = StageScheduler(ProvisionStages(sysDevicesIF, Slots, args, Prebuilt), args.stage_jobs,
+                               sysDevicesIF.Report)
+    if args.plan:
+        print("Devices: " + ", ".join(device.path for device in devices))
+        Scheduler.print_plan()
+        return(True)
+    Start = time.time()
+    Scheduler.run()
+    for path in Prebuilt.values():
+        ReleaseImage(path, args)
+    Elapsed = time.time() - Start
+    FinishReport(sysDevicesIF, args)
+
+    print("")
+    print(Fore.YELLOW + "#### PROVISIONING SUMMARY ####" + Fore.RESET)
+    Passed = 0
+    for slot in Slots:
+        Text = "  {:<14} {:8.1f}s  ".format(slot.Device.path, slot.Seconds)
+        if slot.Passed:
+            Passed = Passed + 1
+            print(Fore.GREEN + Text + "PASS" + Fore.RESET)
+        else:
+            print(Fore.RED + Text + "FAIL in " + slot.FailedStage + Fore.RESET)
+    print("  {} of {} devices passed in {:.1f}s".format(Passed, len(Slots), Elapsed))
+    return(Passed == len(Slots))
+
+def ProvisionStages(sysDevicesIF, slots, args, prebuilt):
+    """
+    Returns the stages that run the command line selected operations on every device
+    slot. The device stages each cover all of the slots and run one after the other.
+    Offline partition images are built alongside them and stored in prebuilt.
+    """
+    Stages = []
+    DeviceStages = []
+
+    def add(name, function, dependsOn = ()):
+        Stages.append(Stage(name, function, DeviceStages[-1:] + list(dependsOn)))
+        DeviceStages.append(name)
+
+    def add_build(name, index, build):
+        # Builds an image (once) for every card. A failed build fails all of the cards.
+        def run():
+            try:
+                prebuilt[index] = build(BuildIF)
+            except SystemExit:
+                for slot in slots:
+                    slot.fail(name)
+                raise
+
+        BuildIF = sysDevicesIF.clone_for_stage()
+        Stages.append(Stage(name, run))
+
+    def write_image(index):
+        def write(sdi, dev):
+            if not sdi.unmount_partition(dev, index):
+                exit(-1)
+            if not sdi.write_partition_image(prebuilt[index], sdi.node_path(dev, index)):
+                exit(-1)
+        return(write)
+
+    def partition_geometry(sdi, index):
+        # ProvisionDevices checked the imaged partitions are the same on every card, so the
+        # first card's geometry is used for images.
+        if args.prepare_card:
+            Start, Sectors = CardLayout(slots[0].Device, sdi.erase_block(slots[0].Device), sdi.Layout)[0][index-1]
+            return(Sectors * SECTOR_SIZE, Start)
+        NodePath = sdi.node_path(slots[0].Device, index)
+        return(sdi.partition_size(NodePath), sdi.partition_start(NodePath))
+
+    if args.flash_bmap or args.flash:
+        add("FlashCardImage", lambda: ParallelStage(slots, "FlashCardImage",
+            lambda sdi, dev: FlashCardImage(sdi, dev, args, verifyOp = False), args.jobs))
+    else:
+        if args.prepare_card:
+            add("PrepareSDCard", lambda: ParallelStage(slots, "PrepareSDCard",
+                lambda sdi, dev: PrepareSDCard(sdi, dev, args, verifyOp = False), args.jobs))
+
+        if args.spl_loc:
+            add("InstallSPL", lambda: FanOutStage(slots, "InstallSPL",
+                lambda sdi, dev: sdi.node_path(dev, RAW_PARTITION),
+                lambda nodes: sysDevicesIF.fan_out_spl(args.spl_loc, nodes)))
+
+        if args.boot_loc and args.offline_fat:
+            # Build the image once and block write it to every card
+            def build_fat(sdi):
+                Size, Start = partition_geometry(sdi, FAT_PARTITION)
+                return(BuildFatImage(sdi, args.boot_loc, Size, Start, sdi.erase_block(slots[0].Device), args))
+
+            add_build("BuildFatImage", FAT_PARTITION, build_fat)
+            add("WriteBootFiles", lambda: ParallelStage(slots, "WriteBootFiles",
+                write_image(FAT_PARTITION), args.jobs), ["BuildFatImage"])
+        elif args.boot_loc and args.sync:
+            add("WriteBootFiles", lambda: ParallelStage(slots, "WriteBootFiles",
+                lambda sdi, dev: WriteBootFiles(sdi, dev, args, verifyOp = False), args.jobs))
+        elif args.boot_loc:
+            add("WriteBootFiles", lambda: FanOutStage(slots, "WriteBootFiles",
+                lambda sdi, dev: MountedPath(sdi, dev, FAT_PARTITION),
+                lambda dirs: sysDevicesIF.fan_out_files(os.path.join(args.boot_loc, ''), dirs)))
+
+        if args.rootfs_loc:
+            ArchivePath = RootfsArchivePath(args.rootfs_loc)
+            if not ArchivePath:
+                print(Fore.RED + "ERROR: No archive found in '" + args.rootfs_loc + "'." + Fore.RESET)
+                for slot in slots:
+                    slot.fail("InstallRootFS")
+            elif args.offline_rootfs:
+                def build_rootfs(sdi):
+                    return(BuildRootfsImage(sdi, ArchivePath, partition_geometry(sdi, ROOTFS_PARTITION)[0],
+                                            sdi.erase_block(slots[0].Device), args))
+
+                add_build("BuildRootfsImage", ROOTFS_PARTITION, build_rootfs)
+                add("InstallRootFS", lambda: ParallelStage(slots, "InstallRootFS",
+                    write_image(ROOTFS_PARTITION), args.jobs), ["BuildRootfsImage"])
+            elif args.rootfs_delta:
+                add("InstallRootFS", lambda: ParallelStage(slots, "InstallRootFS",
+                    lambda sdi, dev: InstallRootFS(sdi, dev, args, verifyOp = False), args.jobs))
+            else:
+                add("InstallRootFS", lambda: FanOutStage(slots, "InstallRootFS",
+                    lambda sdi, dev: MountedPath(sdi, dev, ROOTFS_PARTITION),
+                    lambda dirs: sysDevicesIF.fan_out_rootfs(ArchivePath, dirs)))
+
+        if args.user_loc:
+            add("InstallUserFiles", lambda: ParallelStage(slots, "InstallUserFiles",
+                lambda sdi, dev: InstallUserFiles(sdi, dev, args, verifyOp = False), args.jobs))
+
+    if args.verify:
+        add("VerifyCard", lambda: ParallelStage(slots, "VerifyCard",
+            lambda sdi, dev: VerifyCard(sdi, dev, args), args.jobs))
+    add("UnmountAllPartitions", lambda: ParallelStage(slots, "UnmountAllPartitions",
+        lambda sdi, dev: UnmountAllPartitions(sdi, dev, args), args.jobs))
+    return(Stages)
+
+class HotplugMonitor(object):
+    """
+    Waits for block devices to be added, changed or removed. Kernel uevents are read from
+    a netlink socket; if one can not be opened /sys/block is polled instead.
+    """
+
+    def __init__(self):
+        self.Socket = None
+        try:
+            self.Socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            # Multicast group 1 carries the kernel's uevents
+            self.Socket.bind((0, 1))
+            self.Socket.setblocking(False)
+        except (AttributeError, socket.error) as e:
+            print(Fore.YELLOW + "Uevents are not available (" + str(e) + "), polling /sys/block." + Fore.RESET)
+            self.Socket = None
+
+    def wait(self, timeout):
+        """
+        Returns True if a disk was added, changed or removed within timeout seconds. When
+        polling it always waits the full timeout and returns True.
+        """
+        if not self.Socket:
+            sleep(timeout)
+            return(True)
+        if not select.select([self.Socket], [], [], timeout)[0]:
+            return(False)
+        Changed = False
+        while True:
+            try:
+                Data = self.Socket.recv(65536)
+            except socket.error:
+                break
+            # "ACTION@DEVPATH" followed by KEY=VALUE fields, all NUL terminated
+            Fields = dict(field.split(b"=", 1) for field in Data.split(b"\0")[1:] if b"=" in field)
+            if Fields.get(b"SUBSYSTEM") == b"block" and Fields.get(b"DEVTYPE") == b"disk":
+                Changed = True
+        return(Changed)
+
+class WatchWorker(threading.Thread):
+    """
+    Provisions one card that was inserted in --watch mode and signals its result.
+    """
+
+    def __init__(self, sysDevicesIF, device, args, results):
+        threading.Thread.__init__(self, name = os.path.basename(device.path))
+        self.daemon = True
+        self.SysDevicesIF = sysDevicesIF
+        self.Device = device
+        self.Args = args
+        self.Results = results
+
+    def run(self):
+        print(Fore.GREEN + "Provisioning " + self.Device.path + " [{0}]".format(self.Device.size.pretty(units = "GiB")) + Fore.RESET)
+        Slot = DeviceSlot(self.SysDevicesIF, self.Device, self.Args.logfile)
+        Prebuilt = {}
+        try:
+            Failed = StageScheduler(ProvisionStages(self.SysDevicesIF, [Slot], self.Args, Prebuilt),
+                                    self.Args.stage_jobs, self.SysDevicesIF.Report).run()
+        finally:
+            for path in Prebuilt.values():
+                ReleaseImage(path, self.Args)
+        if Failed and Slot.Passed:
+            Slot.fail(Failed[0].Name)
+        self.Results.append(Slot)
+        Text = "  {:<14} {:8.1f}s  ".format(self.Device.path, Slot.Seconds)
+        if Slot.Passed:
+            print(Fore.GREEN + Text + "PASS" + Fore.RESET)
+        else:
+            print(Fore.RED + Text + "FAIL in " + Slot.FailedStage + Fore.RESET)
+        if self.Args.watch_hook:
+            cmd = self.Args.watch_hook + " " + self.Device.path + " " + ("PASS" if Slot.Passed else "FAIL") + \
+                  " '" + Slot.FailedStage.replace("'", "") + "'"
+            Slot.SysDevicesIF.run_cmd(cmd, timeout = WATCH_HOOK_TIMEOUT)
+
+def WatchDevices(sysDevicesIF, args):
+    """
+    Production line mode. Waits for cards to be inserted and provisions every new card
+    in an SD/MMC card reader (BlockDevice.is_card_reader) that passes validate_device
+    with the command line selected operations, at most args.jobs cards at a time. Cards already present when
+    the watch starts are left alone. The result of each card is printed and passed to
+    the --watch-hook command. Runs until interrupted.
+    """
+    if args.plan:
+        print("Stages run for every inserted card:")
+        StageScheduler(ProvisionStages(sysDevicesIF, [], args, {}), args.stage_jobs).print_plan()
+        return
+    Monitor = HotplugMonitor()
+    Present = dict((device.path, device.size.to("B")) for device in probe_block_devices())
+    for path in sorted(Present):
+        print(Style.DIM + "Already present, not provisioned: " + path + Style.RESET_ALL)
+    print(Fore.GREEN + "Waiting for cards (Ctrl-C to stop)." + Fore.RESET)
+    Active = {}
+    Waiting = []
+    Results = []
+    try:
+        while True:
+            if Monitor.wait(WATCH_POLL_INTERVAL) and Monitor.Socket:
+                sleep(WATCH_SETTLE)
+            Devices = probe_block_devices()
+            Current = dict((device.path, device.size.to("B")) for device in Devices)
+            for device in Devices:
+                # A new device or new media in a reader that was seen before
+                if Present.get(device.path) == Current[device.path]:
+                    continue
+                if device.path in Active or device.path in [d.path for d in Waiting]:
+                    continue
+                if not device.is_card_reader():
+                    print(Style.DIM + "Ignoring " + device.path + ", not an SD/MMC card reader (" +
+                          device.description() + ")" + Style.RESET_ALL)
+                    continue
+                if not sysDevicesIF.validate_device(device):
+                    print(Style.DIM + "Ignoring " + device.path + Style.RESET_ALL)
+                    continue
+                Waiting.append(device)
+            Present = Current
+            for path, worker in list(Active.items()):
+                if not worker.is_alive():
+                    del Active[path]
+            while Waiting and len(Active) < max(1, args.jobs):
+                Device = Waiting.pop(0)
+                # Removed again before its turn
+                if Device.path not in Present:
+                    continue
+                Active[Device.path] = WatchWorker(sysDevicesIF, Device, args, Results)
+                Active[Device.path].start()
+    except KeyboardInterrupt:
+        print("")
+        Running = [worker for worker in Active.values() if worker.is_alive()]
+        print(Fore.YELLOW + "Stopping, cancelling {} running card(s).".format(len(Running)) + Fore.RESET)
+        cancel_all()
+        for worker in Running:
+            worker.join()
+    FinishReport(sysDevicesIF, args)
+    Passed = len([slot for slot in Results if slot.Passed])
+    print("  {} of {} cards passed".format(Passed, len(Results)))
+
 ####################################################################################################
 
 if __name__ == '__main__':
@@ -871,16 +4461,53 @@ if __name__ == '__main__':
                         help = 'Used to specify the SD block device node (e.g., sdc)')
     Parser.add_argument('--prepare_card', action = 'store_true',
                         help = 'Will re-partition and format the target device')
+    Parser.add_argument('--erase', choices = ['discard', 'secure'],
+                        help = 'Erases the card with discard (or secure discard) before re-partitioning (requires --prepare_card).')
+    Parser.add_argument('--erase-partitions', dest = 'erase_partitions', default = '',
+                        help = 'Comma separated partitions (' + ', '.join(sorted(PARTITION_NAMES)) + ') to erase after re-partitioning instead of the whole card.')
+    Parser.add_argument('--erase-zero-fallback', dest = 'erase_zero_fallback', action = 'store_true',
+                        help = 'Writes zeros to all of the erased card or partitions when they do not support discard '
+                               '(by default only the first {}MiB are zeroed).'.format(ERASE_ZERO_HEAD // MIB))
+    Parser.add_argument('--layout',
+                        help = 'JSON or TOML file with the partition sizes, types and mkfs profiles used by --prepare_card, '
+                               'or auto to size the FAT and ROOTFS partitions to their content.')
+    Parser.add_argument('--headroom', type = int, default = AUTO_HEADROOM,
+                        help = 'Free space left in the partitions sized by --layout auto, in percent (default {}).'.format(AUTO_HEADROOM))
+    Parser.add_argument('--erase-block', dest = 'erase_block',
+                        help = 'Erase block (allocation unit) size of the card (e.g., 4MiB), detected if not given.')
     Parser.add_argument('-i', '--images_loc', default = '../ImageFiles',
                         help = 'Specifies the image files directory containing partition directories.')
     Parser.add_argument('-s', '--spl_loc',
                         help = 'Specifies the source data for the SPL image to be written to the RAW partition.')
     Parser.add_argument('-r', '--rootfs_loc',
                         help = 'Specifies the source data for the files written to the ROOTFS partition.')
+    Parser.add_argument('--rootfs-delta', dest = 'rootfs_delta', action = 'store_true',
+                        help = 'Only writes ROOTFS files that changed (using the archive manifest) and removes deleted ones.')
+    Parser.add_argument('--offline-rootfs', dest = 'offline_rootfs', action = 'store_true',
+                        help = 'Builds the ROOTFS ext4 image on the host and block writes it instead of extracting onto the card.')
+    Parser.add_argument('--work-dir', dest = 'work_dir', default = None,
+                        help = 'Directory for temporary staging and partition images (default: system temp dir).')
+    Parser.add_argument('--cache-dir', dest = 'cache_dir', default = IMAGE_CACHE_DIR,
+                        help = 'Cache of offline built partition images (default ' + IMAGE_CACHE_DIR + ').')
+    Parser.add_argument('--cache-size', dest = 'cache_size', default = IMAGE_CACHE_BUDGET,
+                        help = 'Size budget of the partition image cache (default ' + IMAGE_CACHE_BUDGET + ').')
+    Parser.add_argument('--no-cache', dest = 'no_cache', action = 'store_true',
+                        help = 'Always rebuilds offline partition images and does not cache them.')
+    Parser.add_argument('--cache', choices = ['stats', 'prune'],
+                        help = 'Shows the partition image cache contents or prunes it to --cache-size, then exits.')
     Parser.add_argument('-c', '--rootfs_copy_loc',
                         help = 'Specifies the file path for storing a ROOTFS copy.')
+    Parser.add_argument('--rootfs-codec', dest = 'rootfs_codec',
+                        choices = sorted(ROOTFS_CODECS.keys()),
+                        help = 'Compression used for a ROOTFS copy (default from the -c extension, or ' + ROOTFS_DEFAULT_CODEC + ').')
+    Parser.add_argument('--codec-level', dest = 'codec_level', type = int,
+                        help = 'Compression level for --rootfs-codec (codec default if not given).')
     Parser.add_argument('-b', '--boot_loc',
                         help = 'Specifies the source data for the files written to the FAT partition.')
+    Parser.add_argument('--offline-fat', dest = 'offline_fat', action = 'store_true',
+                        help = 'Builds the BOOT FAT32 image on the host and block writes it instead of copying onto the card.')
+    Parser.add_argument('--sync', action = 'store_true',
+                        help = 'Only copies boot files that changed and deletes ones no longer in --boot_loc.')
     Parser.add_argument('-u', '--user_loc',
                         help = 'Specifies the source data for the files written to the USER partition.')
     Parser.add_argument('--logfile', default = 'log.txt',
@@ -891,6 +4518,34 @@ if __name__ == '__main__':
                         help = 'Outputs detected device information (list of devices).')
     Parser.add_argument('-v', '--verbose', action = 'store_true',
                         help = 'Increases the amount of output messages.')
+    Parser.add_argument('--devices', default = '',
+                        help = 'Comma separated list of devices (e.g., sdc,sdd,sde) to provision in parallel.')
+    Parser.add_argument('-j', '--jobs', type = int, default = 8,
+                        help = 'Maximum number of devices provisioned at the same time with --devices or --watch.')
+    Parser.add_argument('--watch', action = 'store_true',
+                        help = 'Waits for cards to be inserted and provisions each new one (production line mode).')
+    Parser.add_argument('--watch-hook', dest = 'watch_hook',
+                        help = 'Command run after each --watch card with the device, PASS or FAIL and the failed stage.')
+    Parser.add_argument('--stage-jobs', dest = 'stage_jobs', type = int, default = 4,
+                        help = 'Maximum number of independent stages run at the same time (1 when prompting).')
+    Parser.add_argument('--report',
+                        help = 'Writes the time, bytes moved and MiB/s of every stage and command to a JSON file.')
+    Parser.add_argument('--trace',
+                        help = 'Writes a timeline of the stages, commands and workers in Chrome Trace Event Format (Perfetto).')
+    Parser.add_argument('--plan', action = 'store_true',
+                        help = 'Prints the stages that would run and their dependencies, then exits.')
+    Parser.add_argument('--target-image', dest = 'target_image',
+                        help = 'Builds a card image file instead of writing to a device (requires --size).')
+    Parser.add_argument('--size',
+                        help = 'Size of the card image created by --target-image (e.g., 4GiB).')
+    Parser.add_argument('--flash-bmap', dest = 'flash_bmap',
+                        help = 'Writes the mapped blocks of a card image (using its .bmap file) and verifies them.')
+    Parser.add_argument('--verify', action = 'store_true',
+                        help = 'Reads the card back and compares it with the manifest.')
+    Parser.add_argument('--manifest',
+                        help = 'Manifest file used by --verify (created from the sources if it does not exist).')
+    Parser.add_argument('--flash',
+                        help = 'Writes a whole card image (.img, .img.gz/.zst/.lz4/.xz) to the device.')
 
     Args = Parser.parse_args()
     SysDevicesIF = SystemDevicesInterface(logFile = Args.logfile, echo_cmds = Args.verbose)
@@ -899,6 +4554,18 @@ if __name__ == '__main__':
         SysDevicesIF.list_devices()
         exit(0)
 
+    CacheBudget = parse_size(Args.cache_size)
+    if CacheBudget is None:
+        print(Fore.RED + "Cache size '" + Args.cache_size + "' is not valid." + Fore.RESET)
+        exit(-1)
+    Cache = PartitionImageCache(Args.cache_dir, CacheBudget)
+    Args.image_cache = None if Args.no_cache else Cache
+    if Args.cache:
+        if Args.cache == 'prune':
+            print("Freed {:.1f}MiB".format(Cache.prune() / float(MIB)))
+        Cache.print_stats()
+        exit(0)
+
     # If the user has specified a SPL file location.
     # Check to make sure it is a valid file.
     if Args.spl_loc:
@@ -919,24 +4586,117 @@ if __name__ == '__main__':
         if not os.path.isfile(Args.rootfs_loc):
             print(Fore.RED + "ROOTFS files location specified '" + Args.rootfs_loc + "' is not valid." + Fore.RESET)
             exit(-1)
+    if Args.flash_bmap:
+        if not os.path.isfile(Args.flash_bmap) or not os.path.isfile(Args.flash_bmap + BMAP_EXTENSION):
+            print(Fore.RED + "Card image '" + Args.flash_bmap + "' or its block map is not valid." + Fore.RESET)
+            exit(-1)
+    if Args.flash:
+        if not os.path.isfile(Args.flash):
+            print(Fore.RED + "Card image '" + Args.flash + "' is not valid." + Fore.RESET)
+            exit(-1)
     if Args.user_loc:
         if not os.path.isdir(Args.user_loc):
             print(Fore.RED + "USER files location specified '" + Args.user_loc + "' is not valid." + Fore.RESET)
             exit(-1)
 
+    # An image target must have a size and always gets a fresh partition table.
+    ImageSize = None
+    if Args.target_image:
+        if not Args.size:
+            print(Fore.RED + "An image size (--size) is required with --target-image." + Fore.RESET)
+            exit(-1)
+        ImageSize = parse_size(Args.size)
+        if not ImageSize or ImageSize % SECTOR_SIZE:
+            print(Fore.RED + "Image size '" + Args.size + "' is not valid." + Fore.RESET)
+            exit(-1)
+        Args.prepare_card = True
+
+    if Args.erase_block:
+        SysDevicesIF.EraseBlock = parse_size(Args.erase_block)
+        if not SysDevicesIF.EraseBlock or SysDevicesIF.EraseBlock % SECTOR_SIZE or SysDevicesIF.EraseBlock > MAX_ERASE_BLOCK:
+            print(Fore.RED + "Erase block size '" + Args.erase_block + "' is not valid." + Fore.RESET)
+            exit(-1)
+
+    if Args.layout == "auto":
+        if Args.headroom < 0:
+            print(Fore.RED + "Headroom must not be negative." + Fore.RESET)
+            exit(-1)
+        SysDevicesIF.Layout = AutoLayout(Args)
+    elif Args.layout:
+        SysDevicesIF.Layout = LoadLayout(Args.layout)
+    if Args.layout and Args.prepare_card:
+        # The layout's sizes are only needed to partition the card
+        print("Measuring partition content for the " + SysDevicesIF.Layout.Source + " layout.")
+        try:
+            SysDevicesIF.Layout.measure(Args)
+        except (IOError, OSError, ValueError) as e:
+            print(Fore.RED + "ERROR: layout '" + Args.layout + "': " + str(e) + Fore.RESET)
+            exit(-1)
+
+    if Args.erase_zero_fallback and not Args.erase:
+        print(Fore.RED + "--erase-zero-fallback requires --erase." + Fore.RESET)
+        exit(-1)
+    if Args.erase:
+        if not Args.prepare_card:
+            print(Fore.RED + "--erase requires --prepare_card." + Fore.RESET)
+            exit(-1)
+        for name in Args.erase_partitions.split(",") if Args.erase_partitions else []:
+            if name.strip() not in PARTITION_NAMES:
+                print(Fore.RED + "Partition '" + name + "' is not valid for --erase-partitions." + Fore.RESET)
+                exit(-1)
+
+    if Args.verify and not Args.plan:
+        Args.manifest_data = LoadManifest(Args)
+
     print("------------------------------------------------------")
     print("| Script to create Boot SD card for Altera SOC FPGAs |")
     print("------------------------------------------------------")
     print("")
     print(Fore.RED + "Warning: Will delete all data on target device!!!" + Fore.RESET)
 
-    if (not Args.boot_loc) and (not Args.rootfs_loc) and (not Args.prepare_card):
+    if Args.devices:
+        # Multi-device mode never prompts per operation so ask once for all of the devices.
+        Devices = []
+        for name in Args.devices.split(','):
+            Device = SysDevicesIF.find_device(name.strip())
+            if not SysDevicesIF.validate_device(Device):
+                print(Fore.RED + "ERROR: '" + name + "' is not a valid SDCard device." + Fore.RESET)
+                exit(-1)
+            Devices.append(Device)
+        if not Args.force and not Args.plan:
+            print("The following devices will be provisioned:")
+            for device in Devices:
+                print(Fore.GREEN + "  " + device.path + " [{0}]".format(device.size.pretty(units = "GiB")) + Fore.RESET)
+            print("Type in 'yippie ki-yay' then press <enter> to perform the operation")
+            UserInput = raw_input("or anything else to abort: ")
+            if UserInput != "yippie ki-yay":
+                print(Fore.RED + "User abort." + Fore.RESET)
+                exit(0)
+        if not ProvisionDevices(SysDevicesIF, Devices, Args):
+            exit(-1)
+        exit(0)
+
+    if Args.watch:
+        # Cards are provisioned without prompting so ask once before watching.
+        if not Args.force and not Args.plan:
+            print("Every card inserted from now on will be provisioned.")
+            print("Type in 'yippie ki-yay' then press <enter> to perform the operation")
+            UserInput = raw_input("or anything else to abort: ")
+            if UserInput != "yippie ki-yay":
+                print(Fore.RED + "User abort." + Fore.RESET)
+                exit(0)
+        WatchDevices(SysDevicesIF, Args)
+        exit(0)
+
+    if (not Args.boot_loc) and (not Args.rootfs_loc) and (not Args.prepare_card) and (not Args.target_image) \
+       and (not Args.flash_bmap) and (not Args.flash):
         # no command line options to tell us what to do so go run the interactive version
         #--------------------------------------------------------------------------------
         Operations = [
                       ('re-partition and format entire SDCARD', PrepareSDCard),
                       ('install SPL to RAW partition', InstallSPL),
                       ('install boot files on FAT partition', WriteBootFiles),
+                      ('sync changed boot files to FAT partition', SyncBootFiles),
                       ('install ROOTFS to SDCARD', InstallRootFS),
                       ('install USER files to SDCARD', InstallUserFiles),
                       ('', None),
@@ -959,42 +4719,46 @@ if __name__ == '__main__':
         while True:
             print("")
             SelectedOperation = get_operation_selection(SelectedDrive, Operations)
-            SelectedOperation[1](SysDevicesIF, SelectedDrive, Args)
+            SysDevicesIF.Report.stage(SelectedOperation[1].__name__, SelectedDrive.path,
+                                      lambda: SelectedOperation[1](SysDevicesIF, SelectedDrive, Args))
+            if Args.report:
+                SysDevicesIF.Report.write(Args.report)
+            if Args.trace:
+                SysDevicesIF.Report.write_trace(Args.trace)
         exit(0)
 
     if Args.verbose:
         pprint.pprint(Args)
 
-    if Args.device:
+    if Args.target_image and Args.plan:
+        # Nothing is written for a plan so the image is not created or attached
+        SelectedDrive = ImageFileDevice(Args.target_image, Args.target_image, ImageSize)
+    elif Args.target_image:
+        SelectedDrive = SysDevicesIF.attach_image(Args.target_image, ImageSize)
+        if not SelectedDrive:
+            exit(-1)
+    elif Args.device:
         ArgDevice = SysDevicesIF.find_device(Args.device)
         if not SysDevicesIF.validate_device(ArgDevice):
             exit(-1)
         SelectedDrive = ArgDevice
     else:
         SelectedDrive = get_drive_selection(SysDevicesIF)
-    # Verify that the specified drive is not a BIG drive.  This is a simple test to
-    # ensure that we are not going to try to format any thing other than an SD card.
-    # SD cards should be less than 32GiB.
-    if not SysDevicesIF.validate_device(SelectedDrive):
-        print("ERROR: Failed device validation for '"+SelectedDrive+"'")
-        exit(-1)
-
-    if Args.prepare_card:
-        PrepareSDCard(SysDevicesIF, SelectedDrive, Args, not Args.force)
-
-    if Args.spl_loc:
-        InstallSPL(SysDevicesIF, SelectedDrive, Args)
-
-    if Args.boot_loc:
-        WriteBootFiles(SysDevicesIF, SelectedDrive, Args, not Args.force)
-
-    if Args.rootfs_loc:
-        InstallRootFS(SysDevicesIF, SelectedDrive, Args, not Args.force)
-
-    if Args.user_loc:
-        InstallUserFiles(SysDevicesIF, SelectedDrive, Args, not Args.force)
+    try:
+        # Verify that the specified drive is not a BIG drive.  This is a simple test to
+        # ensure that we are not going to try to format any thing other than an SD card.
+        # SD cards should be less than 32GiB.
+        if not SysDevicesIF.validate_device(SelectedDrive):
+            print("ERROR: Failed device validation for '"+str(SelectedDrive)+"'")
+            exit(-1)
 
-    UnmountAllPartitions(SysDevicesIF, SelectedDrive, Args)
+        ProvisionDevice(SysDevicesIF, SelectedDrive, Args, not Args.force)
+    finally:
+        # The loop device is released even when provisioning fails
+        if Args.target_image and not Args.plan:
+            SysDevicesIF.detach_image(SelectedDrive)
+    if Args.target_image and not Args.plan:
+        SysDevicesIF.write_block_map(SelectedDrive.image_path)
 
     print("")
     print("------------------------------------------------------------------------")